@@ -3,13 +3,20 @@
 from os import path
 from optparse import OptionParser
 from skime.vm import VM
+from skime import insns
+from skime import skc
 
 from skime.compiler.compiler import Compiler
 from skime.compiler.parser import parse
 
 op       = OptionParser()
 op.add_option('-S', action="store_true", dest="do_not_run",
-              help = "Compile source file and drop into .s file then stop.");
+              help = "Compile source file and drop into .skc file then stop.");
+op.add_option('-e', '--engine', dest="engine", default=insns.DEFAULT_ENGINE,
+              choices=insns.ENGINES.keys(),
+              help = "Run loop used to execute bytecode: %s." % ', '.join(insns.ENGINES.keys()));
+op.add_option('--stats', dest="stats", metavar="FILE",
+              help = "Write instruction counts, times and pairs as JSON to FILE.");
 
 (options, args) = op.parse_args()
 
@@ -23,18 +30,34 @@ def is_valid_path(source_file_path):
    return path.exists(source_file_path) and path.isfile(source_file_path)
 
 
-source_file = open(args[0])
-
-vm          = VM()
-compiler    = Compiler()
-proc        = compiler.compile(parse(source_file.read()), vm.env)
+vm          = VM(engine=options.engine)
+if args[0].endswith('.skc'):
+    # compiled by -S, see skime/skc.py
+    source_file = open(args[0], 'rb')
+    proc        = skc.load(source_file, vm)
+else:
+    source_file = open(args[0])
+    compiler    = Compiler()
+    proc        = compiler.compile(parse(source_file.read()), vm.env)
 
 
 if not options.do_not_run:
+    if options.stats:
+        vm.enable_stats()
     result      = vm.run(proc)
 
     print "Result is %s" % result
     source_file.close()
+
+    if options.stats:
+        stats_file = open(options.stats, "w")
+        vm.stats.dump(stats_file)
+        stats_file.close()
 else:
-    print "Bytecode:\n%s" % str(proc.bytecode)
+    source_file.close()
+    skc_path = path.splitext(args[0])[0] + '.skc'
+    skc_file = open(skc_path, 'wb')
+    skc.dump(proc, skc_file)
+    skc_file.close()
+    print "Compiled to %s" % skc_path
     print "Disasm run:\n%s\n" % str(proc.disasm())
@@ -0,0 +1,3 @@
+# The version of skime, part of the key of the compiled code cache
+# (see cache.py)
+__version__ = '0.1'
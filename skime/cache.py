@@ -0,0 +1,198 @@
+# The compiled code caches of the VM: FormCache of VM.eval_string, in
+# memory, and CompileCache of VM.load, on disk.
+#
+# The forms of eval_string are kept by source text and environment, and
+# run again as they are. Their code checks the globals it was compiled
+# for at run time (see Guard), except for the macros it expanded: the
+# cache is cleared whenever a macro of the global environment is
+# defined, see VM.macros_changed. Forms with quoted lists among their
+# literals aren't kept, since running them again would reuse the lists,
+# as changed by set-car! or set-cdr! on the previous run (strings are
+# Python strings, which can't be changed).
+#
+# The form compiled from a source file is written in the .skc format
+# (see skc.py) to a __skcache__ directory next to the source, or to a
+# directory given to the VM, and loaded from there by the next load of
+# the same source, which then skips the parser and the compiler.
+#
+# A cache file starts with the key of what the form was compiled from:
+# the content of the source, the version of skime and of the .skc
+# format, and the global environment it was compiled in (see
+# CompileCache.key). The global environment is part of the key because
+# the compiler depends on it: the bytecode refers to the globals by
+# index, calls of primitives and small procedures are inlined and
+# macros are expanded. A file whose key doesn't match is compiled and
+# written again.
+
+import os
+import tempfile
+from hashlib        import md5
+from collections    import OrderedDict
+
+from .              import __version__
+from .              import skc
+from .macro         import Macro, DynamicClosure
+from .types.pair    import Pair
+from .compiler.compiler import Folded
+from .errors        import SerializeError
+
+# The directory of the cache files next to the sources
+CACHE_DIR = '__skcache__'
+
+# The default number of forms kept by FormCache
+FORM_CACHE_SIZE = 256
+
+class FormCache(object):
+    """\
+    The last capacity forms compiled by VM.eval_string, by source text
+    and environment. hits and misses count the lookups that found a form
+    and those that didn't. version is incremented by each invalidate, a
+    form compiled meanwhile (e.g. one defining the macro) isn't kept.
+    """
+    def __init__(self, capacity=FORM_CACHE_SIZE):
+        self.capacity = capacity
+        self.forms = OrderedDict()
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, script, env):
+        "Return the form of script compiled in env, or None."
+        form = self.forms.pop((script, env), None)
+        if form is None:
+            self.misses += 1
+            return None
+        # the most recently used form goes last
+        self.forms[(script, env)] = form
+        self.hits += 1
+        return form
+
+    def put(self, script, env, form, version):
+        """\
+        Keep the form of script compiled in env, unless the cache was
+        invalidated since version or the form has mutable literals. The
+        least recently used form is dropped if the cache is full.
+        """
+        if version != self.version or self.capacity <= 0 or \
+               mutable_literals(form):
+            return
+        self.forms[(script, env)] = form
+        if len(self.forms) > self.capacity:
+            self.forms.popitem(last=False)
+
+    def invalidate(self):
+        "Drop all the forms."
+        self.forms.clear()
+        self.version += 1
+
+def mutable_literals(form):
+    """\
+    Whether the literals of the unit of form (see skc.py) include quoted
+    lists, which the program can change in place. The procedures of the
+    unit share the pool of the form they are nested in, the forms of
+    macro expansions have their own.
+    """
+    pools = [form.literals]
+    seen = set()
+    while pools:
+        literals = pools.pop()
+        if id(literals) in seen:
+            continue
+        seen.add(id(literals))
+        for lit in literals:
+            if isinstance(lit, Folded):
+                lit = lit.value
+            if isinstance(lit, Pair):
+                return True
+            if isinstance(lit, DynamicClosure) and lit.form is not None:
+                pools.append(lit.form.literals)
+    return False
+
+class CompileCache(object):
+    """\
+    Cache files of the forms compiled by VM.load. hits and misses count
+    the loads that found a valid cache file and those that didn't.
+    """
+    def __init__(self, directory=None):
+        # None for a CACHE_DIR next to each source
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, source):
+        "Return the path of the cache file of the source file."
+        source = os.path.abspath(source)
+        name = os.path.basename(source)
+        if self.directory is None:
+            return os.path.join(os.path.dirname(source), CACHE_DIR, name + '.skc')
+        # sources of different directories may have the same name
+        return os.path.join(self.directory,
+                            '%s.%s.skc' % (name, md5(source).hexdigest()[:16]))
+
+    def key(self, content, genv):
+        """\
+        Return the key of the form compiled from content in the global
+        environment genv. Only what the compiler depends on is part of
+        it, not the values of the variables.
+        """
+        key = md5()
+        key.update(repr((__version__, skc.VERSION, skc.ISET_DIGEST)))
+        for name, value in zip(genv.scope.names, genv.locals):
+            if isinstance(value, Macro):
+                value = ('Macro', str(value.body))
+            else:
+                value = skc.signature(value)
+            key.update(repr((name, value)))
+        key.update(content)
+        return key.hexdigest()
+
+    def load(self, vm, source, key):
+        "Return the form of source cached with key, or None."
+        try:
+            io = open(self.path(source), 'rb')
+            try:
+                data = io.read()
+            finally:
+                io.close()
+        except IOError:
+            data = ''
+        if data[:len(key)] == key:
+            try:
+                form = skc.loads(data[len(key):], vm)
+                self.hits += 1
+                return form
+            except SerializeError:
+                pass
+        self.misses += 1
+        return None
+
+    def store(self, source, key, form):
+        """\
+        Write the form compiled from source with its key, before it is
+        run. The file is replaced at once, so that VMs of other
+        processes never read it half written. Sources whose form can't
+        be written out, or whose cache directory can't be written to,
+        are just not cached.
+        """
+        try:
+            data = skc.dumps(form)
+        except SerializeError:
+            return
+        path = self.path(source)
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        except (IOError, OSError):
+            return
+        try:
+            io = os.fdopen(fd, 'wb')
+            try:
+                io.write(key + data)
+            finally:
+                io.close()
+            # mkstemp creates files only readable by their owner
+            os.chmod(tmp, 0644)
+            os.rename(tmp, path)
+        except (IOError, OSError):
+            os.remove(tmp)
@@ -2,10 +2,36 @@ from .errors import WrongArgNumber
 
 class Continuation(object):
     def __init__(self, ctx, ip_displacement, n_pop):
-        self.ctx = ctx.clone()
+        # the context and its callers can be resumed any time now
+        c = ctx
+        while c is not None and not c.captured:
+            c.captured = True
+            c = c.parent
+
+        # The callers go on running after the continuation is made, so
+        # their ip are saved in copies
+        self.ctx = clone_chain(ctx)
         self.ctx.ip += ip_displacement
-        if n_pop > 0:
-            self.ctx.pop_n(n_pop)
+        # The frames of the context and its parents live on the
+        # shared stack, which is saved without the n_pop values on
+        # top and restored when the continuation is called
+        self.stack = ctx.stack[:len(ctx.stack)-n_pop]
+
+    def resume(self):
+        """\
+        Return the contexts to run when the continuation is called. It
+        may be called more than once, so they are copies too.
+        """
+        return clone_chain(self.ctx)
 
     def __str__(self):
         return '<Continuation ctx=%s>' % self.ctx
+
+def clone_chain(ctx):
+    "Clone ctx and its callers."
+    ctx = ctx.clone()
+    c = ctx
+    while c.parent is not None:
+        c.parent = c.parent.clone()
+        c = c.parent
+    return ctx
@@ -1,10 +1,20 @@
 from array    import array
 
-from ..iset   import INSN_MAP
+from types    import NoneType
+
+from ..iset   import INSN_MAP, encode
 from ..form   import Form
 from ..proc   import Procedure
 from ..env    import Environment
 from ..errors import UnboundVariable
+from .peephole import optimize
+from .freevars import DIRECT_CALLS
+from ..types.symbol import Symbol
+
+# Types of the literals that are shared by all the equal values of the
+# same type, see Builder.get_literal_idx. Other literals, like quoted
+# lists, are only shared with themselves.
+HASHED_LITERALS = (int, long, float, complex, bool, str, unicode, NoneType, Symbol)
 
 class Builder(object):
     "Builder is a helper of building the bytecode for a form."
@@ -17,12 +27,16 @@ class Builder(object):
 
         # Instructions stream
         self.stream = []
-        # Program counter (instruction pointer)
-        self.ip = 0
-        # Maps label names to instruction pointers
+        # Maps label names to instruction pointers, which are only
+        # known once the stream is generated
         self.labels = {}
         # Literals list
         self.literals = []
+        # Index of every literal in self.literals, by key (see
+        # get_literal_idx)
+        self.literal_idx = {}
+        # The generated form or procedure
+        self.result = None
 
     def emit(self, insn_name, *args):
         """
@@ -53,10 +67,10 @@ class Builder(object):
         # instructions arguments count
         #
         # if it isn't so, raise
-        if insn.length != 1+len(args):
+        if len(insn.operands) != len(args):
             raise TypeError, \
                   "INSTRUCTION %s expects %d parameters, but %d given" % \
-                  (insn_name, insn.length-1, len(args))
+                  (insn_name, len(insn.operands), len(args))
 
         # pick more specific push_* instruction
         # based on argument type
@@ -82,18 +96,40 @@ class Builder(object):
 
         # append emitted instruction to the stream
         self.stream.append((insn_name, args))
-        # increment instruction pointer
-        self.ip += len(args)+1
 
     def def_local(self, name):
         "Define a local variable."
         return self.env.alloc_local(name)
 
+    def bind_local(self, name):
+        """\
+        Allocate a new local variable shadowing the variable of the same
+        name (if any) until unbind_local is called. Used to compile the
+        bindings of a let into the environment of the procedure. Return
+        the index of the variable and the index it shadows.
+        """
+        scope = self.env.scope
+        shadowed = scope.map.get(name)
+        idx = self.env.alloc_slot(name)
+        scope.map[name] = idx
+        return idx, shadowed
+
+    def unbind_local(self, name, shadowed):
+        "End the scope of a variable allocated by bind_local."
+        if shadowed is None:
+            del self.env.scope.map[name]
+        else:
+            self.env.scope.map[name] = shadowed
+
     def def_label(self, name):
-        "Define a label at current ip."
-        if self.labels.get(name) is not None:
+        """\
+        Define a label at the current position of the stream. Labels
+        are kept in the stream as 'label' pseudo instructions.
+        """
+        if name in self.labels:
             raise TypeError, "Duplicated label: %s" % name
-        self.labels[name] = self.ip
+        self.labels[name] = None
+        self.stream.append(('label', name))
 
     def emit_local(self, action, name, dyn_env=None):
         """\
@@ -115,6 +151,13 @@ class Builder(object):
         # no nesting means variable is undefined
         if depth is None:
             raise UnboundVariable(name, "Unbound variable %s" % name)
+        if self.is_global(env, depth):
+            # variables of the global environment are accessed
+            # directly, without walking the environments chain
+            if dyn:
+                self.emit('pop') # the SymbolClosure
+            self.emit('%s_global' % action, idx)
+            return
         if depth == 0:
             postfix = ''
             args = (idx,)
@@ -145,55 +188,102 @@ class Builder(object):
         # to construct the procedure later
         bdr.args = args
         bdr.rest_arg = rest_arg
+        # The procedures built by a builder share its literals
+        bdr.literals = self.literals
+        bdr.literal_idx = self.literal_idx
+        # The arguments and body of a procedure whose calls can be
+        # inlined, see Compiler.inlinable
+        bdr.inline = None
 
         # generate_proc is a pseudo instruction
         self.stream.append(('generate_proc', bdr))
-        self.ip += 3 # push_literal + fix_lexical (2+1)
-        
+
         return bdr
 
     def generate(self):
         """\
         Generate a form with emitted instructions.
 
-        Real instruction results in an optcode followed
-        by instruction arguments. Arguments vary depending
-        on instruction type but not much. There are 3
-        different cases:
+        The stream is first rewritten by the peephole optimizer,
+        which e.g. replaces common sequences of instructions by
+        superinstructions (see peephole.py).
 
-        1. goto* instructions that need a position argument
-        2. push_literal instruction needs a literal index in literals list
-        3. the rest of instructions needs list of arguments "as given"
+        Each instruction is encoded as a single word of the bytecode,
+        holding its opcode and its operands, preceded by extended_arg
+        words when its operands are too large for it (see encode in
+        iset.py). Operands vary depending on operand type but not much.
+        There are 3 different cases:
 
-        since bytecode is a stream of integers, labels used by goto*
-        are replaced by actual ip positions.
+        1. ip operands (of goto* etc.) that need a position argument
+        2. literal operands need a literal index in literals list
+        3. the rest of operands are given "as is"
+
+        Labels used by goto* are replaced by actual ip positions. As the
+        number of extended_arg words of a jump depends on the position
+        it jumps to, the positions of the labels are computed until
+        they don't change.
 
         This function returns an instance of Form or Procedure but
         may return any other object that has attached bytecode.
         """
-        # bc is for bytecodes
-        bc = array('i')
+        self.stream = optimize(self.stream)
+
+        # the instructions with their operands, once the literals are
+        # resolved; the literals of nested procedures are added first
+        insns = []
         for insn_name, args in self.stream:
-            # pseudo instructions
+            if insn_name == 'label':
+                insns.append((None, args))
+                continue
             if insn_name == 'generate_proc':
-                idx = len(self.literals)
-                self.literals.append(args.generate())
-                bc.append(INSN_MAP['push_literal'].opcode)
-                bc.append(idx)
-            # real instructions
-            else:
-                insn = INSN_MAP[insn_name]
-                bc.append(insn.opcode)
-                
-                if insn_name in ['goto', 'goto_if_false', 'goto_if_not_false']:
-                    bc.append(self.labels[args[0]])
-                elif insn_name == 'push_literal':
-                    bc.append(self.get_literal_idx(args[0]))
+                insn_name, args = 'push_literal', (args.generate(),)
+            elif insn_name in DIRECT_CALLS.values():
+                # the literal is the builder of the procedure called
+                args[0].generate()
+            insn = INSN_MAP[insn_name]
+            operands = []
+            for name, x in zip(insn.operands, args):
+                if name == 'literal':
+                    operands.append(self.get_literal_idx(x))
                 else:
-                    for x in args:
-                        bc.append(x)
+                    operands.append(x)
+            insns.append((insn, operands))
 
-        return self.result_t(self, bc)
+        # resolve labels
+        self.labels = dict([(label, 0) for insn, label in insns if insn is None])
+        while True:
+            words = []
+            positions = {}
+            for insn, operands in insns:
+                if insn is None:
+                    positions[operands] = len(words)
+                else:
+                    words.extend(encode(insn, self.resolve(insn, operands)))
+            if positions == self.labels:
+                break
+            self.labels = positions
+
+        # bc is for bytecodes
+        self.result = self.result_t(self, array('i', words))
+        return self.result
+
+    def link(self):
+        """\
+        Replace the builders among the literals of the generated form,
+        and of the procedures nested in it, by their generated result.
+        A builder is used as the literal of an instruction referring to
+        a procedure that is not generated yet, e.g. a recursive call
+        (see Compiler.known_procedure).
+        """
+        for i, lit in enumerate(self.literals):
+            if isinstance(lit, Builder):
+                self.literals[i] = lit.result
+                self.result.literals[i] = lit.result
+        for insn_name, args in self.stream:
+            if insn_name == 'generate_proc':
+                args.link()
+            elif insn_name in DIRECT_CALLS.values():
+                args[0].link()
 
         
     ########################################
@@ -213,17 +303,35 @@ class Builder(object):
             env = env.parent
         return (None, None)
 
+    def is_global(self, env, depth):
+        """\
+        Whether the environment depth levels up from env is the global
+        environment of the VM.
+        """
+        while depth > 0:
+            env = env.parent
+            depth -= 1
+        return env.vm is not None and env is env.vm.env
+
+    def resolve(self, insn, operands):
+        "Return the operands of an instruction with its labels resolved."
+        return [self.labels[x] if name == 'ip' else x
+                for name, x in zip(insn.operands, operands)]
+
     def get_literal_idx(self, lit):
         """\
         Return the index in literals list if there. Or else append
         the literal to the literals list.
         """
-        for i in range(len(self.literals)):
+        if type(lit) in HASHED_LITERALS:
             # make sure type is the same so that 42 and 42.0 will be
             # different literals
-            l = self.literals[i]
-            if type(l) is type(lit) and \
-               l == lit:
-                return i
-        self.literals.append(lit)
-        return len(self.literals)-1
+            key = (type(lit), lit)
+        else:
+            key = id(lit)
+        idx = self.literal_idx.get(key)
+        if idx is None:
+            idx = len(self.literals)
+            self.literals.append(lit)
+            self.literal_idx[key] = idx
+        return idx
@@ -4,11 +4,85 @@ from ..types.symbol import Symbol as sym
 from ..types.pair   import Pair as pair
 from ..macro        import Macro, DynamicClosure, SymbolClosure
 from ..form         import Form
+from ..proc         import Procedure
+from ..prim         import PyPrimitive, prim_list
+from ..prim         import plus, minus, equal, less
+from ..prim         import prim_first, prim_rest, prim_pair, prim_null_p
 
 from ..errors       import CompileError
 from ..errors       import SyntaxError
+from ..errors       import WrongArgNumber
 
 from .builder       import Builder
+from .freevars      import convert_closures
+
+# Primitives of load_primitives (by Python function and number of
+# arguments) whose calls are compiled into an instruction of their own,
+# see Compiler.inline_primitive
+INLINE_PRIMITIVES = {
+    (plus, 2)        : 'add2',
+    (minus, 2)       : 'sub2',
+    (equal, 2)       : 'numeq2',
+    (less, 2)        : 'lt2',
+    (prim_first, 1)  : 'car',
+    (prim_rest, 1)   : 'cdr',
+    (prim_pair, 2)   : 'cons',
+    (prim_null_p, 1) : 'nullp'
+    }
+
+# Special forms creating procedures or variables, whose use prevents
+# the bindings of a let from being compiled into the enclosing frame,
+# see Compiler.can_inline_let
+SCOPE_FORMS = ('lambda', 'define', 'define-syntax')
+
+# Maximum number of atoms in the body of a procedure whose calls are
+# inlined, see Compiler.inlinable
+INLINE_SIZE = 12
+
+# Marks an expression whose value isn't known at compile time, see
+# Compiler.constant_value
+UNKNOWN = object()
+
+# Types of the values a call can be folded into: a folded value is
+# shared by every run of the code.
+CONSTANT_TYPES = (int, long, float, complex, bool, str, unicode, NoneType, sym)
+
+class Guard(object):
+    """\
+    Globals whose values code was compiled for: guards are the indexes
+    of the globals and their values at compile time, checked again at
+    run time each time a global was assigned.
+    """
+    def __init__(self, guards, version):
+        self.guards = guards
+        # Version of the global environment the guards were last
+        # checked at, see Environment.version
+        self.version = version
+
+    def check(self, genv):
+        "Check whether the globals still have their values."
+        for idx, value in self.guards:
+            if genv.locals[idx] is not value:
+                return False
+        self.version = genv.version
+        return True
+
+    def __str__(self):
+        return "<guard %s>" % ' '.join([str(idx) for idx, value in self.guards])
+
+class Folded(Guard):
+    """\
+    The value of a call of pure primitives on constants, computed at
+    compile time (see Compiler.fold_call). The guards are the globals
+    called and the primitives they were bound to, checked again by
+    push_folded.
+    """
+    def __init__(self, value, guards, version):
+        Guard.__init__(self, guards, version)
+        self.value = value
+
+    def __str__(self):
+        return "<folded %s>" % self.value
 
 class Compiler(object):
     """\
@@ -35,13 +109,30 @@ class Compiler(object):
 
     def __init__(self):
         self.label_seed = 0
+        # Builders of the global procedures defined by the unit being
+        # compiled, by name. See known_procedure.
+        self.known = {}
+        # Builders generated for the unit being compiled, which may
+        # refer to the builders in self.known, see Builder.link
+        self.generated = []
+        # Loops being generated, by name: the label of their start and
+        # the indexes of their variables. See generate_loop.
+        self.loops = {}
+        # Procedures whose body is being inlined, see generate_inlined
+        self.inlining = []
 
     def compile(self, sexp, env):
         bdr = Builder(env)
+        self.known = {}
+        self.loops = {}
+        self.generated = [bdr]
 
         self.generate_expr(bdr, sexp, keep=True, tail=False)
+        convert_closures(bdr)
 
         form = bdr.generate()
+        for generated in self.generated:
+            generated.link()
         return form
 
     ########################################
@@ -74,6 +165,288 @@ class Compiler(object):
                 return True
         return False
 
+    def global_idx(self, bdr, name):
+        """\
+        Return the index of the variable name in the global environment
+        of the VM if that's where name refers to from bdr, or else None.
+        """
+        env = bdr.env
+        while env is not None:
+            idx = env.find_local(name)
+            if idx is not None:
+                break
+            env = env.parent
+        if env is None or env.vm is None or env is not env.vm.env:
+            return None
+        return idx
+
+    def inline_primitive(self, bdr, name, argc):
+        """\
+        If a call of the global name with argc arguments can be compiled
+        into the instruction of a primitive (see INLINE_PRIMITIVES),
+        return the instruction, the index of the global and the
+        primitive, or else None. The instruction checks that the global
+        is still bound to the primitive at run time.
+        """
+        if name in self.known:
+            return None
+        idx = self.global_idx(bdr, name)
+        if idx is None:
+            return None
+        prim = bdr.env.vm.env.read_local(idx)
+        if not isinstance(prim, PyPrimitive):
+            return None
+        insn = INLINE_PRIMITIVES.get((prim.proc, argc))
+        if insn is None:
+            return None
+        return (insn, idx, prim)
+
+    def literal_value(self, expr):
+        "Return the value of a self-evaluating or quoted expr, or else UNKNOWN."
+        if self.self_evaluating(expr):
+            return expr
+        if isinstance(expr, pair) and expr.first == Compiler.sym_quote and \
+               isinstance(expr.rest, pair) and expr.rest.rest is None:
+            return expr.rest.first
+        return UNKNOWN
+
+    def constant_value(self, bdr, expr, guards):
+        """\
+        Return the value of expr if it is a constant or a call of a pure
+        primitive (see PyPrimitive) of the global environment with
+        constant arguments, or else UNKNOWN. The globals called are
+        appended to guards.
+        """
+        value = self.literal_value(expr)
+        if value is not UNKNOWN or not isinstance(expr, pair) or \
+               not isinstance(expr.first, sym) or expr.first.name in self.known or \
+               expr.first.name in self.loops:
+            return value
+        idx = self.global_idx(bdr, expr.first.name)
+        if idx is None:
+            return UNKNOWN
+        prim = bdr.env.vm.env.read_local(idx)
+        if not isinstance(prim, PyPrimitive) or not prim.pure:
+            return UNKNOWN
+
+        args = []
+        arg = expr.rest
+        while isinstance(arg, pair):
+            value = self.constant_value(bdr, arg.first, guards)
+            if value is UNKNOWN:
+                return UNKNOWN
+            args.append(value)
+            arg = arg.rest
+        if arg is not None:
+            return UNKNOWN
+        try:
+            prim.check_arity(len(args))
+            value = prim.call(bdr.env.vm, *args)
+        except Exception:
+            # the error is raised when the code runs
+            return UNKNOWN
+        if not isinstance(value, CONSTANT_TYPES):
+            return UNKNOWN
+        guards.append((idx, prim))
+        return value
+
+    def fold_call(self, bdr, expr):
+        """\
+        If expr is a call of pure primitives on constants only, return
+        a Folded holding its value, or else None.
+        """
+        guards = []
+        value = self.constant_value(bdr, expr, guards)
+        if value is UNKNOWN:
+            return None
+        return Folded(value, guards, bdr.env.vm.env.version)
+
+    def can_inline_let(self, bdr, exprs):
+        """\
+        Whether the variables of a let, let* or letrec whose values and
+        body are exprs can be compiled into the frame of the procedure
+        built by bdr (see generate_inline_let). They can't if the
+        expressions may create a procedure that captures them, or a
+        variable of the procedure, or use a macro. A named let is only
+        allowed if it is compiled into a loop (see generate_loop).
+        """
+        if bdr.result_t is not Procedure:
+            return False
+        exprs = list(exprs)
+        while exprs:
+            expr = exprs.pop()
+            if isinstance(expr, (DynamicClosure, SymbolClosure)):
+                return False
+            if not isinstance(expr, pair) or expr.first == Compiler.sym_quote:
+                continue
+            head = expr.first
+            if isinstance(head, sym) and \
+                   (head.name in SCOPE_FORMS or self.get_macro(bdr.env, head)):
+                return False
+            if head == Compiler.sym_let and isinstance(expr.rest, pair) and \
+                   isinstance(expr.rest.first, sym):
+                name, params, inits, body = self.parse_named_let(expr.rest)
+                if not self.is_loop(name, params, body):
+                    return False
+            while isinstance(expr, pair):
+                exprs.append(expr.first)
+                expr = expr.rest
+        return True
+
+    def is_loop(self, name, params, body):
+        """\
+        Whether the procedure name taking params, with body as its body,
+        is only called by itself in tail position, so that it can be
+        compiled into a loop, see generate_loop.
+        """
+        if name in params:
+            return False
+        return self.only_tail_calls(name, len(params),
+                                    pair(Compiler.sym_begin, body), True)
+
+    def only_tail_calls(self, name, argc, expr, tail):
+        """\
+        Whether the variable name only occurs in expr as the procedure
+        of calls with argc arguments in tail position, tail telling
+        whether expr itself is in tail position. Other uses of name,
+        including its bindings, make it false.
+        """
+        if isinstance(expr, sym):
+            return expr.name != name
+        if not isinstance(expr, pair) or expr.first == Compiler.sym_quote:
+            return True
+        head = expr.first
+        elements = []
+        rest = expr.rest
+        while isinstance(rest, pair):
+            elements.append(rest.first)
+            rest = rest.rest
+        if rest is not None:
+            return False
+
+        def seq(exprs, tail):
+            for i, x in enumerate(exprs):
+                if not self.only_tail_calls(name, argc, x, tail and i == len(exprs)-1):
+                    return False
+            return True
+
+        if head == Compiler.sym_if:
+            return seq(elements[:1], False) and seq(elements[1:2], tail) and \
+                   seq(elements[2:3], tail) and len(elements) <= 3
+        if head in (Compiler.sym_begin, Compiler.sym_and, Compiler.sym_or):
+            return seq(elements, tail)
+        if head in (Compiler.sym_let, Compiler.sym_letstar, Compiler.sym_letrec) and \
+               elements and not isinstance(elements[0], sym):
+            # the bindings are checked like expressions, so that
+            # binding name makes it false
+            return seq(elements[:1], False) and seq(elements[1:], tail)
+        if head == Compiler.sym_cond:
+            for clause in elements:
+                if not isinstance(clause, pair):
+                    return False
+                clause = self.elements(clause, 'cond')
+                if clause[1:2] == [sym('=>')]:
+                    if not seq(clause, False):
+                        return False
+                elif not (seq(clause[:1], False) and seq(clause[1:], tail)):
+                    return False
+            return True
+        if isinstance(head, sym) and head.name == name:
+            return tail and len(elements) == argc and seq(elements, False)
+        return seq([head] + elements, False)
+
+    def atoms(self, expr):
+        "Return the atoms of expr, a quoted expression counting as one."
+        atoms = []
+        exprs = [expr]
+        while exprs:
+            expr = exprs.pop()
+            if not isinstance(expr, pair) or expr.first == Compiler.sym_quote:
+                atoms.append(expr)
+                continue
+            while isinstance(expr, pair):
+                exprs.append(expr.first)
+                expr = expr.rest
+            if expr is not None:
+                atoms.append(expr)
+        return atoms
+
+    def inlinable(self, bdr, name, args, rest_arg, body):
+        """\
+        If the calls of the procedure defined as name in the global
+        environment by bdr, with args and body, can be inlined, return
+        args and body, or else None. The body must be small (see
+        INLINE_SIZE) and not call the procedure itself.
+        """
+        if rest_arg or bdr.env.vm is None or bdr.env is not bdr.env.vm.env:
+            return None
+        atoms = self.atoms(body)
+        if len(atoms) > INLINE_SIZE or sym(name) in atoms:
+            return None
+        return (list(args), body)
+
+    def can_inline_call(self, bdr, proc, args):
+        """\
+        Whether the call of the procedure proc known at compile time
+        (see known_procedure) on args can be inlined. The body of proc
+        is compiled in place of the call, like a let binding its
+        arguments (see can_inline_let), so the other variables it uses
+        must be globals at the call site too.
+        """
+        if not isinstance(proc, Procedure) or proc.inline is None or \
+               proc in self.inlining:
+            return False
+        genv = bdr.env.vm.env
+        params, body = proc.inline
+        if proc.lexical_parent is not genv or \
+               not self.can_inline_let(bdr, args + [body]):
+            return False
+        for atom in self.atoms(body):
+            if not isinstance(atom, sym) or atom.name in params:
+                continue
+            if atom.name in self.loops:
+                return False
+            loc = bdr.env.lookup_location(atom.name)
+            if loc is not None and loc.env is not genv:
+                return False
+        return True
+
+    def known_procedure(self, bdr, name, argc):
+        """\
+        If a call of the global name with argc arguments goes to a
+        procedure known at compile time, return the index of the global
+        and the procedure, or else None. The procedure is either the
+        Procedure the global is bound to, or the builder of a procedure
+        the unit binds it to with define. Since globals can be
+        redefined, call_known checks that the global is still bound to
+        the procedure at run time.
+        """
+        idx = self.global_idx(bdr, name)
+        if idx is None:
+            return None
+        env = bdr.env.vm.env
+
+        known = self.known.get(name)
+        if known is not None and known[0] is env:
+            builder = known[1]
+            fixed_argc = len(builder.args)
+            if builder.rest_arg:
+                fixed_argc -= 1
+                if argc < fixed_argc:
+                    return None
+            elif argc != fixed_argc:
+                return None
+            return (idx, builder)
+
+        proc = env.read_local(idx)
+        if not isinstance(proc, Procedure):
+            return None
+        try:
+            proc.check_arity(argc)
+        except WrongArgNumber:
+            return None
+        return (idx, proc)
+
     def next_label(self):
         """
         Returns next label name. Label
@@ -140,7 +513,6 @@ class Compiler(object):
             if routine is not None:
                 routine(bdr, expr.rest, keep=keep, tail=tail)
             else:
-                argc = 0
                 macro = self.get_macro(bdr.env, expr.first)
                 transform_env = bdr.env
                 if macro is not None:
@@ -148,9 +520,11 @@ class Compiler(object):
 
                     transform_env = macro.lexical_parent
                     form_bdr = Builder(transform_env)
-                    self.generate_expr(form_bdr, expr, keep=True, tail=False)
+                    # the form returns to the dynamic_eval running it
+                    self.generate_expr(form_bdr, expr, keep=True, tail=True)
                     macro_closure = DynamicClosure(transform_env, expr)
                     macro_closure.form = form_bdr.generate()
+                    self.generated.append(form_bdr)
                     bdr.emit('push_literal', macro_closure)
 
                     dist = self.calc_env_distance(macro.lexical_parent, bdr.env)
@@ -164,8 +538,9 @@ class Compiler(object):
                         bdr.emit('push_literal', dc)
                         bdr.emit('fix_lexical_pop')
                         form_bdr = Builder(bdr.env)
-                        self.generate_expr(form_bdr, dc.expression, keep=True, tail=False)
+                        self.generate_expr(form_bdr, dc.expression, keep=True, tail=True)
                         dc.form = form_bdr.generate()
+                        self.generated.append(form_bdr)
 
                     bdr.emit('dynamic_eval')
                     if not keep:
@@ -174,19 +549,13 @@ class Compiler(object):
                         bdr.emit('ret')
 
                 else:
-                    arg  = expr.rest
-                    while isinstance(arg, pair):
-                        self.generate_expr(bdr, arg.first, keep=True, tail=False)
-                        arg = arg.rest
-                        argc += 1
-                    self.generate_expr(bdr, expr.first, keep=True, tail=False)
-
-                    if tail:
-                        bdr.emit('tail_call', argc)
+                    folded = None
+                    if keep:
+                        folded = self.fold_call(bdr, expr)
+                    if folded is not None:
+                        self.generate_folded(bdr, expr, folded, tail)
                     else:
-                        bdr.emit('call', argc)
-                        if not keep:
-                            bdr.emit('pop')
+                        self.generate_call(bdr, expr, keep, tail)
 
         elif isinstance(expr, DynamicClosure):
             bdr.emit('push_literal', expr)
@@ -199,6 +568,94 @@ class Compiler(object):
         else:
             raise CompileError("Expecting atom or list, but got %s" % expr)
 
+    def generate_call(self, bdr, expr, keep=True, tail=False):
+        "Generate a procedure call."
+        if isinstance(expr.first, sym) and expr.first.name in self.loops:
+            self.generate_loop_call(bdr, expr)
+            return
+
+        args = []
+        arg  = expr.rest
+        while isinstance(arg, pair):
+            self.generate_expr(bdr, arg.first, keep=True, tail=False)
+            args.append(arg.first)
+            arg = arg.rest
+        argc = len(args)
+
+        inline = known = None
+        if isinstance(expr.first, sym):
+            inline = self.inline_primitive(bdr, expr.first.name, argc)
+            if inline is None:
+                known = self.known_procedure(bdr, expr.first.name, argc)
+
+        if inline is not None:
+            bdr.emit(*inline)
+            if tail:
+                bdr.emit('ret')
+            elif not keep:
+                bdr.emit('pop')
+            return
+
+        if known is not None and tail and known[1] is bdr:
+            # the procedure calls itself, see tail_call_self
+            bdr.emit('tail_call_self', known[0], argc)
+            return
+        lbl_end = None
+        if known is not None and self.can_inline_call(bdr, known[1], args):
+            lbl_end = self.generate_inlined(bdr, known, keep, tail)
+        if known is not None:
+            call = 'call_known'
+            call_args = (known[0], argc, known[1])
+        else:
+            self.generate_expr(bdr, expr.first, keep=True, tail=False)
+            call = 'call'
+            call_args = (argc,)
+
+        if tail:
+            bdr.emit('tail_' + call, *call_args)
+        else:
+            bdr.emit(call, *call_args)
+            if not keep:
+                bdr.emit('pop')
+        if lbl_end is not None:
+            bdr.def_label(lbl_end)
+
+    def generate_inlined(self, bdr, known, keep=True, tail=False):
+        """\
+        Generate the body of a procedure known at compile time in place
+        of its call, with the arguments on the stack (see
+        can_inline_call). guard_inlined jumps over it to the call if
+        the global was rebound. Return the label following the call.
+        """
+        idx, proc = known
+        params, body = proc.inline
+        lbl_call = self.next_label()
+        lbl_end = self.next_label()
+        bdr.emit('guard_inlined', Guard([known], bdr.env.vm.env.version), lbl_call)
+        bound = [(param,) + bdr.bind_local(param) for param in params]
+        for param, idx, shadowed in reversed(bound):
+            bdr.emit('set_local', idx)
+        self.inlining.append(proc)
+        self.generate_inline_body(bdr, bound, body, keep, tail)
+        self.inlining.pop()
+        if not tail:
+            bdr.emit('goto', lbl_end)
+        bdr.def_label(lbl_call)
+        return lbl_end
+
+    def generate_folded(self, bdr, expr, folded, tail=False):
+        """\
+        Generate a call folded into a constant: push_folded pushes the
+        value and jumps over the code of the call, which only runs if a
+        primitive called was rebound.
+        """
+        lbl_end = self.next_label()
+        bdr.emit('push_folded', folded, lbl_end)
+        self.generate_call(bdr, expr, keep=True, tail=tail)
+        bdr.def_label(lbl_end)
+        if tail:
+            bdr.emit('ret')
+
     def generate_if_expr(self, bdr, expr, keep=True, tail=False):
         """
         Generates a byte code for the "if" expression.
@@ -286,6 +743,19 @@ class Compiler(object):
                 raise SyntaxError("Extra expression in 'if'")
             expelse = expelse.first
 
+        value = self.literal_value(cond)
+        if value is not UNKNOWN:
+            # only one branch is reachable
+            if value is not False:
+                self.generate_expr(bdr, expthen, keep=keep, tail=tail)
+            elif expelse is not None:
+                self.generate_expr(bdr, expelse, keep=keep, tail=tail)
+            elif keep:
+                bdr.emit('push_nil')
+                if tail:
+                    bdr.emit('ret')
+            return
+
         self.generate_expr(bdr, cond, keep=True, tail=False)
 
         if keep is True:
@@ -326,7 +796,7 @@ class Compiler(object):
             return expr
         raise SyntaxError("Expecting symbol, but got %s" % expr)
 
-    def generate_lambda(self, base_builder, expr, keep=True, tail=False):
+    def generate_lambda(self, base_builder, expr, keep=True, tail=False, name=None):
         if keep is not True:
             return  # lambda expression has no side-effect
         try:
@@ -351,6 +821,11 @@ class Compiler(object):
                 args = [self.filter_sc(arglst).name]
 
             bdr = base_builder.push_proc(args=args, rest_arg=rest_arg)
+            if name is not None:
+                # defined as name, known before the body is compiled
+                # so that recursive calls are known calls
+                self.known[name] = (base_builder.env, bdr)
+                bdr.inline = self.inlinable(base_builder, name, args, rest_arg, body)
             self.generate_body(bdr, body, keep=True, tail=True)
             base_builder.emit("fix_lexical")
 
@@ -367,9 +842,15 @@ class Compiler(object):
                          _||_
                           \/
         ((lambda (var1 var2) expr1 expr2) val1 val2)
+
+        unless the variables can be allocated in the frame of the
+        enclosing procedure, see can_inline_let.
         """
         if not isinstance(expr, pair):
             raise SyntaxError("Invalid let expression")
+        if isinstance(expr.first, sym):
+            self.generate_named_let(bdr, expr, keep=keep, tail=tail)
+            return
         bindings = expr.first
         param = []
         args = []
@@ -389,6 +870,13 @@ class Compiler(object):
         for x in args:
             self.generate_expr(bdr, x, keep=True, tail=False)
 
+        if self.can_inline_let(bdr, args + [expr.rest]):
+            bound = [(name,) + bdr.bind_local(name) for name in param]
+            for name, idx, shadowed in reversed(bound):
+                bdr.emit_local('set', name)
+            self.generate_inline_body(bdr, bound, expr.rest, keep, tail)
+            return
+
         lambda_bdr = bdr.push_proc(args=param, rest_arg=False)
         self.generate_body(lambda_bdr, expr.rest, keep=True, tail=True)
         bdr.emit('fix_lexical')
@@ -401,6 +889,103 @@ class Compiler(object):
             if not keep:
                 bdr.emit('pop')
 
+    def parse_named_let(self, expr):
+        """\
+        Return the name, the names of the variables, the values and the
+        body of the named let expr.
+        """
+        if not isinstance(expr.rest, pair):
+            raise SyntaxError("Invalid named let expression")
+        bindings = expr.rest.first
+        params = []
+        inits = []
+        while isinstance(bindings, pair):
+            binding = bindings.first
+            if not isinstance(binding, pair) or \
+               not isinstance(binding.rest, pair):
+                raise SyntaxError("Invalid binding for let expression: %s" % binding)
+            params.append(self.filter_sc(binding.first).name)
+            inits.append(binding.rest.first)
+            bindings = bindings.rest
+        if bindings is not None:
+            raise SyntaxError("Invalid let expression: expecting bindings, but got %s" % bindings)
+        return expr.first.name, params, inits, expr.rest.rest
+
+    def generate_named_let(self, bdr, expr, keep=True, tail=False):
+        """\
+        (let name ((var1 val1) (var2 val2)) expr1 expr2)
+                          ||
+                         _||_
+                          \/
+        ((letrec ((name (lambda (var1 var2) expr1 expr2))) name) val1 val2)
+
+        unless it can be compiled into a loop, see generate_loop.
+        """
+        name, params, inits, body = self.parse_named_let(expr)
+        if self.generate_loop(bdr, name, params, inits, body, keep, tail):
+            return
+
+        variables = prim_list(None, *[binding.first for binding in
+                                      self.elements(expr.rest.first, 'let')])
+        proc = pair(Compiler.sym_lambda, pair(variables, body))
+        letrec = prim_list(None, Compiler.sym_letrec,
+                           prim_list(None, prim_list(None, expr.first, proc)),
+                           expr.first)
+        self.generate_expr(bdr, pair(letrec, prim_list(None, *inits)),
+                           keep=keep, tail=tail)
+
+    def generate_loop(self, bdr, name, params, inits, body, keep=True, tail=False):
+        """\
+        Generate the call of the procedure name taking params, with body
+        as its body, on inits, as a loop in the frame of bdr: params are
+        allocated like the variables of a let (see can_inline_let) and
+        the calls of name in body jump back to its start after setting
+        them. Return False and generate nothing if it is not a loop (see
+        is_loop) or the variables can't be allocated in the frame.
+        """
+        if not self.is_loop(name, params, body) or \
+               not self.can_inline_let(bdr, inits + [body]):
+            return False
+
+        for x in inits:
+            self.generate_expr(bdr, x, keep=True, tail=False)
+        bound = [(param,) + bdr.bind_local(param) for param in params]
+        for param, idx, shadowed in reversed(bound):
+            bdr.emit('set_local', idx)
+
+        lbl_loop = self.next_label()
+        bdr.def_label(lbl_loop)
+        outer = self.loops.get(name)
+        self.loops[name] = (lbl_loop, [idx for param, idx, shadowed in bound])
+        self.generate_inline_body(bdr, bound, body, keep, tail)
+        if outer is None:
+            del self.loops[name]
+        else:
+            self.loops[name] = outer
+        return True
+
+    def generate_loop_call(self, bdr, expr):
+        "Generate a call of a loop, see generate_loop."
+        lbl_loop, variables = self.loops[expr.first.name]
+        arg = expr.rest
+        while isinstance(arg, pair):
+            self.generate_expr(bdr, arg.first, keep=True, tail=False)
+            arg = arg.rest
+        for idx in reversed(variables):
+            bdr.emit('set_local', idx)
+        bdr.emit('goto', lbl_loop)
+
+    def generate_inline_body(self, bdr, bound, body, keep=True, tail=False):
+        """\
+        Generate the body of a let whose variables were allocated in the
+        frame of bdr (see can_inline_let), then end their scope. bound
+        holds the name of every variable followed by what bind_local
+        returned for it.
+        """
+        self.generate_body(bdr, body, keep=keep, tail=tail)
+        for name, idx, shadowed in reversed(bound):
+            bdr.unbind_local(name, shadowed)
+
     def generate_letrec(self, bdr, expr, keep=True, tail=False):
         if not isinstance(expr, pair):
             raise SyntaxError("Invalid letrec expression")
@@ -408,8 +993,6 @@ class Compiler(object):
         bindings = expr.first
         body = expr.rest
 
-        lambda_bdr = bdr.push_proc()
-
         # letrec will evaluate the init forms in the new env
         names = []
         vals = []
@@ -422,7 +1005,6 @@ class Compiler(object):
                 raise SyntaxError("Invalid binding for letrec expression: %s" % binding)
             name = self.filter_sc(binding.first).name
             val = binding.rest.first
-            lambda_bdr.def_local(name)
 
             names.append(name)
             vals.append(val)
@@ -432,6 +1014,21 @@ class Compiler(object):
         if bindings is not None:
             raise SyntaxError("Invalid bindings for letrec expression: %s" % bindings)
 
+        loop = self.letrec_loop(names, vals, body)
+        if loop is not None and self.generate_loop(bdr, *loop, keep=keep, tail=tail):
+            return
+
+        if self.can_inline_let(bdr, vals + [body]):
+            bound = [(name,) + bdr.bind_local(name) for name in names]
+            for i in range(len(names)):
+                self.generate_expr(bdr, vals[i], keep=True, tail=False)
+                bdr.emit_local('set', names[i])
+            self.generate_inline_body(bdr, bound, body, keep, tail)
+            return
+
+        lambda_bdr = bdr.push_proc()
+        for name in names:
+            lambda_bdr.def_local(name)
         for i in range(len(names)):
             self.generate_expr(lambda_bdr, vals[i], keep=True, tail=False)
             lambda_bdr.emit_local('set', names[i])
@@ -446,6 +1043,38 @@ class Compiler(object):
             if not keep:
                 bdr.emit('pop')
 
+    def letrec_loop(self, names, vals, body):
+        """\
+        If the letrec binding names to vals with body as its body is
+
+          (letrec ((name (lambda (var1 var2) expr1 expr2))) (name val1 val2))
+
+        return the arguments of generate_loop for it, or else None.
+        """
+        if len(names) != 1 or not isinstance(vals[0], pair) or \
+               vals[0].first != Compiler.sym_lambda or \
+               not isinstance(vals[0].rest, pair) or \
+               not isinstance(body, pair) or body.rest is not None or \
+               not isinstance(body.first, pair) or body.first.first != sym(names[0]):
+            return None
+        params = []
+        param = vals[0].rest.first
+        while isinstance(param, pair) and isinstance(param.first, sym):
+            params.append(param.first.name)
+            param = param.rest
+        inits = []
+        arg = body.first.rest
+        while isinstance(arg, pair):
+            inits.append(arg.first)
+            arg = arg.rest
+        if param is not None or arg is not None or len(inits) != len(params):
+            return None
+        # the values are in the scope of name
+        for init in inits:
+            if not self.only_tail_calls(names[0], len(params), init, False):
+                return None
+        return names[0], params, inits, vals[0].rest.rest
+
     def generate_letstar(self, bdr, expr, keep=True, tail=False):
         if not isinstance(expr, pair):
             raise SyntaxError("Invalid letrec expression")
@@ -453,8 +1082,6 @@ class Compiler(object):
         bindings = expr.first
         body = expr.rest
 
-        lambda_bdr = bdr.push_proc()
-
         # let* will evaluate the init forms in the new env sequencially
         names = []
         vals = []
@@ -476,6 +1103,16 @@ class Compiler(object):
         if bindings is not None:
             raise SyntaxError("Invalid bindings for let* expression: %s" % bindings)
 
+        if self.can_inline_let(bdr, vals + [body]):
+            bound = []
+            for i in range(len(names)):
+                self.generate_expr(bdr, vals[i], keep=True, tail=False)
+                bound.append((names[i],) + bdr.bind_local(names[i]))
+                bdr.emit_local('set', names[i])
+            self.generate_inline_body(bdr, bound, body, keep, tail)
+            return
+
+        lambda_bdr = bdr.push_proc()
         for i in range(len(names)):
             lambda_bdr.def_local(names[i])
             self.generate_expr(lambda_bdr, vals[i], keep=True, tail=False)
@@ -518,8 +1155,13 @@ class Compiler(object):
 
         # first define local, then generate value. This allow
         # recursive function to be compiled properly.
-        bdr.def_local(var.name)
-        gen(bdr, val, keep=True, tail=False)
+        idx = bdr.def_local(var.name)
+        if isinstance(bdr.env.read_local(idx), Macro) and bdr.is_global(bdr.env, 0):
+            bdr.env.vm.macros_changed()
+        if gen == self.generate_lambda:
+            gen(bdr, val, keep=True, tail=False, name=var.name)
+        else:
+            gen(bdr, val, keep=True, tail=False)
         if keep is True:
             bdr.emit('dup')
         bdr.emit_local('set', var.name)
@@ -562,58 +1204,71 @@ class Compiler(object):
             if tail:
                 bdr.emit('ret')
 
-    def generate_or(self, bdr, expr, keep=True, tail=False):
-        lbl_end = self.next_label()
-        expr_generated = False
+    def elements(self, expr, name):
+        "Return the elements of the and/or expression expr as a list."
+        elements = []
         while isinstance(expr, pair):
-            el = expr.first
+            elements.append(expr.first)
             expr = expr.rest
-            # 'False' literal in 'or' expression can be silently
-            # ignored
-            if el is not False:
-                expr_generated = True
-                self.generate_expr(bdr, el, keep=True, tail=False)
-                if keep:
-                    bdr.emit('dup')
-                bdr.emit('goto_if_not_false', lbl_end)
-                if keep:
-                    if expr is not None:
-                        bdr.emit('pop')
         if expr is not None:
-            raise SyntaxError("Invalid element in or expression: %s" % expr)
-        if keep:
-            if not expr_generated:
-                bdr.emit('push_false')
-            if tail:
-                bdr.emit('ret')
+            raise SyntaxError("Invalid element in %s expression: %s" % (name, expr))
+        return elements
+
+    def generate_or(self, bdr, expr, keep=True, tail=False):
+        # False constants are left out, and the elements following a
+        # true constant are never evaluated
+        elements = []
+        for el in self.elements(expr, 'or'):
+            value = self.literal_value(el)
+            if value is False:
+                continue
+            elements.append(el)
+            if value is not UNKNOWN:
+                break
+        if not elements:
+            elements = [False]
 
+        lbl_end = self.next_label()
+        for el in elements[:-1]:
+            self.generate_expr(bdr, el, keep=True, tail=False)
+            if keep:
+                bdr.emit('dup')
+            bdr.emit('goto_if_not_false', lbl_end)
+            if keep:
+                bdr.emit('pop')
+        self.generate_expr(bdr, elements[-1], keep=keep, tail=tail)
         bdr.def_label(lbl_end)
+        if tail and len(elements) > 1:
+            bdr.emit('ret')
 
     def generate_and(self, bdr, expr, keep=True, tail=False):
+        # True constants are left out but as the last element, and the
+        # elements following a false constant are never evaluated
+        elements = []
+        for el in self.elements(expr, 'and'):
+            elements.append(el)
+            if self.literal_value(el) is False:
+                break
+        if not elements:
+            elements = [True]
+        tests = [el for el in elements[:-1]
+                 if self.literal_value(el) is UNKNOWN]
+
+        lbl_false = self.next_label()
         lbl_end = self.next_label()
-        expr_generated = False
-        while isinstance(expr, pair):
-            el = expr.first
-            expr = expr.rest
-            # 'True' literal in 'and' expression can be silently
-            # ignored
-            if el is not True:
-                expr_generated = True
-                self.generate_expr(bdr, el, keep=True, tail=False)
-                if keep:
-                    bdr.emit('dup')
-                bdr.emit('goto_if_false', lbl_end)
-                if keep:
-                    if expr is not None:
-                        bdr.emit('pop')
-        if expr is not None:
-            raise SyntaxError("Invalid element in or expression: %s" % expr)
-        if keep:
-            if not expr_generated:
-                bdr.emit('push_true')
+        for el in tests:
+            self.generate_expr(bdr, el, keep=True, tail=False)
+            bdr.emit('goto_if_false', lbl_false)
+        self.generate_expr(bdr, elements[-1], keep=keep, tail=tail)
+        if keep and tests:
+            if not tail:
+                bdr.emit('goto', lbl_end)
+            bdr.def_label(lbl_false)
+            bdr.emit('push_false')
             if tail:
                 bdr.emit('ret')
-
+        else:
+            bdr.def_label(lbl_false)
         bdr.def_label(lbl_end)
 
     def generate_define_syntax(self, bdr, expr, keep=True, tail=False):
@@ -635,6 +1290,8 @@ class Compiler(object):
         idx = bdr.def_local(name.name)
         macro = Macro(bdr.env, expr.first.rest)
         bdr.env.assign_local(idx, macro)
+        if bdr.is_global(bdr.env, 0):
+            bdr.env.vm.macros_changed()
 
         if keep:
             # macro object is generally not available at runtime, the value of
@@ -683,24 +1340,19 @@ class Compiler(object):
         for val in init_vals:
             self.generate_expr(bdr, val, keep=True, tail=False)
 
-        lam_bdr = bdr.push_proc(args=variables, rest_arg=False)
-        lbl_test = self.next_label()
         lbl_end = self.next_label()
+        if self.can_inline_let(bdr, init_vals + [test_expr, result_expr, body] +
+                               [step for step in steps if step is not None]):
+            # the loop runs in the frame of bdr, see can_inline_let
+            bound = [(name,) + bdr.bind_local(name) for name in variables]
+            for name, idx, shadowed in reversed(bound):
+                bdr.emit_local('set', name)
+            self.generate_do_loop(bdr, variables, test_expr, body, steps, lbl_end)
+            self.generate_inline_body(bdr, bound, result_expr, keep, tail)
+            return
 
-        lam_bdr.def_label(lbl_test)
-        self.generate_expr(lam_bdr, test_expr, keep=True, tail=False)
-        lam_bdr.emit('goto_if_not_false', lbl_end)
-        self.generate_body(lam_bdr, body, keep=False, tail=False)
-
-        for i in range(len(steps)):
-            if steps[i] is not None:
-                self.generate_expr(lam_bdr, steps[i], keep=True, tail=False)
-        for i in range(len(steps)-1, -1, -1):
-            if steps[i] is not None:
-                lam_bdr.emit_local('set', variables[i])
-
-        lam_bdr.emit('goto', lbl_test)
-        lam_bdr.def_label(lbl_end)
+        lam_bdr = bdr.push_proc(args=variables, rest_arg=False)
+        self.generate_do_loop(lam_bdr, variables, test_expr, body, steps, lbl_end)
         self.generate_body(lam_bdr, result_expr, keep=True, tail=True)
 
         bdr.emit('fix_lexical')
@@ -712,21 +1364,44 @@ class Compiler(object):
             if not keep:
                 bdr.emit('pop')
 
+    def generate_do_loop(self, bdr, variables, test_expr, body, steps, lbl_end):
+        """\
+        Generate the iterations of a do expression with the variables
+        named variables, jumping to lbl_end when test_expr is true.
+        """
+        lbl_test = self.next_label()
+        bdr.def_label(lbl_test)
+        self.generate_expr(bdr, test_expr, keep=True, tail=False)
+        bdr.emit('goto_if_not_false', lbl_end)
+        self.generate_body(bdr, body, keep=False, tail=False)
+
+        for i in range(len(steps)):
+            if steps[i] is not None:
+                self.generate_expr(bdr, steps[i], keep=True, tail=False)
+        for i in range(len(steps)-1, -1, -1):
+            if steps[i] is not None:
+                bdr.emit_local('set', variables[i])
+
+        bdr.emit('goto', lbl_test)
+        bdr.def_label(lbl_end)
+
     def generate_cond(self, bdr, expr, keep=True, tail=False):
         if not isinstance(expr, pair):
             raise SyntaxError("Empty cond expression")
 
         lbl_end = self.next_label()
-        lbl_next = self.next_label()
-        first = True
+        lbl_next = None
+        # whether the test of the previous clause is left on the stack
+        # when it is false
+        dup = False
 
         while isinstance(expr, pair):
-            bdr.def_label(lbl_next)
+            if lbl_next is not None:
+                bdr.def_label(lbl_next)
+                if dup:
+                    bdr.emit('pop')
             lbl_next = self.next_label()
-
-            if not first:
-                bdr.emit('pop')
-                first = False
+            dup = False
 
             cond_expr = expr.first
             if not isinstance(cond_expr, pair):
@@ -738,7 +1413,8 @@ class Compiler(object):
 
             if pred == sym('else'):
                 if body is None:
-                    bdr.emit('push_true')
+                    # like an empty body
+                    bdr.emit('push_nil')
                 else:
                     if not isinstance(body, pair):
                         raise SyntaxError("Invalid cond clause: %s" % cond_expr)
@@ -750,6 +1426,7 @@ class Compiler(object):
                         bdr.emit('call', 1)
                     else:
                         self.generate_body(bdr, body, keep=True, tail=False)
+                bdr.emit('goto', lbl_end)
                 break
 
             else:
@@ -757,6 +1434,7 @@ class Compiler(object):
                 if body is None:
                     bdr.emit('dup')
                     bdr.emit('goto_if_false', lbl_next)
+                    dup = True
                 else:
                     if not isinstance(body, pair):
                         raise SyntaxError("Invalid cond clause: %s" % cond_expr)
@@ -765,6 +1443,7 @@ class Compiler(object):
                             raise SyntaxError("Invalid cond clause, expecting expression after =>")
                         bdr.emit('dup')
                         bdr.emit('goto_if_false', lbl_next)
+                        dup = True
                         self.generate_expr(bdr, body.rest.first, keep=True, tail=False)
                         bdr.emit('call', 1)
                     else:
@@ -776,6 +1455,8 @@ class Compiler(object):
             raise SyntaxError("Extra garbage expression in cond expression: %s" % expr)
 
         bdr.def_label(lbl_next)
+        if dup:
+            bdr.emit('pop')
         bdr.emit('push_nil')
         bdr.def_label(lbl_end)
 
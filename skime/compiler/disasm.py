@@ -1,4 +1,4 @@
-from ..iset import INSTRUCTIONS
+from ..iset import decode, decode_operands
 
 
 def disasm(io, form):
@@ -6,18 +6,15 @@ def disasm(io, form):
     env = form.env
     literals = form.literals
     
-    ip = 0
-    while ip < len(bytecode):
+    for ip, instr, operands in decode(bytecode):
         io.write("%04X " % ip)
-        instr = INSTRUCTIONS[bytecode[ip]]
         io.write("%20s " % instr.name)
         if instr.name in ['push_local', 'set_local']:
-            io.write('idx: %d' % bytecode[ip+1])
+            io.write('idx: %d' % operands[0])
             io.write(', name: ')
-            io.write(env.get_name(bytecode[ip+1]))
+            io.write(env.get_name(operands[0]))
         elif instr.name in ['push_local_depth', 'set_local_depth']:
-            depth = bytecode[ip+1]
-            idx = bytecode[ip+2]
+            depth, idx = operands
             io.write("depth=%d, idx=%d" % (depth, idx))
             penv = env
             while depth > 0:
@@ -25,16 +22,14 @@ def disasm(io, form):
                 depth -= 1
             io.write(" (name: %s)" % penv.get_name(idx))
         elif instr.name in ['goto', 'goto_if_not_false', 'goto_if_false']:
-            io.write("ip=0x%04X" % bytecode[ip+1])
+            io.write("ip=0x%04X" % operands[0])
         elif instr.name == 'dynamic_set_local':
-            lit = bytecode[ip-1]
-            io.write('idx: %d' % bytecode[ip+1])
+            # the literal of the preceding push_literal
+            lit = decode_operands(bytecode, ip-1)[0]
+            io.write('idx: %d' % operands[0])
             io.write(', name: ')
             io.write(literals[lit].expression.name)
         else:
             io.write(', '.join(["%s=%s" % (name, val)
-                                for name, val in zip(instr.operands,
-                                                     bytecode[ip+1:
-                                                              ip+len(instr.operands)+1])]))
+                                for name, val in zip(instr.operands, operands)]))
         io.write('\n')
-        ip += instr.length
@@ -0,0 +1,169 @@
+# Flat closure conversion.
+#
+# Compiled naively, a procedure reaches the variables of enclosing
+# procedures by walking its environment chain (push_local_depth), and
+# a closure keeps that whole chain alive. This pass runs on the
+# builders of a compilation unit before their bytecode is generated:
+#
+#  * The free variables of every procedure, i.e. the variables of
+#    enclosing procedures it or the procedures nested in it use, get a
+#    slot at the end of its locals.
+#  * Where a procedure with free variables is created, their values
+#    are pushed and make_closure bundles them with the procedure into
+#    a Closure. Calling the closure copies the values into the slots.
+#  * Variables captured by a closure and assigned are boxed when
+#    their procedure is entered (box_local), so that all closures and
+#    the procedure itself share them.
+#  * The environment of every procedure then has the global
+#    environment as parent.
+#  * A procedure called as soon as it is created, like the lambda a
+#    let is compiled into when its variables can't be allocated in
+#    the enclosing frame, never escapes: call_direct calls it with the
+#    values of its free variables without making a closure.
+#
+# Units using macros are left alone: the code of a macro expansion
+# (dynamic_eval) is run in the environment chain of the procedure.
+
+# Instructions of code that relies on the environment chain
+DYNAMIC = ['dynamic_eval', 'dynamic_set_local', 'dynamic_set_local_depth',
+           'fix_lexical_pop', 'fix_lexical_depth']
+
+ACCESSES = ['push_local', 'set_local', 'push_local_depth', 'set_local_depth']
+
+# Calls of the procedure on top of the stack, by the instruction calling
+# a procedure that never escapes
+DIRECT_CALLS = {
+    'call'      : 'call_direct',
+    'tail_call' : 'tail_call_direct'
+    }
+
+def convert_closures(top):
+    "Convert the procedures built in the builder top into flat closures."
+    builders = nested_builders(top)
+    for bdr in builders:
+        for i, (insn, args) in enumerate(bdr.stream):
+            if insn in DYNAMIC:
+                return
+            if insn == 'generate_proc' and \
+               bdr.stream[i+1:i+2] != [('fix_lexical', ())]:
+                return
+
+    proc_envs = set([bdr.env for bdr in builders[1:]])
+    free = {}
+    assigned = set()
+    collect_free(top, proc_envs, free, assigned)
+    boxed = set()
+    for variables in free.values():
+        boxed.update([var for var in variables if var in assigned])
+
+    for bdr in builders:
+        convert_builder(bdr, top, free, boxed)
+    for bdr in builders[1:]:
+        bdr.env.parent = top.env
+
+def nested_builders(bdr):
+    "Return bdr and the builders of the procedures nested in it, outermost first."
+    result = [bdr]
+    for insn, args in bdr.stream:
+        if insn == 'generate_proc':
+            result.extend(nested_builders(args))
+    return result
+
+def variable(bdr, insn, args):
+    "Return the variable accessed by an instruction as (env, idx)."
+    if insn.endswith('_depth'):
+        depth, idx = args
+    else:
+        depth, idx = 0, args[0]
+    env = bdr.env
+    while depth > 0:
+        env = env.parent
+        depth -= 1
+    return (env, idx)
+
+def collect_free(bdr, proc_envs, free, assigned):
+    """\
+    Fill free with the free variables of bdr and the builders nested in
+    it, and assigned with the variables they assign. Return the free
+    variables of bdr, in order of appearance.
+    """
+    variables = []
+    def add(var):
+        if var[0] is not bdr.env and var[0] in proc_envs and \
+           var not in variables:
+            variables.append(var)
+
+    for insn, args in bdr.stream:
+        if insn in ACCESSES:
+            var = variable(bdr, insn, args)
+            if insn.startswith('set'):
+                assigned.add(var)
+            add(var)
+        elif insn == 'generate_proc':
+            for var in collect_free(args, proc_envs, free, assigned):
+                add(var)
+    free[bdr] = variables
+    return variables
+
+def convert_builder(bdr, top, free, boxed):
+    "Rewrite the instructions stream of bdr for flat closures."
+    # Slots of the free variables
+    slots = {}
+    for var in free[bdr]:
+        env, idx = var
+        slots[var] = bdr.env.alloc_slot(env.get_name(idx))
+    def slot(var):
+        if var[0] is bdr.env:
+            return var[1]
+        return slots[var]
+
+    stream = []
+    own_boxed = [idx for env, idx in boxed if env is bdr.env]
+    for idx in sorted(own_boxed):
+        stream.append(('box_local', (idx,)))
+
+    i = 0
+    while i < len(bdr.stream):
+        insn, args = bdr.stream[i]
+        i += 1
+        if insn in ACCESSES:
+            var = variable(bdr, insn, args)
+            action = insn.startswith('push') and 'push' or 'set'
+            if var[0] is bdr.env or var in slots:
+                if var in boxed:
+                    stream.append(('%s_local_box' % action, (slot(var),)))
+                else:
+                    stream.append(('%s_local' % action, (slot(var),)))
+            elif bdr is top:
+                stream.append((insn, args))
+            else:
+                # global variable, reached through the global environment
+                depth = 1
+                env = top.env
+                while env is not var[0]:
+                    env = env.parent
+                    depth += 1
+                stream.append(('%s_local_depth' % action, (depth, var[1])))
+        elif insn == 'generate_proc':
+            # replace the fix_lexical following it
+            i += 1
+            call, call_args = (bdr.stream[i:i+1] or [(None, ())])[0]
+            direct = call in DIRECT_CALLS and accepts(args, call_args[0])
+            if not direct:
+                stream.append((insn, args))
+            for var in free[args]:
+                stream.append(('push_local', (slot(var),)))
+            if direct:
+                i += 1
+                stream.append((DIRECT_CALLS[call], (args, call_args[0], len(free[args]))))
+            elif free[args]:
+                stream.append(('make_closure', (len(free[args]),)))
+        else:
+            stream.append((insn, args))
+    bdr.stream = stream
+
+def accepts(bdr, argc):
+    "Whether the procedure built by bdr can be called with argc arguments."
+    if bdr.rest_arg:
+        return argc >= len(bdr.args)-1
+    return argc == len(bdr.args)
@@ -0,0 +1,204 @@
+from ..iset import INSTRUCTIONS, INSN_MAP
+
+# Superinstructions as (fused instruction names, name), longest first
+# so that a sequence is fused into the longest superinstruction matching
+# it. See the superinstructions in iset.yml.
+SUPERINSTRUCTIONS = sorted([(tuple(insn.fuses), insn.name)
+                            for insn in INSTRUCTIONS if insn.fuses],
+                           key=lambda x: -len(x[0]))
+
+# Instructions never followed by the next one
+UNCONDITIONAL = ('goto', 'ret', 'tail_call', 'tail_call_known', 'tail_call_self',
+                 'tail_call_direct')
+
+# Instructions pushing a value without any side effect
+PUSH_CONSTANT = ('push_literal', 'push_true', 'push_false', 'push_nil',
+                 'push_0', 'push_1')
+PUSH_VALUE = PUSH_CONSTANT + ('push_local', 'push_local_depth', 'push_global')
+
+# Calls followed by ret, by the tail call replacing them
+TAIL_CALLS = {
+    'call'       : 'tail_call',
+    'call_known' : 'tail_call_known',
+    'call_direct': 'tail_call_direct'
+    }
+
+# Assignments of the stack top, after which dup ... pop is a no-op
+SETS = ('set_local', 'set_local_depth', 'set_global', 'set_local_box')
+
+def optimize(stream):
+    """\
+    Rewrite an instructions stream of a builder, see Builder.generate.
+    Labels and pseudo instructions are part of the stream, so rewrites
+    never span a jump target.
+
+    The stream is first simplified until nothing changes, then common
+    sequences are fused into superinstructions.
+    """
+    while True:
+        result = simplify(remove_dead_code(thread_jumps(stream)))
+        if result == stream:
+            break
+        stream = result
+    stream = fuse(stream)
+    stream = fuse_call_pop(stream)
+    return stream
+
+def jump_label(insn, args):
+    "Return the label an instruction jumps to, or None."
+    if insn in ('label', 'generate_proc'):
+        return None
+    for name, x in zip(INSN_MAP[insn].operands, args):
+        if name == 'ip':
+            return x
+    return None
+
+def with_label(insn, args, label):
+    "Return the arguments of a jump with its label replaced."
+    return tuple([label if name == 'ip' else x
+                  for name, x in zip(INSN_MAP[insn].operands, args)])
+
+def thread_jumps(stream):
+    """\
+    Make jumps to a goto jump to its target directly, and replace a
+    goto to a ret by ret.
+    """
+    # the instruction following each label
+    targets = {}
+    for i, (insn, args) in enumerate(stream):
+        if insn == 'label':
+            j = i
+            while j < len(stream) and stream[j][0] == 'label':
+                j += 1
+            if j < len(stream):
+                targets[args] = stream[j]
+
+    result = []
+    for insn, args in stream:
+        label = jump_label(insn, args)
+        if label is not None:
+            seen = set([label])
+            while targets.get(label, (None,))[0] == 'goto':
+                label = targets[label][1][0]
+                if label in seen:
+                    # an infinite loop
+                    break
+                seen.add(label)
+            if insn == 'goto' and targets.get(label) == ('ret', ()):
+                insn, args = 'ret', ()
+            else:
+                args = with_label(insn, args, label)
+        result.append((insn, args))
+    return result
+
+def remove_dead_code(stream):
+    """\
+    Remove the instructions following an unconditional jump, up to the
+    next label jumped to, the labels no jump refers to, and gotos to
+    the next instruction.
+    """
+    used = set()
+    for insn, args in stream:
+        label = jump_label(insn, args)
+        if label is not None:
+            used.add(label)
+
+    result = []
+    dead = False
+    for insn, args in stream:
+        if insn == 'label':
+            if args not in used:
+                continue
+            dead = False
+            if result and result[-1] == ('goto', (args,)):
+                result.pop()
+        elif dead and insn != 'generate_proc':
+            # nested procedures are still generated, see Builder.link
+            continue
+        elif insn in UNCONDITIONAL:
+            dead = True
+        result.append((insn, args))
+    return result
+
+def simplify(stream):
+    """\
+    Rewrite short sequences of instructions:
+
+      push, pop                       => (nothing)
+      dup, set, pop                   => set
+      push constant, conditional jump => goto or nothing
+      goto_if_false L, goto M, L:     => goto_if_not_false M, L:
+      call, ret                       => tail_call
+    """
+    result = []
+    i = 0
+    while i < len(stream):
+        insn, args = stream[i]
+        insn2, args2 = (stream[i+1:i+2] or [(None, ())])[0]
+        insn3, args3 = (stream[i+2:i+3] or [(None, ())])[0]
+
+        if insn in PUSH_VALUE and insn2 == 'pop':
+            i += 2
+        elif insn == 'dup' and insn2 in SETS and insn3 == 'pop':
+            result.append((insn2, args2))
+            i += 3
+        elif insn in PUSH_CONSTANT and insn2 in ('goto_if_false', 'goto_if_not_false'):
+            false = insn == 'push_false' or \
+                    (insn == 'push_literal' and args[0] is False)
+            if false == (insn2 == 'goto_if_false'):
+                result.append(('goto', args2))
+            i += 2
+        elif insn in ('goto_if_false', 'goto_if_not_false') and \
+                 insn2 == 'goto' and (insn3, args3) == ('label', args[0]):
+            if insn == 'goto_if_false':
+                result.append(('goto_if_not_false', args2))
+            else:
+                result.append(('goto_if_false', args2))
+            i += 2
+        elif insn in TAIL_CALLS and insn2 == 'ret':
+            result.append((TAIL_CALLS[insn], args))
+            i += 2
+        else:
+            result.append((insn, args))
+            i += 1
+    return result
+
+def fuse(stream):
+    "Replace sequences of instructions by superinstructions."
+    result = []
+    i = 0
+    while i < len(stream):
+        for names, name in SUPERINSTRUCTIONS:
+            n = len(names)
+            if tuple([insn for insn, args in stream[i:i+n]]) == names:
+                args = ()
+                for insn, a in stream[i:i+n]:
+                    args += a
+                result.append((name, args))
+                i += n
+                break
+        else:
+            result.append(stream[i])
+            i += 1
+    return result
+
+def fuse_call_pop(stream):
+    """\
+    Replace call followed by pop by call_pop. The pop is kept (a called
+    procedure returns to it) and a label after it is added, which
+    call_pop jumps to when a primitive was called.
+    """
+    result = []
+    i = 0
+    while i < len(stream):
+        insn, args = stream[i]
+        if insn == 'call' and stream[i+1:i+2] == [('pop', ())]:
+            label = '__call_pop_%d' % i
+            result.append(('call_pop', args + (label,)))
+            result.append(('pop', ()))
+            result.append(('label', label))
+            i += 2
+        else:
+            result.append(stream[i])
+            i += 1
+    return result
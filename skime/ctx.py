@@ -1,5 +1,9 @@
 from .prim import load_primitives
 
+# Maximum number of free contexts kept by a FramePool, and of free
+# environments kept per procedure
+POOL_SIZE = 64
+
 class Context(object):
     """
     Context of execution. Every procedure call
@@ -7,14 +11,27 @@ class Context(object):
     a context instance.
 
     Context holds method environment, caller (parent
-    context), bytecode to execute and a stack. Stack
-    operations are usually performed on the context
-    instance.
+    context), bytecode to execute and a frame of the
+    operand stack. Stack operations are usually performed
+    on the context instance.
+
+    All contexts of a VM share its operand stack. The
+    frame of a context starts at its base pointer, which
+    is the stack pointer (the stack size) when the
+    context is created. Procedure arguments are moved
+    off the stack before the callee context is created
+    and the return value is left on top of the caller's
+    frame.
     """
     def __init__(self, form, env, parent=None):
+        self.vm = env.vm
+        self.stack = self.vm.stack
+        self.reset(form, env, parent)
+
+    def reset(self, form, env, parent):
+        "Set up the context to run form, see FramePool."
         self.form = form
         self.env = env
-        self.vm = env.vm
         self.parent = parent
 
         self.ip = 0
@@ -22,13 +39,21 @@ class Context(object):
             self.bytecode = form.bytecode
         else:
             self.bytecode = []
-        self.stack = []
+        self.base = len(self.stack)
+
+        # Set when a continuation references the context, so that
+        # it is never recycled
+        self.captured = False
 
     def clone(self):
-        "Make a clone of the context object."
+        """\
+        Make a clone of the context object. The stack is shared,
+        see Continuation for saving its content.
+        """
         ctx = Context(self.form, self.env, self.parent)
         ctx.ip = self.ip
-        ctx.stack = list(self.stack)
+        ctx.base = self.base
+        ctx.captured = self.captured
         return ctx
 
     def push(self, val):
@@ -39,7 +64,8 @@ class Context(object):
         return self.stack.pop()
     def pop_n(self, n):
         "Remove n values from the top of the stack."
-        del self.stack[-n:]
+        if n > 0:
+            del self.stack[-n:]
     def top(self, idx=1):
         "Get a value from the stack."
         return self.stack[-idx]
@@ -57,4 +83,50 @@ class Context(object):
         self.stack[idx:idx] = val
 
     def __str__(self):
-        return '<Context stack_size=%d, ip=%d>' % (len(self.stack), self.ip)
+        return '<Context stack_size=%d, ip=%d>' % (len(self.stack)-self.base, self.ip)
+
+class FramePool(object):
+    """\
+    Free lists of the contexts and environments of procedure calls,
+    one per VM.
+
+    A procedure frame left by ret or a tail call is recycled unless
+    it may still be referenced: its context was captured by a
+    continuation (Context.captured), or its environment is the lexical
+    parent of a closure (Environment.captured, set by the fix_lexical
+    instructions). Environments are kept per procedure, in
+    Procedure.free_envs, since their size depends on the procedure.
+    """
+    def __init__(self):
+        self.contexts = []
+
+    def context(self, proc, env, parent):
+        "Return a context running proc (or a form) under env."
+        if self.contexts:
+            ctx = self.contexts.pop()
+            ctx.reset(proc, env, parent)
+            return ctx
+        return Context(proc, env, parent)
+
+    def env(self, proc):
+        "Return a new environment for a call of proc."
+        if proc.free_envs:
+            env = proc.free_envs.pop()
+            env.parent = proc.env.parent
+            env.locals[:] = proc.env.locals
+            return env
+        return proc.env.dup()
+
+    def release(self, ctx):
+        "Recycle the context of a procedure call that was left."
+        if ctx.captured:
+            return
+        env = ctx.env
+        free_envs = ctx.form.free_envs
+        if not env.captured and free_envs is not None:
+            if len(free_envs) < POOL_SIZE:
+                free_envs.append(env)
+        # don't keep the objects of the frame alive
+        ctx.form = ctx.env = ctx.parent = None
+        if len(self.contexts) < POOL_SIZE:
+            self.contexts.append(ctx)
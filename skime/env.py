@@ -25,6 +25,19 @@ class Location(object):
     def __str__(self):
         return '<Location idx=%s, env=%s>' % (self.idx, self.env)
 
+class Box(object):
+    """\
+    A cell holding the value of a variable that is captured by a
+    closure and assigned, see compiler/freevars.py.
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __repr__(self):
+        return '<Box value=%r>' % (self.value,)
+
 class Undef(object):
     undef = None
     def __new__(cls):
@@ -37,13 +50,32 @@ class Undef(object):
     def __str__(self):
         return '<undef>'
 
+class Scope(object):
+    """\
+    The names of the local variables of an environment. A scope is
+    filled at compile time and then shared by the environments of
+    every call of a procedure, see Environment.dup.
+    """
+    __slots__ = ('names', 'map')
+
+    def __init__(self):
+        # The names of local variables
+        self.names = []
+        # The mapping from name to index
+        self.map = {}
+
+    def size_get(self):
+        return len(self.names)
+    size = property(size_get, None, None, 'number of local variables')
+
 class Environment(object):
     """\
     An environment object holds the local variables of a scope
     and is chained through the lexical scope.
     """
+    __slots__ = ('parent', 'vm', 'scope', 'locals', 'captured', 'version')
 
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, scope=None):
         # The lexical parent
         self.parent = parent
 
@@ -52,23 +84,41 @@ class Environment(object):
         else:
             self.vm = None
 
+        # The names of local variables
+        if scope is None:
+            scope = Scope()
+        self.scope = scope
         # The values of local variables
         self.locals = []
-        # The names of local variables
-        self.locals_name = []
-        # The mapping from name to index
-        self.locals_map = {}
+
+        # Set when the environment becomes the lexical parent of an
+        # object, so that it is never recycled, see FramePool
+        self.captured = False
+
+        # Incremented whenever a variable of the global environment is
+        # assigned by set_global, so that code caching the values of
+        # globals (see jit.py) can tell whether they may have changed
+        self.version = 0
 
     def dup(self):
         """\
-        Create a copy of self.
+        Create a copy of self. The copy shares the scope of self, only
+        the values of the local variables are copied.
         """
-        env = Environment(self.parent)
+        env = Environment(self.parent, self.scope)
         env.locals = list(self.locals)
-        env.locals_name = list(self.locals_name)
-        env.locals_map = dict(self.locals_map)
         return env
 
+    def alloc_slot(self, name):
+        """\
+        Allocate space for a variable that can't be found by name, e.g.
+        a free variable copied from a closure. Return its index.
+        """
+        idx = len(self.locals)
+        self.scope.names.append(name)
+        self.locals.append(Undef())
+        return idx
+
     def assign_local(self, idx, value):
         """\
         Assign value to the local variable stored at idx.
@@ -90,15 +140,16 @@ class Environment(object):
         is OK. They will be stored at the same location, and
         value assigned later will overwrite earlier values.
         """
-        idx = self.locals_map.get(name)
+        scope = self.scope
+        idx = scope.map.get(name)
         if idx is not None:
             if value is not Undef():
                 self.locals[idx] = value
             return idx
         idx = len(self.locals)
-        self.locals_name.append(name)
+        scope.names.append(name)
         self.locals.append(value)
-        self.locals_map[name] = idx
+        scope.map[name] = idx
         return idx
 
     def find_local(self, name):
@@ -107,14 +158,14 @@ class Environment(object):
         stored. Return None if no variable with given name is
         found.
         """
-        return self.locals_map.get(name)
+        return self.scope.map.get(name)
 
     def get_name(self, idx):
         """\
         Get the name of the local variable stored at the given
         location(index). Used in debugging.
         """
-        return self.locals_name[idx]
+        return self.scope.names[idx]
 
     def lookup_location(self, name):
         """\
@@ -21,5 +21,8 @@ class ParseError(CompileError):
 class MiscError(Error):
     pass
 
+class SerializeError(Error):
+    "Compiled code that can't be written out or loaded back, see skc.py"
+
 class WrongArgType(Error):
     pass
@@ -1,10 +1,11 @@
 from cStringIO        import StringIO
+from array            import array
 
 from .errors          import MiscError
 from .env             import Environment
 from .compiler.disasm import disasm
-from .insns           import run
 from .ctx             import Context
+from .iset            import INSN_MAP
 
 class Form(object):
     """\
@@ -24,10 +25,26 @@ class Form(object):
         # The literals used in bytecode
         self.literals = builder.literals
 
+        # Basic block closures of the bytecode, translated on first
+        # run by the closure engine
+        self.closures = None
+
+        # Forms are run once, the JIT only compiles procedures
+        self.backedges = 0
+        self.native = False
+
+        # A form runs in an environment it is given, which is never
+        # recycled, see FramePool
+        self.free_envs = None
+
     def eval(self, env, vm):
         "Eval the form under env and vm."
         ctx = Context(self, env, vm.ctx)
-        return run(ctx)
+        try:
+            return vm.engine(ctx)
+        finally:
+            # drop what an error left on the stack
+            del vm.stack[ctx.base:]
 
     def disasm(self):
         "Show the disassemble of the instructions of the form. Useful for debug."
@@ -50,3 +67,21 @@ class Form(object):
         io.close()
 
         return content
+
+
+class TrampolineForm(object):
+    """\
+    The form of the contexts running the calls of a PyTrampoline. Its
+    only instruction resumes the primitive each time a procedure it
+    called returns.
+    """
+    bytecode = array('i', [INSN_MAP['resume_trampoline'].opcode])
+    literals = []
+
+    def __init__(self, prim):
+        self.prim = prim
+        self.env = None
+        self.closures = None
+        self.backedges = 0
+        self.native = False
+        self.free_envs = None
@@ -1,24 +1,28 @@
 # Don't edit this file. This is generated by iset_gen.py
 
+from timeit      import default_timer as clock
+
 from .ctx        import Context
+from .form       import TrampolineForm
 from .call_cc    import Continuation
-from .proc       import Procedure
-from .prim       import Primitive
+from .proc       import Procedure, Closure
+from .env        import Box
+from .prim       import Primitive, PyTrampoline, Apply, apply_arguments, type_check
 from .types.pair import Pair
-from .errors     import WrongArgType
+from .errors     import WrongArgType, WrongArgNumber
+from .iset       import INSTRUCTIONS, FIELDS, OPCODE_MASK, EXTENDED, decode, decode_operands
 
 TAG_CTRL_FLOW    = 1
 TAG_CTX_SWITCH   = 2
 
 def op_ret(ctx):
     """
-    Return from a procedure.
-    stack before: []
-    stack after: []
+    Return from a procedure. The return value is left on the stack for the caller.
+    stack before: ['retval']
+    stack after: ['retval']
     """
     pctx = ctx.parent
-    retval = ctx.pop()
-    pctx.push(retval)
+    ctx.vm.frames.release(ctx)
     return pctx
     
 def op_call(ctx):
@@ -27,10 +31,10 @@ def op_call(ctx):
     stack before: ['...', 'proc']
     stack after: ['retval']
     """
-    argc = get_param(ctx, 1)
+    argc = get_param(ctx, 1, 1)
     nctx = make_call(ctx, argc)
     
-    ctx.ip += 2
+    ctx.ip += 1
     return nctx
     
 def op_tail_call(ctx):
@@ -39,10 +43,9 @@ def op_tail_call(ctx):
     stack before: ['...', 'proc']
     stack after: ['retval']
     """
-    argc = get_param(ctx, 1)
+    argc = get_param(ctx, 1, 1)
+    ctx.ip += 1
     nctx = make_call(ctx, argc, tail=True)
-    
-    ctx.ip += 2
     return nctx
     
 def op_call_cc(ctx):
@@ -73,10 +76,10 @@ def op_push_local(ctx):
     stack before: []
     stack after: ['value']
     """
-    idx = get_param(ctx, 1)
+    idx = get_param(ctx, 1, 1)
     loc = ctx.env.read_local(idx)
     ctx.push(loc)
-    ctx.ip += 2
+    ctx.ip += 1
     
 def op_set_local(ctx):
     """
@@ -84,10 +87,10 @@ def op_set_local(ctx):
     stack before: ['value']
     stack after: []
     """
-    idx = get_param(ctx, 1)
+    idx = get_param(ctx, 1, 1)
     val = ctx.pop()
     ctx.env.assign_local(idx, val)
-    ctx.ip += 2
+    ctx.ip += 1
     
 def op_push_local_depth(ctx):
     """
@@ -95,8 +98,8 @@ def op_push_local_depth(ctx):
     stack before: []
     stack after: ['value']
     """
-    depth = get_param(ctx, 1)
-    idx = get_param(ctx, 2)
+    depth = get_param(ctx, 1, 2)
+    idx = get_param(ctx, 2, 2)
     
     penv = ctx.env
     while depth > 0:
@@ -104,7 +107,7 @@ def op_push_local_depth(ctx):
         depth -= 1
     loc = penv.read_local(idx)
     ctx.push(loc)
-    ctx.ip += 3
+    ctx.ip += 1
     
 def op_set_local_depth(ctx):
     """
@@ -112,8 +115,8 @@ def op_set_local_depth(ctx):
     stack before: ['value']
     stack after: []
     """
-    depth = get_param(ctx, 1)
-    idx = get_param(ctx, 2)
+    depth = get_param(ctx, 1, 2)
+    idx = get_param(ctx, 2, 2)
     value = ctx.pop()
     
     penv = ctx.env
@@ -121,7 +124,28 @@ def op_set_local_depth(ctx):
         penv = penv.parent
         depth -= 1
     penv.assign_local(idx, value)
-    ctx.ip += 3
+    ctx.ip += 1
+    
+def op_push_global(ctx):
+    """
+    Push value of a variable of the global environment to operand stack.
+    stack before: []
+    stack after: ['value']
+    """
+    ctx.push(ctx.vm.env.read_local(get_param(ctx, 1, 1)))
+    ctx.ip += 1
+    
+def op_set_global(ctx):
+    """
+    Pop a value and assign to a variable of the global environment.
+    stack before: ['value']
+    stack after: []
+    """
+    value = ctx.pop()
+    genv = ctx.vm.env
+    genv.assign_local(get_param(ctx, 1, 1), value)
+    genv.version += 1
+    ctx.ip += 1
     
 def op_push_literal(ctx):
     """
@@ -129,10 +153,10 @@ def op_push_literal(ctx):
     stack before: []
     stack after: ['value']
     """
-    idx = get_param(ctx, 1)
+    idx = get_param(ctx, 1, 1)
     lit = ctx.form.literals[idx]
     ctx.push(lit)
-    ctx.ip += 2
+    ctx.ip += 1
     
 def op_push_0(ctx):
     """
@@ -190,11 +214,13 @@ def op_dup(ctx):
     
 def op_goto(ctx):
     """
-    Unconditional jump.
+    Unconditional jump. Backward jumps are counted for the JIT.
     stack before: []
     stack after: []
     """
-    ip = get_param(ctx, 1)
+    ip = get_param(ctx, 1, 1)
+    if ip <= ctx.ip:
+        ctx.form.backedges += 1
     ctx.ip = ip
     
 def op_goto_if_not_false(ctx):
@@ -203,12 +229,39 @@ def op_goto_if_not_false(ctx):
     stack before: ['condition']
     stack after: []
     """
-    ip = get_param(ctx, 1)
+    ip = get_param(ctx, 1, 1)
     cond = ctx.pop()
     if cond is not False:
         ctx.ip = ip
     else:
-        ctx.ip += 2
+        ctx.ip += 1
+    
+def op_push_folded(ctx):
+    """
+    Push the value of a call folded at compile time and jump to ip, if the primitives it calls are still bound to their globals (see Folded). Else the code of the call follows.
+    stack before: []
+    stack after: ['value']
+    """
+    folded = ctx.form.literals[get_param(ctx, 1, 2)]
+    genv = ctx.vm.env
+    if folded.version == genv.version or folded.check(genv):
+        ctx.push(folded.value)
+        ctx.ip = get_param(ctx, 2, 2)
+    else:
+        ctx.ip += 1
+    
+def op_guard_inlined(ctx):
+    """
+    Fall through to the body of a procedure inlined at compile time if the global it was called by is still bound to it (see Guard). Else jump to ip, where the call of the procedure follows.
+    stack before: []
+    stack after: []
+    """
+    guard = ctx.form.literals[get_param(ctx, 1, 2)]
+    genv = ctx.vm.env
+    if guard.version == genv.version or guard.check(genv):
+        ctx.ip += 1
+    else:
+        ctx.ip = get_param(ctx, 2, 2)
     
 def op_goto_if_false(ctx):
     """
@@ -216,12 +269,12 @@ def op_goto_if_false(ctx):
     stack before: ['condition']
     stack after: []
     """
-    ip = get_param(ctx, 1)
+    ip = get_param(ctx, 1, 1)
     cond = ctx.pop()
     if cond is False:
         ctx.ip = ip
     else:
-        ctx.ip += 2
+        ctx.ip += 1
     
 def op_fix_lexical(ctx):
     """
@@ -231,6 +284,7 @@ def op_fix_lexical(ctx):
     """
     proc = ctx.top()
     proc.lexical_parent = ctx.env
+    ctx.env.captured = True
     ctx.ip += 1
     
 def op_fix_lexical_pop(ctx):
@@ -241,6 +295,7 @@ def op_fix_lexical_pop(ctx):
     """
     proc = ctx.pop()
     proc.lexical_parent = ctx.env
+    ctx.env.captured = True
     ctx.ip += 1
     
 def op_fix_lexical_depth(ctx):
@@ -249,26 +304,38 @@ def op_fix_lexical_depth(ctx):
     stack before: ['obj']
     stack after: ['obj']
     """
-    depth = get_param(ctx, 1)
+    depth = get_param(ctx, 1, 1)
     proc = ctx.top()
     env = ctx.env
     while depth > 0:
         env = env.parent
         depth -= 1
     proc.lexical_parent = env
-    ctx.ip += 2
+    env.captured = True
+    ctx.ip += 1
+    
+def op_resume_trampoline(ctx):
+    """
+    Resume a PyTrampoline with its state and the result of the procedure it called, see TrampolineForm.
+    stack before: ['state', 'result']
+    stack after: []
+    """
+    value = ctx.pop()
+    state = ctx.pop()
+    nctx = resume_trampoline(ctx, ctx.form.prim.resume(ctx.vm, state, value))
+    return nctx
     
 def op_dynamic_eval(ctx):
     """
-    Evaluate a DynamicClosure and push the result.
+    Evaluate a DynamicClosure and push the result. Its form returns to the next instruction.
     stack before: ['dynamic_closure']
     stack after: ['result']
     """
     dc = ctx.pop()
-    form = dc.form
-    env = dc.lexical_parent
-    ctx.push(form.eval(env, ctx.vm))
+    nctx = ctx.vm.frames.context(dc.form, dc.lexical_parent, ctx)
+    
     ctx.ip += 1
+    return nctx
     
 def op_dynamic_set_local(ctx):
     """
@@ -276,13 +343,13 @@ def op_dynamic_set_local(ctx):
     stack before: ['value', 'sym_closure']
     stack after: []
     """
-    idx = get_param(ctx, 1)
+    idx = get_param(ctx, 1, 1)
     sym_closure = ctx.pop()
     value = ctx.pop()
     
     env = sym_closure.lexical_parent
     env.assign_local(idx, value)
-    ctx.ip += 2
+    ctx.ip += 1
     
 def op_dynamic_set_local_depth(ctx):
     """
@@ -290,8 +357,8 @@ def op_dynamic_set_local_depth(ctx):
     stack before: ['value', 'sym_closure']
     stack after: []
     """
-    depth = get_param(ctx, 1)
-    idx = get_param(ctx, 2)
+    depth = get_param(ctx, 1, 2)
+    idx = get_param(ctx, 2, 2)
     sym_closure = ctx.pop()
     value = ctx.pop()
     
@@ -300,7 +367,399 @@ def op_dynamic_set_local_depth(ctx):
         env = env.parent
         depth -= 1
     env.assign_local(idx, value)
-    ctx.ip += 3
+    ctx.ip += 1
+    
+def op_call_pop(ctx):
+    """
+    Call a procedure and drop its result. Followed by a pop that is skipped (jumping to ip) if a primitive was called.
+    stack before: ['...', 'proc']
+    stack after: []
+    """
+    argc = get_param(ctx, 1, 2)
+    nctx = make_call(ctx, argc)
+    if nctx is ctx:
+        # A primitive was called, drop its result and skip the pop.
+        # A call outside of tail position never releases ctx, so it
+        # can't come back as a recycled context.
+        ctx.pop()
+        ctx.ip = get_param(ctx, 2, 2)
+    else:
+        ctx.ip += 1
+    return nctx
+    
+def op_call_known(ctx):
+    """
+    Call the procedure proc, known at compile time to be the value of the global variable local, if it still is. Otherwise call the value of the global.
+    stack before: ['...']
+    stack after: ['retval']
+    """
+    argc = get_param(ctx, 2, 3)
+    proc = ctx.form.literals[get_param(ctx, 3, 3)]
+    value = ctx.vm.env.read_local(get_param(ctx, 1, 3))
+    if value is proc:
+        nctx = call_procedure(ctx, proc, argc)
+    else:
+        ctx.push(value)
+        nctx = make_call(ctx, argc)
+    
+    ctx.ip += 1
+    return nctx
+    
+def op_tail_call_known(ctx):
+    """
+    Like call_known, but with tail-call.
+    stack before: ['...']
+    stack after: ['retval']
+    """
+    argc = get_param(ctx, 2, 3)
+    proc = ctx.form.literals[get_param(ctx, 3, 3)]
+    value = ctx.vm.env.read_local(get_param(ctx, 1, 3))
+    ctx.ip += 1
+    if value is proc:
+        nctx = call_procedure(ctx, proc, argc, tail=True)
+    else:
+        ctx.push(value)
+        nctx = make_call(ctx, argc, tail=True)
+    return nctx
+    
+def op_call_direct(ctx):
+    """
+    Call the procedure proc, created for a lambda that is only called right there (see compiler/freevars.py), with the argc arguments on the stack below the values of its freec free variables. No closure is made.
+    stack before: ['...']
+    stack after: ['retval']
+    """
+    proc = ctx.form.literals[get_param(ctx, 1, 3)]
+    argc = get_param(ctx, 2, 3)
+    freec = get_param(ctx, 3, 3)
+    free = None
+    if freec > 0:
+        free = ctx.stack[-freec:]
+        ctx.pop_n(freec)
+    nctx = call_procedure(ctx, proc, argc, free=free)
+    ctx.ip += 1
+    return nctx
+    
+def op_tail_call_direct(ctx):
+    """
+    Like call_direct, but with tail-call.
+    stack before: ['...']
+    stack after: ['retval']
+    """
+    proc = ctx.form.literals[get_param(ctx, 1, 3)]
+    argc = get_param(ctx, 2, 3)
+    freec = get_param(ctx, 3, 3)
+    free = None
+    if freec > 0:
+        free = ctx.stack[-freec:]
+        ctx.pop_n(freec)
+    ctx.ip += 1
+    nctx = call_procedure(ctx, proc, argc, tail=True, free=free)
+    return nctx
+    
+def op_tail_call_self(ctx):
+    """
+    Like tail_call_known, for a procedure calling itself. The arguments are rebound in the frame of the call, which runs again from its start.
+    stack before: ['...']
+    stack after: ['retval']
+    """
+    argc = get_param(ctx, 2, 2)
+    proc = ctx.form
+    value = ctx.vm.env.read_local(get_param(ctx, 1, 2))
+    ctx.ip += 1
+    if value is proc:
+        nctx = call_procedure(ctx, proc, argc, tail=True)
+    else:
+        ctx.push(value)
+        nctx = make_call(ctx, argc, tail=True)
+    return nctx
+    
+def op_push_local_box(ctx):
+    """
+    Push the value of a boxed local variable.
+    stack before: []
+    stack after: ['value']
+    """
+    idx = get_param(ctx, 1, 1)
+    box = ctx.env.read_local(idx)
+    ctx.push(box.value)
+    ctx.ip += 1
+    
+def op_set_local_box(ctx):
+    """
+    Pop the stack top and assign it to a boxed local variable.
+    stack before: ['value']
+    stack after: []
+    """
+    idx = get_param(ctx, 1, 1)
+    box = ctx.env.read_local(idx)
+    box.value = ctx.pop()
+    ctx.ip += 1
+    
+def op_box_local(ctx):
+    """
+    Put the value of a local variable captured by closures and assigned in a box.
+    stack before: []
+    stack after: []
+    """
+    idx = get_param(ctx, 1, 1)
+    value = ctx.env.read_local(idx)
+    ctx.env.assign_local(idx, Box(value))
+    ctx.ip += 1
+    
+def op_make_closure(ctx):
+    """
+    Make a closure of a procedure and the values of its free variables.
+    stack before: ['proc', '...']
+    stack after: ['closure']
+    """
+    argc = get_param(ctx, 1, 1)
+    free = ctx.stack[-argc:]
+    ctx.pop_n(argc)
+    proc = ctx.pop()
+    ctx.push(Closure(proc, free))
+    ctx.ip += 1
+    
+def op_extended_arg(ctx):
+    """
+    Hold the high bits of the operands of the next instruction, which are too large for its word (see decode_operands in iset.py). Does nothing when run.
+    stack before: []
+    stack after: []
+    """
+    pass
+    ctx.ip += 1
+    
+def op_add2(ctx):
+    """
+    Add two numbers, like the + primitive.
+    stack before: ['a', 'b']
+    stack after: ['a+b']
+    """
+    b = ctx.pop()
+    a = ctx.pop()
+    if ctx.vm.env.read_local(get_param(ctx, 1, 2)) is ctx.form.literals[get_param(ctx, 2, 2)]:
+        try:
+            ctx.push(0 + a + b)
+        except TypeError, e:
+            raise WrongArgType(e.message)
+    else:
+        ctx.push(ctx.vm.apply(ctx.vm.env.read_local(get_param(ctx, 1, 2)), [a, b]))
+    ctx.ip += 1
+    
+def op_sub2(ctx):
+    """
+    Subtract two numbers, like the - primitive.
+    stack before: ['a', 'b']
+    stack after: ['a-b']
+    """
+    b = ctx.pop()
+    a = ctx.pop()
+    if ctx.vm.env.read_local(get_param(ctx, 1, 2)) is ctx.form.literals[get_param(ctx, 2, 2)]:
+        try:
+            ctx.push(a - b)
+        except TypeError, e:
+            raise WrongArgType(e.message)
+    else:
+        ctx.push(ctx.vm.apply(ctx.vm.env.read_local(get_param(ctx, 1, 2)), [a, b]))
+    ctx.ip += 1
+    
+def op_numeq2(ctx):
+    """
+    Compare two numbers, like the = primitive.
+    stack before: ['a', 'b']
+    stack after: ['a=b']
+    """
+    b = ctx.pop()
+    a = ctx.pop()
+    if ctx.vm.env.read_local(get_param(ctx, 1, 2)) is ctx.form.literals[get_param(ctx, 2, 2)]:
+        type_check(a, (int, long, float, complex))
+        type_check(b, (int, long, float, complex))
+        ctx.push(a == b)
+    else:
+        ctx.push(ctx.vm.apply(ctx.vm.env.read_local(get_param(ctx, 1, 2)), [a, b]))
+    ctx.ip += 1
+    
+def op_lt2(ctx):
+    """
+    Compare two numbers, like the < primitive.
+    stack before: ['a', 'b']
+    stack after: ['a<b']
+    """
+    b = ctx.pop()
+    a = ctx.pop()
+    if ctx.vm.env.read_local(get_param(ctx, 1, 2)) is ctx.form.literals[get_param(ctx, 2, 2)]:
+        ctx.push(not a >= b)
+    else:
+        ctx.push(ctx.vm.apply(ctx.vm.env.read_local(get_param(ctx, 1, 2)), [a, b]))
+    ctx.ip += 1
+    
+def op_car(ctx):
+    """
+    The first element of a pair, like the car primitive.
+    stack before: ['pair']
+    stack after: ['first']
+    """
+    obj = ctx.pop()
+    if ctx.vm.env.read_local(get_param(ctx, 1, 2)) is ctx.form.literals[get_param(ctx, 2, 2)]:
+        if not isinstance(obj, Pair):
+            type_check(obj, Pair)
+        ctx.push(obj.first)
+    else:
+        ctx.push(ctx.vm.apply(ctx.vm.env.read_local(get_param(ctx, 1, 2)), [obj]))
+    ctx.ip += 1
+    
+def op_cdr(ctx):
+    """
+    The rest of a pair, like the cdr primitive.
+    stack before: ['pair']
+    stack after: ['rest']
+    """
+    obj = ctx.pop()
+    if ctx.vm.env.read_local(get_param(ctx, 1, 2)) is ctx.form.literals[get_param(ctx, 2, 2)]:
+        if not isinstance(obj, Pair):
+            type_check(obj, Pair)
+        ctx.push(obj.rest)
+    else:
+        ctx.push(ctx.vm.apply(ctx.vm.env.read_local(get_param(ctx, 1, 2)), [obj]))
+    ctx.ip += 1
+    
+def op_cons(ctx):
+    """
+    Make a pair, like the cons primitive.
+    stack before: ['first', 'rest']
+    stack after: ['pair']
+    """
+    rest = ctx.pop()
+    first = ctx.pop()
+    if ctx.vm.env.read_local(get_param(ctx, 1, 2)) is ctx.form.literals[get_param(ctx, 2, 2)]:
+        ctx.push(Pair(first, rest))
+    else:
+        ctx.push(ctx.vm.apply(ctx.vm.env.read_local(get_param(ctx, 1, 2)), [first, rest]))
+    ctx.ip += 1
+    
+def op_nullp(ctx):
+    """
+    Whether an object is the empty list, like the null? primitive.
+    stack before: ['obj']
+    stack after: ['bool']
+    """
+    obj = ctx.pop()
+    if ctx.vm.env.read_local(get_param(ctx, 1, 2)) is ctx.form.literals[get_param(ctx, 2, 2)]:
+        ctx.push(obj is None)
+    else:
+        ctx.push(ctx.vm.apply(ctx.vm.env.read_local(get_param(ctx, 1, 2)), [obj]))
+    ctx.ip += 1
+    
+def op_call_locals(ctx):
+    """
+    Call a global procedure with two local arguments.
+    stack before: []
+    stack after: ['retval']
+    """
+    idx = get_param(ctx, 1, 4)
+    loc = ctx.env.read_local(idx)
+    ctx.push(loc)
+    idx = get_param(ctx, 2, 4)
+    loc = ctx.env.read_local(idx)
+    ctx.push(loc)
+    ctx.push(ctx.vm.env.read_local(get_param(ctx, 3, 4)))
+    argc = get_param(ctx, 4, 4)
+    nctx = make_call(ctx, argc)
+    
+    ctx.ip += 1
+    return nctx
+    
+def op_call_literal_global(ctx):
+    """
+    Call a global procedure with a literal argument.
+    stack before: ['...']
+    stack after: ['retval']
+    """
+    idx = get_param(ctx, 1, 3)
+    lit = ctx.form.literals[idx]
+    ctx.push(lit)
+    ctx.push(ctx.vm.env.read_local(get_param(ctx, 2, 3)))
+    argc = get_param(ctx, 3, 3)
+    nctx = make_call(ctx, argc)
+    
+    ctx.ip += 1
+    return nctx
+    
+def op_call_global(ctx):
+    """
+    Call a global procedure.
+    stack before: ['...']
+    stack after: ['retval']
+    """
+    ctx.push(ctx.vm.env.read_local(get_param(ctx, 1, 2)))
+    argc = get_param(ctx, 2, 2)
+    nctx = make_call(ctx, argc)
+    
+    ctx.ip += 1
+    return nctx
+    
+def op_tail_call_global(ctx):
+    """
+    Tail-call a global procedure.
+    stack before: ['...']
+    stack after: ['retval']
+    """
+    ctx.push(ctx.vm.env.read_local(get_param(ctx, 1, 2)))
+    argc = get_param(ctx, 2, 2)
+    ctx.ip += 1
+    nctx = make_call(ctx, argc, tail=True)
+    return nctx
+    
+def op_push_local_local(ctx):
+    """
+    Push the values of two local variables.
+    stack before: []
+    stack after: ['value1', 'value2']
+    """
+    idx = get_param(ctx, 1, 2)
+    loc = ctx.env.read_local(idx)
+    ctx.push(loc)
+    idx = get_param(ctx, 2, 2)
+    loc = ctx.env.read_local(idx)
+    ctx.push(loc)
+    ctx.ip += 1
+    
+def op_push_local_literal(ctx):
+    """
+    Push the value of a local variable and a literal.
+    stack before: []
+    stack after: ['value', 'literal']
+    """
+    idx = get_param(ctx, 1, 2)
+    loc = ctx.env.read_local(idx)
+    ctx.push(loc)
+    idx = get_param(ctx, 2, 2)
+    lit = ctx.form.literals[idx]
+    ctx.push(lit)
+    ctx.ip += 1
+    
+def op_push_local_1(ctx):
+    """
+    Push the value of a local variable and 1.
+    stack before: []
+    stack after: ['value', 1]
+    """
+    idx = get_param(ctx, 1, 1)
+    loc = ctx.env.read_local(idx)
+    ctx.push(loc)
+    ctx.push(1)
+    ctx.ip += 1
+    
+def op_dup_set_local(ctx):
+    """
+    Assign the stack top to a local variable, keeping it.
+    stack before: ['value']
+    stack after: ['value']
+    """
+    ctx.push(ctx.top())
+    idx = get_param(ctx, 1, 1)
+    val = ctx.pop()
+    ctx.env.assign_local(idx, val)
+    ctx.ip += 1
     
 
 INSN_ACTION = [
@@ -313,6 +772,8 @@ INSN_ACTION = [
     op_set_local,
     op_push_local_depth,
     op_set_local_depth,
+    op_push_global,
+    op_set_global,
     op_push_literal,
     op_push_0,
     op_push_1,
@@ -322,13 +783,43 @@ INSN_ACTION = [
     op_dup,
     op_goto,
     op_goto_if_not_false,
+    op_push_folded,
+    op_guard_inlined,
     op_goto_if_false,
     op_fix_lexical,
     op_fix_lexical_pop,
     op_fix_lexical_depth,
+    op_resume_trampoline,
     op_dynamic_eval,
     op_dynamic_set_local,
-    op_dynamic_set_local_depth
+    op_dynamic_set_local_depth,
+    op_call_pop,
+    op_call_known,
+    op_tail_call_known,
+    op_call_direct,
+    op_tail_call_direct,
+    op_tail_call_self,
+    op_push_local_box,
+    op_set_local_box,
+    op_box_local,
+    op_make_closure,
+    op_extended_arg,
+    op_add2,
+    op_sub2,
+    op_numeq2,
+    op_lt2,
+    op_car,
+    op_cdr,
+    op_cons,
+    op_nullp,
+    op_call_locals,
+    op_call_literal_global,
+    op_call_global,
+    op_tail_call_global,
+    op_push_local_local,
+    op_push_local_literal,
+    op_push_local_1,
+    op_dup_set_local
 ]
 
 
@@ -349,12 +840,44 @@ INSN_TAGS = [
     0,
     0,
     0,
+    0,
+    0,
+    TAG_CTRL_FLOW,
+    TAG_CTRL_FLOW,
     TAG_CTRL_FLOW,
     TAG_CTRL_FLOW,
     TAG_CTRL_FLOW,
     0,
     0,
     0,
+    TAG_CTX_SWITCH | TAG_CTRL_FLOW,
+    TAG_CTX_SWITCH | TAG_CTRL_FLOW,
+    0,
+    0,
+    TAG_CTX_SWITCH | TAG_CTRL_FLOW,
+    TAG_CTX_SWITCH | TAG_CTRL_FLOW,
+    TAG_CTX_SWITCH | TAG_CTRL_FLOW,
+    TAG_CTX_SWITCH | TAG_CTRL_FLOW,
+    TAG_CTX_SWITCH | TAG_CTRL_FLOW,
+    TAG_CTX_SWITCH | TAG_CTRL_FLOW,
+    0,
+    0,
+    0,
+    0,
+    0,
+    0,
+    0,
+    0,
+    0,
+    0,
+    0,
+    0,
+    0,
+    TAG_CTX_SWITCH | TAG_CTRL_FLOW,
+    TAG_CTX_SWITCH | TAG_CTRL_FLOW,
+    TAG_CTX_SWITCH | TAG_CTRL_FLOW,
+    TAG_CTX_SWITCH | TAG_CTRL_FLOW,
+    0,
     0,
     0,
     0
@@ -365,56 +888,1657 @@ INSN_TAGS = [
 def has_tag(opcode, tag):
     return INSN_TAGS[opcode] & tag == tag
 
-def get_param(ctx, n):
-    return ctx.bytecode[ctx.ip+n]
+def get_param(ctx, n, count):
+    "Return the Nth of the count operands of the instruction at the current IP."
+    word = ctx.bytecode[ctx.ip]
+    if word & EXTENDED:
+        return decode_operands(ctx.bytecode, ctx.ip)[n-1]
+    shift, mask = FIELDS[count][n-1]
+    return word >> shift & mask
 
-def run(ctx):
+def run_table(ctx):
+    "Table driven run loop: one call through INSN_ACTION per instruction."
     while ctx.ip < len(ctx.bytecode):
-        opcode = ctx.bytecode[ctx.ip]
+        opcode = ctx.bytecode[ctx.ip] & OPCODE_MASK
         nctx = INSN_ACTION[opcode](ctx)
         if has_tag(opcode, TAG_CTX_SWITCH):
             ctx = nctx
     return ctx.pop()
 
+def run_stats(ctx):
+    """\
+    Instrumented run loop, like run_table but recording instruction
+    counts, times and pairs in ctx.vm.stats (an InsnStats).
+    """
+    stats = ctx.vm.stats
+    counts = stats.counts
+    times = stats.times
+    pairs = stats.pairs
+    while ctx.ip < len(ctx.bytecode):
+        opcode = ctx.bytecode[ctx.ip] & OPCODE_MASK
+        counts[opcode] += 1
+        pairs[stats.last][opcode] += 1
+        stats.last = opcode
+        start = clock()
+        nctx = INSN_ACTION[opcode](ctx)
+        times[opcode] += clock() - start
+        if has_tag(opcode, TAG_CTX_SWITCH):
+            ctx = nctx
+    return ctx.pop()
+
+def run_fused(ctx):
+    """\
+    Fused run loop: all instruction bodies are inlined into a single
+    dispatch chain ordered by opcode frequency, with the state of the
+    current context cached in local variables.
+    """
+    literals = None
+    G = ctx.vm.env.locals
+    form = ctx.form
+    bc = ctx.bytecode
+    pc = ctx.ip
+    end = len(bc)
+    stack = ctx.stack
+    push = stack.append
+    pop = stack.pop
+    lvars = ctx.env.locals
+    if form is not None:
+        literals = form.literals
+    while pc < end:
+        word = bc[pc]
+        # with the EXTENDED flag, see FUSED_EXTENDED
+        opcode = word & 0xff
+        if opcode == 41: # add2
+            b = pop()
+            a = pop()
+            if G[word >> 8 & 2047] is literals[word >> 19]:
+                try:
+                    push(0 + a + b)
+                except TypeError, e:
+                    raise WrongArgType(e.message)
+            else:
+                push(ctx.vm.apply(G[word >> 8 & 2047], [a, b]))
+            pc += 1
+        elif opcode == 19: # goto_if_not_false
+            ip = word >> 8
+            cond = pop()
+            if cond is not False:
+                pc = ip
+            else:
+                pc += 1
+        elif opcode == 55: # push_local_1
+            idx = word >> 8
+            loc = lvars[idx]
+            push(loc)
+            push(1)
+            pc += 1
+        elif opcode == 6: # set_local
+            idx = word >> 8
+            val = pop()
+            lvars[idx] = val
+            pc += 1
+        elif opcode == 43: # numeq2
+            b = pop()
+            a = pop()
+            if G[word >> 8 & 2047] is literals[word >> 19]:
+                type_check(a, (int, long, float, complex))
+                type_check(b, (int, long, float, complex))
+                push(a == b)
+            else:
+                push(ctx.vm.apply(G[word >> 8 & 2047], [a, b]))
+            pc += 1
+        elif opcode == 53: # push_local_local
+            idx = word >> 8 & 2047
+            loc = lvars[idx]
+            push(loc)
+            idx = word >> 19
+            loc = lvars[idx]
+            push(loc)
+            pc += 1
+        elif opcode == 54: # push_local_literal
+            idx = word >> 8 & 2047
+            loc = lvars[idx]
+            push(loc)
+            idx = word >> 19
+            lit = literals[idx]
+            push(lit)
+            pc += 1
+        elif opcode == 42: # sub2
+            b = pop()
+            a = pop()
+            if G[word >> 8 & 2047] is literals[word >> 19]:
+                try:
+                    push(a - b)
+                except TypeError, e:
+                    raise WrongArgType(e.message)
+            else:
+                push(ctx.vm.apply(G[word >> 8 & 2047], [a, b]))
+            pc += 1
+        elif opcode == 5: # push_local
+            idx = word >> 8
+            loc = lvars[idx]
+            push(loc)
+            pc += 1
+        elif opcode == 12: # push_0
+            push(0)
+            pc += 1
+        elif opcode == 18: # goto
+            ctx.ip = pc
+            ip = word >> 8
+            if ip <= ctx.ip:
+                ctx.form.backedges += 1
+            pc = ip
+        elif opcode == 32: # tail_call_known
+            ctx.ip = pc
+            argc = word >> 15 & 127
+            proc = ctx.form.literals[word >> 22]
+            value = ctx.vm.env.read_local(word >> 8 & 127)
+            ctx.ip += 1
+            if value is proc:
+                nctx = call_procedure(ctx, proc, argc, tail=True)
+            else:
+                ctx.push(value)
+                nctx = make_call(ctx, argc, tail=True)
+            ctx = nctx
+            if ctx.form is form and ctx.env.locals is lvars:
+                pc = ctx.ip
+            else:
+                form = ctx.form
+                bc = ctx.bytecode
+                pc = ctx.ip
+                end = len(bc)
+                stack = ctx.stack
+                push = stack.append
+                pop = stack.pop
+                lvars = ctx.env.locals
+                if form is not None:
+                    literals = form.literals
+        elif opcode == 35: # tail_call_self
+            ctx.ip = pc
+            argc = word >> 19
+            proc = ctx.form
+            value = ctx.vm.env.read_local(word >> 8 & 2047)
+            ctx.ip += 1
+            if value is proc:
+                nctx = call_procedure(ctx, proc, argc, tail=True)
+            else:
+                ctx.push(value)
+                nctx = make_call(ctx, argc, tail=True)
+            ctx = nctx
+            if ctx.form is form and ctx.env.locals is lvars:
+                pc = ctx.ip
+            else:
+                form = ctx.form
+                bc = ctx.bytecode
+                pc = ctx.ip
+                end = len(bc)
+                stack = ctx.stack
+                push = stack.append
+                pop = stack.pop
+                lvars = ctx.env.locals
+                if form is not None:
+                    literals = form.literals
+        elif opcode == 0: # ret
+            ctx.ip = pc
+            pctx = ctx.parent
+            ctx.vm.frames.release(ctx)
+            ctx = pctx
+            if ctx.form is form and ctx.env.locals is lvars:
+                pc = ctx.ip
+            else:
+                form = ctx.form
+                bc = ctx.bytecode
+                pc = ctx.ip
+                end = len(bc)
+                stack = ctx.stack
+                push = stack.append
+                pop = stack.pop
+                lvars = ctx.env.locals
+                if form is not None:
+                    literals = form.literals
+        elif opcode == 31: # call_known
+            ctx.ip = pc
+            argc = word >> 15 & 127
+            proc = ctx.form.literals[word >> 22]
+            value = ctx.vm.env.read_local(word >> 8 & 127)
+            if value is proc:
+                nctx = call_procedure(ctx, proc, argc)
+            else:
+                ctx.push(value)
+                nctx = make_call(ctx, argc)
+
+            ctx.ip += 1
+            ctx = nctx
+            if ctx.form is form and ctx.env.locals is lvars:
+                pc = ctx.ip
+            else:
+                form = ctx.form
+                bc = ctx.bytecode
+                pc = ctx.ip
+                end = len(bc)
+                stack = ctx.stack
+                push = stack.append
+                pop = stack.pop
+                lvars = ctx.env.locals
+                if form is not None:
+                    literals = form.literals
+        elif opcode == 44: # lt2
+            b = pop()
+            a = pop()
+            if G[word >> 8 & 2047] is literals[word >> 19]:
+                push(not a >= b)
+            else:
+                push(ctx.vm.apply(G[word >> 8 & 2047], [a, b]))
+            pc += 1
+        elif opcode == 51: # call_global
+            push(G[word >> 8 & 2047])
+            ctx.ip = pc
+            argc = word >> 19
+            nctx = make_call(ctx, argc)
+
+            ctx.ip += 1
+            ctx = nctx
+            if ctx.form is form and ctx.env.locals is lvars:
+                pc = ctx.ip
+            else:
+                form = ctx.form
+                bc = ctx.bytecode
+                pc = ctx.ip
+                end = len(bc)
+                stack = ctx.stack
+                push = stack.append
+                pop = stack.pop
+                lvars = ctx.env.locals
+                if form is not None:
+                    literals = form.literals
+        elif opcode == 52: # tail_call_global
+            push(G[word >> 8 & 2047])
+            ctx.ip = pc
+            argc = word >> 19
+            ctx.ip += 1
+            nctx = make_call(ctx, argc, tail=True)
+            ctx = nctx
+            if ctx.form is form and ctx.env.locals is lvars:
+                pc = ctx.ip
+            else:
+                form = ctx.form
+                bc = ctx.bytecode
+                pc = ctx.ip
+                end = len(bc)
+                stack = ctx.stack
+                push = stack.append
+                pop = stack.pop
+                lvars = ctx.env.locals
+                if form is not None:
+                    literals = form.literals
+        elif opcode == 1: # call
+            ctx.ip = pc
+            argc = word >> 8
+            nctx = make_call(ctx, argc)
+
+            ctx.ip += 1
+            ctx = nctx
+            if ctx.form is form and ctx.env.locals is lvars:
+                pc = ctx.ip
+            else:
+                form = ctx.form
+                bc = ctx.bytecode
+                pc = ctx.ip
+                end = len(bc)
+                stack = ctx.stack
+                push = stack.append
+                pop = stack.pop
+                lvars = ctx.env.locals
+                if form is not None:
+                    literals = form.literals
+        elif opcode == 11: # push_literal
+            idx = word >> 8
+            lit = literals[idx]
+            push(lit)
+            pc += 1
+        elif opcode == 13: # push_1
+            push(1)
+            pc += 1
+        elif opcode == 2: # tail_call
+            ctx.ip = pc
+            argc = word >> 8
+            ctx.ip += 1
+            nctx = make_call(ctx, argc, tail=True)
+            ctx = nctx
+            if ctx.form is form and ctx.env.locals is lvars:
+                pc = ctx.ip
+            else:
+                form = ctx.form
+                bc = ctx.bytecode
+                pc = ctx.ip
+                end = len(bc)
+                stack = ctx.stack
+                push = stack.append
+                pop = stack.pop
+                lvars = ctx.env.locals
+                if form is not None:
+                    literals = form.literals
+        elif opcode == 3: # call_cc
+            ctx.ip = pc
+            cc = Continuation(ctx, 1, 1)
+            ctx.insert(-1, cc)
+
+            nctx = make_call(ctx, 1)
+            ctx.ip += 1
+            ctx = nctx
+            if ctx.form is form and ctx.env.locals is lvars:
+                pc = ctx.ip
+            else:
+                form = ctx.form
+                bc = ctx.bytecode
+                pc = ctx.ip
+                end = len(bc)
+                stack = ctx.stack
+                push = stack.append
+                pop = stack.pop
+                lvars = ctx.env.locals
+                if form is not None:
+                    literals = form.literals
+        elif opcode == 4: # pop
+            pop()
+            pc += 1
+        elif opcode == 7: # push_local_depth
+            depth = word >> 8 & 2047
+            idx = word >> 19
+
+            penv = ctx.env
+            while depth > 0:
+                penv = penv.parent
+                depth -= 1
+            loc = penv.locals[idx]
+            push(loc)
+            pc += 1
+        elif opcode == 8: # set_local_depth
+            depth = word >> 8 & 2047
+            idx = word >> 19
+            value = pop()
+
+            penv = ctx.env
+            while depth > 0:
+                penv = penv.parent
+                depth -= 1
+            penv.locals[idx] = value
+            pc += 1
+        elif opcode == 9: # push_global
+            push(G[word >> 8])
+            pc += 1
+        elif opcode == 10: # set_global
+            value = pop()
+            genv = ctx.vm.env
+            genv.locals[word >> 8] = value
+            genv.version += 1
+            pc += 1
+        elif opcode == 14: # push_nil
+            push(None)
+            pc += 1
+        elif opcode == 15: # push_true
+            push(True)
+            pc += 1
+        elif opcode == 16: # push_false
+            push(False)
+            pc += 1
+        elif opcode == 17: # dup
+            push(stack[-1])
+            pc += 1
+        elif opcode == 20: # push_folded
+            folded = literals[word >> 8 & 2047]
+            genv = ctx.vm.env
+            if folded.version == genv.version or folded.check(genv):
+                push(folded.value)
+                pc = word >> 19
+            else:
+                pc += 1
+        elif opcode == 21: # guard_inlined
+            guard = literals[word >> 8 & 2047]
+            genv = ctx.vm.env
+            if guard.version == genv.version or guard.check(genv):
+                pc += 1
+            else:
+                pc = word >> 19
+        elif opcode == 22: # goto_if_false
+            ip = word >> 8
+            cond = pop()
+            if cond is False:
+                pc = ip
+            else:
+                pc += 1
+        elif opcode == 23: # fix_lexical
+            proc = stack[-1]
+            proc.lexical_parent = ctx.env
+            ctx.env.captured = True
+            pc += 1
+        elif opcode == 24: # fix_lexical_pop
+            proc = pop()
+            proc.lexical_parent = ctx.env
+            ctx.env.captured = True
+            pc += 1
+        elif opcode == 25: # fix_lexical_depth
+            depth = word >> 8
+            proc = stack[-1]
+            env = ctx.env
+            while depth > 0:
+                env = env.parent
+                depth -= 1
+            proc.lexical_parent = env
+            env.captured = True
+            pc += 1
+        elif opcode == 26: # resume_trampoline
+            ctx.ip = pc
+            value = ctx.pop()
+            state = ctx.pop()
+            nctx = resume_trampoline(ctx, ctx.form.prim.resume(ctx.vm, state, value))
+            ctx = nctx
+            if ctx.form is form and ctx.env.locals is lvars:
+                pc = ctx.ip
+            else:
+                form = ctx.form
+                bc = ctx.bytecode
+                pc = ctx.ip
+                end = len(bc)
+                stack = ctx.stack
+                push = stack.append
+                pop = stack.pop
+                lvars = ctx.env.locals
+                if form is not None:
+                    literals = form.literals
+        elif opcode == 27: # dynamic_eval
+            ctx.ip = pc
+            dc = ctx.pop()
+            nctx = ctx.vm.frames.context(dc.form, dc.lexical_parent, ctx)
+
+            ctx.ip += 1
+            ctx = nctx
+            if ctx.form is form and ctx.env.locals is lvars:
+                pc = ctx.ip
+            else:
+                form = ctx.form
+                bc = ctx.bytecode
+                pc = ctx.ip
+                end = len(bc)
+                stack = ctx.stack
+                push = stack.append
+                pop = stack.pop
+                lvars = ctx.env.locals
+                if form is not None:
+                    literals = form.literals
+        elif opcode == 28: # dynamic_set_local
+            idx = word >> 8
+            sym_closure = pop()
+            value = pop()
+
+            env = sym_closure.lexical_parent
+            env.locals[idx] = value
+            pc += 1
+        elif opcode == 29: # dynamic_set_local_depth
+            depth = word >> 8 & 2047
+            idx = word >> 19
+            sym_closure = pop()
+            value = pop()
+
+            env = sym_closure.lexical_parent
+            while depth > 0:
+                env = env.parent
+                depth -= 1
+            env.locals[idx] = value
+            pc += 1
+        elif opcode == 30: # call_pop
+            ctx.ip = pc
+            argc = word >> 8 & 2047
+            nctx = make_call(ctx, argc)
+            if nctx is ctx:
+                # A primitive was called, drop its result and skip the pop.
+                # A call outside of tail position never releases ctx, so it
+                # can't come back as a recycled context.
+                ctx.pop()
+                ctx.ip = word >> 19
+            else:
+                ctx.ip += 1
+            ctx = nctx
+            if ctx.form is form and ctx.env.locals is lvars:
+                pc = ctx.ip
+            else:
+                form = ctx.form
+                bc = ctx.bytecode
+                pc = ctx.ip
+                end = len(bc)
+                stack = ctx.stack
+                push = stack.append
+                pop = stack.pop
+                lvars = ctx.env.locals
+                if form is not None:
+                    literals = form.literals
+        elif opcode == 33: # call_direct
+            ctx.ip = pc
+            proc = ctx.form.literals[word >> 8 & 127]
+            argc = word >> 15 & 127
+            freec = word >> 22
+            free = None
+            if freec > 0:
+                free = ctx.stack[-freec:]
+                ctx.pop_n(freec)
+            nctx = call_procedure(ctx, proc, argc, free=free)
+            ctx.ip += 1
+            ctx = nctx
+            if ctx.form is form and ctx.env.locals is lvars:
+                pc = ctx.ip
+            else:
+                form = ctx.form
+                bc = ctx.bytecode
+                pc = ctx.ip
+                end = len(bc)
+                stack = ctx.stack
+                push = stack.append
+                pop = stack.pop
+                lvars = ctx.env.locals
+                if form is not None:
+                    literals = form.literals
+        elif opcode == 34: # tail_call_direct
+            ctx.ip = pc
+            proc = ctx.form.literals[word >> 8 & 127]
+            argc = word >> 15 & 127
+            freec = word >> 22
+            free = None
+            if freec > 0:
+                free = ctx.stack[-freec:]
+                ctx.pop_n(freec)
+            ctx.ip += 1
+            nctx = call_procedure(ctx, proc, argc, tail=True, free=free)
+            ctx = nctx
+            if ctx.form is form and ctx.env.locals is lvars:
+                pc = ctx.ip
+            else:
+                form = ctx.form
+                bc = ctx.bytecode
+                pc = ctx.ip
+                end = len(bc)
+                stack = ctx.stack
+                push = stack.append
+                pop = stack.pop
+                lvars = ctx.env.locals
+                if form is not None:
+                    literals = form.literals
+        elif opcode == 36: # push_local_box
+            idx = word >> 8
+            box = lvars[idx]
+            push(box.value)
+            pc += 1
+        elif opcode == 37: # set_local_box
+            idx = word >> 8
+            box = lvars[idx]
+            box.value = pop()
+            pc += 1
+        elif opcode == 38: # box_local
+            idx = word >> 8
+            value = lvars[idx]
+            ctx.env.assign_local(idx, Box(value))
+            pc += 1
+        elif opcode == 39: # make_closure
+            ctx.ip = pc
+            argc = word >> 8
+            free = ctx.stack[-argc:]
+            ctx.pop_n(argc)
+            proc = pop()
+            push(Closure(proc, free))
+            pc += 1
+        elif opcode == 40: # extended_arg
+            pass
+            pc += 1
+        elif opcode == 45: # car
+            obj = pop()
+            if G[word >> 8 & 2047] is literals[word >> 19]:
+                if not isinstance(obj, Pair):
+                    type_check(obj, Pair)
+                push(obj.first)
+            else:
+                push(ctx.vm.apply(G[word >> 8 & 2047], [obj]))
+            pc += 1
+        elif opcode == 46: # cdr
+            obj = pop()
+            if G[word >> 8 & 2047] is literals[word >> 19]:
+                if not isinstance(obj, Pair):
+                    type_check(obj, Pair)
+                push(obj.rest)
+            else:
+                push(ctx.vm.apply(G[word >> 8 & 2047], [obj]))
+            pc += 1
+        elif opcode == 47: # cons
+            rest = pop()
+            first = pop()
+            if G[word >> 8 & 2047] is literals[word >> 19]:
+                push(Pair(first, rest))
+            else:
+                push(ctx.vm.apply(G[word >> 8 & 2047], [first, rest]))
+            pc += 1
+        elif opcode == 48: # nullp
+            obj = pop()
+            if G[word >> 8 & 2047] is literals[word >> 19]:
+                push(obj is None)
+            else:
+                push(ctx.vm.apply(G[word >> 8 & 2047], [obj]))
+            pc += 1
+        elif opcode == 49: # call_locals
+            idx = word >> 8 & 31
+            loc = lvars[idx]
+            push(loc)
+            idx = word >> 13 & 31
+            loc = lvars[idx]
+            push(loc)
+            push(G[word >> 18 & 31])
+            ctx.ip = pc
+            argc = word >> 23
+            nctx = make_call(ctx, argc)
+
+            ctx.ip += 1
+            ctx = nctx
+            if ctx.form is form and ctx.env.locals is lvars:
+                pc = ctx.ip
+            else:
+                form = ctx.form
+                bc = ctx.bytecode
+                pc = ctx.ip
+                end = len(bc)
+                stack = ctx.stack
+                push = stack.append
+                pop = stack.pop
+                lvars = ctx.env.locals
+                if form is not None:
+                    literals = form.literals
+        elif opcode == 50: # call_literal_global
+            idx = word >> 8 & 127
+            lit = literals[idx]
+            push(lit)
+            push(G[word >> 15 & 127])
+            ctx.ip = pc
+            argc = word >> 22
+            nctx = make_call(ctx, argc)
+
+            ctx.ip += 1
+            ctx = nctx
+            if ctx.form is form and ctx.env.locals is lvars:
+                pc = ctx.ip
+            else:
+                form = ctx.form
+                bc = ctx.bytecode
+                pc = ctx.ip
+                end = len(bc)
+                stack = ctx.stack
+                push = stack.append
+                pop = stack.pop
+                lvars = ctx.env.locals
+                if form is not None:
+                    literals = form.literals
+        elif opcode == 56: # dup_set_local
+            push(stack[-1])
+            idx = word >> 8
+            val = pop()
+            lvars[idx] = val
+            pc += 1
+        else:
+            ctx.ip = pc
+            opcode &= OPCODE_MASK
+            nctx = INSN_ACTION[opcode](ctx)
+            if not has_tag(opcode, TAG_CTX_SWITCH):
+                pc = ctx.ip
+            else:
+                ctx = nctx
+                if ctx.form is form and ctx.env.locals is lvars:
+                    pc = ctx.ip
+                else:
+                    form = ctx.form
+                    bc = ctx.bytecode
+                    pc = ctx.ip
+                    end = len(bc)
+                    stack = ctx.stack
+                    push = stack.append
+                    pop = stack.pop
+                    lvars = ctx.env.locals
+                    if form is not None:
+                        literals = form.literals
+    ctx.ip = pc
+    return ctx.pop()
+
+def closure_ret(form, at):
+    "Return from a procedure. The return value is left on the stack for the caller."
+    def op(ctx):
+        ctx.ip = at
+        pctx = ctx.parent
+        ctx.vm.frames.release(ctx)
+        return pctx
+    return op
+
+def closure_call(form, at, p1):
+    "Call a procedure."
+    next_ip = at + 1
+    def op(ctx):
+        ctx.ip = at
+        argc = p1
+        nctx = make_call(ctx, argc)
+
+        ctx.ip = next_ip
+        return nctx
+    return op
+
+def closure_tail_call(form, at, p1):
+    "Call a procedure with tail-call."
+    next_ip = at + 1
+    def op(ctx):
+        ctx.ip = at
+        argc = p1
+        ctx.ip = next_ip
+        nctx = make_call(ctx, argc, tail=True)
+        return nctx
+    return op
+
+def closure_call_cc(form, at):
+    "Call with current continuation."
+    next_ip = at + 1
+    def op(ctx):
+        ctx.ip = at
+        cc = Continuation(ctx, 1, 1)
+        ctx.insert(-1, cc)
+
+        nctx = make_call(ctx, 1)
+        ctx.ip = next_ip
+        return nctx
+    return op
+
+def closure_pop(form, at):
+    "Pop the value off from the operand stack."
+    def op(ctx):
+        ctx.stack.pop()
+    return op
+
+def closure_push_local(form, at, p1):
+    "Push value of a local variable to operand stack."
+    def op(ctx):
+        idx = p1
+        loc = ctx.env.locals[idx]
+        ctx.stack.append(loc)
+    return op
+
+def closure_set_local(form, at, p1):
+    "Pop the stack top and assign it to a local variable."
+    def op(ctx):
+        idx = p1
+        val = ctx.stack.pop()
+        ctx.env.locals[idx] = val
+    return op
+
+def closure_push_local_depth(form, at, p1, p2):
+    "Push value of a local in lexical parent to operand stack."
+    def op(ctx):
+        depth = p1
+        idx = p2
+
+        penv = ctx.env
+        while depth > 0:
+            penv = penv.parent
+            depth -= 1
+        loc = penv.locals[idx]
+        ctx.stack.append(loc)
+    return op
+
+def closure_set_local_depth(form, at, p1, p2):
+    "Pop a value and assign to a local variable of lexical parent."
+    def op(ctx):
+        depth = p1
+        idx = p2
+        value = ctx.stack.pop()
+
+        penv = ctx.env
+        while depth > 0:
+            penv = penv.parent
+            depth -= 1
+        penv.locals[idx] = value
+    return op
+
+def closure_push_global(form, at, p1):
+    "Push value of a variable of the global environment to operand stack."
+    def op(ctx):
+        ctx.stack.append(ctx.vm.env.locals[p1])
+    return op
+
+def closure_set_global(form, at, p1):
+    "Pop a value and assign to a variable of the global environment."
+    def op(ctx):
+        value = ctx.stack.pop()
+        genv = ctx.vm.env
+        genv.locals[p1] = value
+        genv.version += 1
+    return op
+
+def closure_push_literal(form, at, p1):
+    "Push a literal to operand stack."
+    literals = form.literals
+    def op(ctx):
+        idx = p1
+        lit = literals[idx]
+        ctx.stack.append(lit)
+    return op
+
+def closure_push_0(form, at):
+    "Push 0 to operand stack."
+    def op(ctx):
+        ctx.stack.append(0)
+    return op
+
+def closure_push_1(form, at):
+    "Push 1 to operand stack."
+    def op(ctx):
+        ctx.stack.append(1)
+    return op
+
+def closure_push_nil(form, at):
+    "Push None to oeprand stack."
+    def op(ctx):
+        ctx.stack.append(None)
+    return op
+
+def closure_push_true(form, at):
+    "Push True to oeprand stack."
+    def op(ctx):
+        ctx.stack.append(True)
+    return op
+
+def closure_push_false(form, at):
+    "Push False to oeprand stack."
+    def op(ctx):
+        ctx.stack.append(False)
+    return op
+
+def closure_dup(form, at):
+    "Duplicate the stack top object."
+    def op(ctx):
+        ctx.stack.append(ctx.stack[-1])
+    return op
+
+def closure_goto(form, at, p1):
+    "Unconditional jump. Backward jumps are counted for the JIT."
+    def op(ctx):
+        ip = p1
+        if ip <= ctx.ip:
+            ctx.form.backedges += 1
+        ctx.ip = ip
+        return ctx
+    return op
+
+def closure_goto_if_not_false(form, at, p1):
+    "Jump if the stack top is not False."
+    next_ip = at + 1
+    def op(ctx):
+        ip = p1
+        cond = ctx.stack.pop()
+        if cond is not False:
+            ctx.ip = ip
+        else:
+            ctx.ip = next_ip
+        return ctx
+    return op
+
+def closure_push_folded(form, at, p1, p2):
+    "Push the value of a call folded at compile time and jump to ip, if the primitives it calls are still bound to their globals (see Folded). Else the code of the call follows."
+    literals = form.literals
+    next_ip = at + 1
+    def op(ctx):
+        folded = literals[p1]
+        genv = ctx.vm.env
+        if folded.version == genv.version or folded.check(genv):
+            ctx.stack.append(folded.value)
+            ctx.ip = p2
+        else:
+            ctx.ip = next_ip
+        return ctx
+    return op
+
+def closure_guard_inlined(form, at, p1, p2):
+    "Fall through to the body of a procedure inlined at compile time if the global it was called by is still bound to it (see Guard). Else jump to ip, where the call of the procedure follows."
+    literals = form.literals
+    next_ip = at + 1
+    def op(ctx):
+        guard = literals[p1]
+        genv = ctx.vm.env
+        if guard.version == genv.version or guard.check(genv):
+            ctx.ip = next_ip
+        else:
+            ctx.ip = p2
+        return ctx
+    return op
+
+def closure_goto_if_false(form, at, p1):
+    "Jump if the stack top is False."
+    next_ip = at + 1
+    def op(ctx):
+        ip = p1
+        cond = ctx.stack.pop()
+        if cond is False:
+            ctx.ip = ip
+        else:
+            ctx.ip = next_ip
+        return ctx
+    return op
+
+def closure_fix_lexical(form, at):
+    "Fix the lexical_parent of an object."
+    def op(ctx):
+        proc = ctx.stack[-1]
+        proc.lexical_parent = ctx.env
+        ctx.env.captured = True
+    return op
+
+def closure_fix_lexical_pop(form, at):
+    "Like fix_literal, but pop the object off after fixing."
+    def op(ctx):
+        proc = ctx.stack.pop()
+        proc.lexical_parent = ctx.env
+        ctx.env.captured = True
+    return op
+
+def closure_fix_lexical_depth(form, at, p1):
+    "Fix the lexical_parent of an object."
+    def op(ctx):
+        depth = p1
+        proc = ctx.stack[-1]
+        env = ctx.env
+        while depth > 0:
+            env = env.parent
+            depth -= 1
+        proc.lexical_parent = env
+        env.captured = True
+    return op
+
+def closure_resume_trampoline(form, at):
+    "Resume a PyTrampoline with its state and the result of the procedure it called, see TrampolineForm."
+    def op(ctx):
+        ctx.ip = at
+        value = ctx.stack.pop()
+        state = ctx.stack.pop()
+        nctx = resume_trampoline(ctx, ctx.form.prim.resume(ctx.vm, state, value))
+        return nctx
+    return op
+
+def closure_dynamic_eval(form, at):
+    "Evaluate a DynamicClosure and push the result. Its form returns to the next instruction."
+    next_ip = at + 1
+    def op(ctx):
+        ctx.ip = at
+        dc = ctx.stack.pop()
+        nctx = ctx.vm.frames.context(dc.form, dc.lexical_parent, ctx)
+
+        ctx.ip = next_ip
+        return nctx
+    return op
+
+def closure_dynamic_set_local(form, at, p1):
+    "Assignment of SymbolClosure."
+    def op(ctx):
+        idx = p1
+        sym_closure = ctx.stack.pop()
+        value = ctx.stack.pop()
+
+        env = sym_closure.lexical_parent
+        env.locals[idx] = value
+    return op
+
+def closure_dynamic_set_local_depth(form, at, p1, p2):
+    "Assignment of SymbolClosure."
+    def op(ctx):
+        depth = p1
+        idx = p2
+        sym_closure = ctx.stack.pop()
+        value = ctx.stack.pop()
+
+        env = sym_closure.lexical_parent
+        while depth > 0:
+            env = env.parent
+            depth -= 1
+        env.locals[idx] = value
+    return op
+
+def closure_call_pop(form, at, p1, p2):
+    "Call a procedure and drop its result. Followed by a pop that is skipped (jumping to ip) if a primitive was called."
+    next_ip = at + 1
+    def op(ctx):
+        ctx.ip = at
+        argc = p1
+        nctx = make_call(ctx, argc)
+        if nctx is ctx:
+            # A primitive was called, drop its result and skip the pop.
+            # A call outside of tail position never releases ctx, so it
+            # can't come back as a recycled context.
+            ctx.stack.pop()
+            ctx.ip = p2
+        else:
+            ctx.ip = next_ip
+        return nctx
+    return op
+
+def closure_call_known(form, at, p1, p2, p3):
+    "Call the procedure proc, known at compile time to be the value of the global variable local, if it still is. Otherwise call the value of the global."
+    literals = form.literals
+    next_ip = at + 1
+    def op(ctx):
+        ctx.ip = at
+        argc = p2
+        proc = literals[p3]
+        value = ctx.vm.env.locals[p1]
+        if value is proc:
+            nctx = call_procedure(ctx, proc, argc)
+        else:
+            ctx.stack.append(value)
+            nctx = make_call(ctx, argc)
+
+        ctx.ip = next_ip
+        return nctx
+    return op
+
+def closure_tail_call_known(form, at, p1, p2, p3):
+    "Like call_known, but with tail-call."
+    literals = form.literals
+    next_ip = at + 1
+    def op(ctx):
+        ctx.ip = at
+        argc = p2
+        proc = literals[p3]
+        value = ctx.vm.env.locals[p1]
+        ctx.ip = next_ip
+        if value is proc:
+            nctx = call_procedure(ctx, proc, argc, tail=True)
+        else:
+            ctx.stack.append(value)
+            nctx = make_call(ctx, argc, tail=True)
+        return nctx
+    return op
+
+def closure_call_direct(form, at, p1, p2, p3):
+    "Call the procedure proc, created for a lambda that is only called right there (see compiler/freevars.py), with the argc arguments on the stack below the values of its freec free variables. No closure is made."
+    literals = form.literals
+    next_ip = at + 1
+    def op(ctx):
+        ctx.ip = at
+        proc = literals[p1]
+        argc = p2
+        freec = p3
+        free = None
+        if freec > 0:
+            free = ctx.stack[-freec:]
+            ctx.pop_n(freec)
+        nctx = call_procedure(ctx, proc, argc, free=free)
+        ctx.ip = next_ip
+        return nctx
+    return op
+
+def closure_tail_call_direct(form, at, p1, p2, p3):
+    "Like call_direct, but with tail-call."
+    literals = form.literals
+    next_ip = at + 1
+    def op(ctx):
+        ctx.ip = at
+        proc = literals[p1]
+        argc = p2
+        freec = p3
+        free = None
+        if freec > 0:
+            free = ctx.stack[-freec:]
+            ctx.pop_n(freec)
+        ctx.ip = next_ip
+        nctx = call_procedure(ctx, proc, argc, tail=True, free=free)
+        return nctx
+    return op
+
+def closure_tail_call_self(form, at, p1, p2):
+    "Like tail_call_known, for a procedure calling itself. The arguments are rebound in the frame of the call, which runs again from its start."
+    next_ip = at + 1
+    def op(ctx):
+        ctx.ip = at
+        argc = p2
+        proc = ctx.form
+        value = ctx.vm.env.locals[p1]
+        ctx.ip = next_ip
+        if value is proc:
+            nctx = call_procedure(ctx, proc, argc, tail=True)
+        else:
+            ctx.stack.append(value)
+            nctx = make_call(ctx, argc, tail=True)
+        return nctx
+    return op
+
+def closure_push_local_box(form, at, p1):
+    "Push the value of a boxed local variable."
+    def op(ctx):
+        idx = p1
+        box = ctx.env.locals[idx]
+        ctx.stack.append(box.value)
+    return op
+
+def closure_set_local_box(form, at, p1):
+    "Pop the stack top and assign it to a boxed local variable."
+    def op(ctx):
+        idx = p1
+        box = ctx.env.locals[idx]
+        box.value = ctx.stack.pop()
+    return op
+
+def closure_box_local(form, at, p1):
+    "Put the value of a local variable captured by closures and assigned in a box."
+    def op(ctx):
+        idx = p1
+        value = ctx.env.locals[idx]
+        ctx.env.assign_local(idx, Box(value))
+    return op
+
+def closure_make_closure(form, at, p1):
+    "Make a closure of a procedure and the values of its free variables."
+    def op(ctx):
+        argc = p1
+        free = ctx.stack[-argc:]
+        ctx.pop_n(argc)
+        proc = ctx.stack.pop()
+        ctx.stack.append(Closure(proc, free))
+    return op
+
+def closure_extended_arg(form, at):
+    "Hold the high bits of the operands of the next instruction, which are too large for its word (see decode_operands in iset.py). Does nothing when run."
+    def op(ctx):
+        pass
+    return op
+
+def closure_add2(form, at, p1, p2):
+    "Add two numbers, like the + primitive."
+    literals = form.literals
+    def op(ctx):
+        b = ctx.stack.pop()
+        a = ctx.stack.pop()
+        if ctx.vm.env.locals[p1] is literals[p2]:
+            try:
+                ctx.stack.append(0 + a + b)
+            except TypeError, e:
+                raise WrongArgType(e.message)
+        else:
+            ctx.stack.append(ctx.vm.apply(ctx.vm.env.locals[p1], [a, b]))
+    return op
+
+def closure_sub2(form, at, p1, p2):
+    "Subtract two numbers, like the - primitive."
+    literals = form.literals
+    def op(ctx):
+        b = ctx.stack.pop()
+        a = ctx.stack.pop()
+        if ctx.vm.env.locals[p1] is literals[p2]:
+            try:
+                ctx.stack.append(a - b)
+            except TypeError, e:
+                raise WrongArgType(e.message)
+        else:
+            ctx.stack.append(ctx.vm.apply(ctx.vm.env.locals[p1], [a, b]))
+    return op
+
+def closure_numeq2(form, at, p1, p2):
+    "Compare two numbers, like the = primitive."
+    literals = form.literals
+    def op(ctx):
+        b = ctx.stack.pop()
+        a = ctx.stack.pop()
+        if ctx.vm.env.locals[p1] is literals[p2]:
+            type_check(a, (int, long, float, complex))
+            type_check(b, (int, long, float, complex))
+            ctx.stack.append(a == b)
+        else:
+            ctx.stack.append(ctx.vm.apply(ctx.vm.env.locals[p1], [a, b]))
+    return op
+
+def closure_lt2(form, at, p1, p2):
+    "Compare two numbers, like the < primitive."
+    literals = form.literals
+    def op(ctx):
+        b = ctx.stack.pop()
+        a = ctx.stack.pop()
+        if ctx.vm.env.locals[p1] is literals[p2]:
+            ctx.stack.append(not a >= b)
+        else:
+            ctx.stack.append(ctx.vm.apply(ctx.vm.env.locals[p1], [a, b]))
+    return op
+
+def closure_car(form, at, p1, p2):
+    "The first element of a pair, like the car primitive."
+    literals = form.literals
+    def op(ctx):
+        obj = ctx.stack.pop()
+        if ctx.vm.env.locals[p1] is literals[p2]:
+            if not isinstance(obj, Pair):
+                type_check(obj, Pair)
+            ctx.stack.append(obj.first)
+        else:
+            ctx.stack.append(ctx.vm.apply(ctx.vm.env.locals[p1], [obj]))
+    return op
+
+def closure_cdr(form, at, p1, p2):
+    "The rest of a pair, like the cdr primitive."
+    literals = form.literals
+    def op(ctx):
+        obj = ctx.stack.pop()
+        if ctx.vm.env.locals[p1] is literals[p2]:
+            if not isinstance(obj, Pair):
+                type_check(obj, Pair)
+            ctx.stack.append(obj.rest)
+        else:
+            ctx.stack.append(ctx.vm.apply(ctx.vm.env.locals[p1], [obj]))
+    return op
+
+def closure_cons(form, at, p1, p2):
+    "Make a pair, like the cons primitive."
+    literals = form.literals
+    def op(ctx):
+        rest = ctx.stack.pop()
+        first = ctx.stack.pop()
+        if ctx.vm.env.locals[p1] is literals[p2]:
+            ctx.stack.append(Pair(first, rest))
+        else:
+            ctx.stack.append(ctx.vm.apply(ctx.vm.env.locals[p1], [first, rest]))
+    return op
+
+def closure_nullp(form, at, p1, p2):
+    "Whether an object is the empty list, like the null? primitive."
+    literals = form.literals
+    def op(ctx):
+        obj = ctx.stack.pop()
+        if ctx.vm.env.locals[p1] is literals[p2]:
+            ctx.stack.append(obj is None)
+        else:
+            ctx.stack.append(ctx.vm.apply(ctx.vm.env.locals[p1], [obj]))
+    return op
+
+def closure_call_locals(form, at, p1, p2, p3, p4):
+    "Call a global procedure with two local arguments."
+    next_ip = at + 1
+    def op(ctx):
+        ctx.ip = at
+        idx = p1
+        loc = ctx.env.locals[idx]
+        ctx.stack.append(loc)
+        idx = p2
+        loc = ctx.env.locals[idx]
+        ctx.stack.append(loc)
+        ctx.stack.append(ctx.vm.env.locals[p3])
+        argc = p4
+        nctx = make_call(ctx, argc)
+
+        ctx.ip = next_ip
+        return nctx
+    return op
+
+def closure_call_literal_global(form, at, p1, p2, p3):
+    "Call a global procedure with a literal argument."
+    literals = form.literals
+    next_ip = at + 1
+    def op(ctx):
+        ctx.ip = at
+        idx = p1
+        lit = literals[idx]
+        ctx.stack.append(lit)
+        ctx.stack.append(ctx.vm.env.locals[p2])
+        argc = p3
+        nctx = make_call(ctx, argc)
+
+        ctx.ip = next_ip
+        return nctx
+    return op
+
+def closure_call_global(form, at, p1, p2):
+    "Call a global procedure."
+    next_ip = at + 1
+    def op(ctx):
+        ctx.ip = at
+        ctx.stack.append(ctx.vm.env.locals[p1])
+        argc = p2
+        nctx = make_call(ctx, argc)
+
+        ctx.ip = next_ip
+        return nctx
+    return op
+
+def closure_tail_call_global(form, at, p1, p2):
+    "Tail-call a global procedure."
+    next_ip = at + 1
+    def op(ctx):
+        ctx.ip = at
+        ctx.stack.append(ctx.vm.env.locals[p1])
+        argc = p2
+        ctx.ip = next_ip
+        nctx = make_call(ctx, argc, tail=True)
+        return nctx
+    return op
+
+def closure_push_local_local(form, at, p1, p2):
+    "Push the values of two local variables."
+    def op(ctx):
+        idx = p1
+        loc = ctx.env.locals[idx]
+        ctx.stack.append(loc)
+        idx = p2
+        loc = ctx.env.locals[idx]
+        ctx.stack.append(loc)
+    return op
+
+def closure_push_local_literal(form, at, p1, p2):
+    "Push the value of a local variable and a literal."
+    literals = form.literals
+    def op(ctx):
+        idx = p1
+        loc = ctx.env.locals[idx]
+        ctx.stack.append(loc)
+        idx = p2
+        lit = literals[idx]
+        ctx.stack.append(lit)
+    return op
+
+def closure_push_local_1(form, at, p1):
+    "Push the value of a local variable and 1."
+    def op(ctx):
+        idx = p1
+        loc = ctx.env.locals[idx]
+        ctx.stack.append(loc)
+        ctx.stack.append(1)
+    return op
+
+def closure_dup_set_local(form, at, p1):
+    "Assign the stack top to a local variable, keeping it."
+    def op(ctx):
+        ctx.stack.append(ctx.stack[-1])
+        idx = p1
+        val = ctx.stack.pop()
+        ctx.env.locals[idx] = val
+    return op
+
+
+CLOSURE_FACTORY = [
+    closure_ret,
+    closure_call,
+    closure_tail_call,
+    closure_call_cc,
+    closure_pop,
+    closure_push_local,
+    closure_set_local,
+    closure_push_local_depth,
+    closure_set_local_depth,
+    closure_push_global,
+    closure_set_global,
+    closure_push_literal,
+    closure_push_0,
+    closure_push_1,
+    closure_push_nil,
+    closure_push_true,
+    closure_push_false,
+    closure_dup,
+    closure_goto,
+    closure_goto_if_not_false,
+    closure_push_folded,
+    closure_guard_inlined,
+    closure_goto_if_false,
+    closure_fix_lexical,
+    closure_fix_lexical_pop,
+    closure_fix_lexical_depth,
+    closure_resume_trampoline,
+    closure_dynamic_eval,
+    closure_dynamic_set_local,
+    closure_dynamic_set_local_depth,
+    closure_call_pop,
+    closure_call_known,
+    closure_tail_call_known,
+    closure_call_direct,
+    closure_tail_call_direct,
+    closure_tail_call_self,
+    closure_push_local_box,
+    closure_set_local_box,
+    closure_box_local,
+    closure_make_closure,
+    closure_extended_arg,
+    closure_add2,
+    closure_sub2,
+    closure_numeq2,
+    closure_lt2,
+    closure_car,
+    closure_cdr,
+    closure_cons,
+    closure_nullp,
+    closure_call_locals,
+    closure_call_literal_global,
+    closure_call_global,
+    closure_tail_call_global,
+    closure_push_local_local,
+    closure_push_local_literal,
+    closure_push_local_1,
+    closure_dup_set_local
+]
+
+
+def make_block(ops, last, next_ip):
+    """\
+    Make the closure running a basic block: ops are the closures of the
+    straight-line instructions, last the closure of the control flow
+    instruction ending the block (None if the block falls through to
+    next_ip).
+    """
+    if last is None:
+        def block(ctx):
+            for op in ops:
+                op(ctx)
+            ctx.ip = next_ip
+            return ctx
+    elif len(ops) == 0:
+        block = last
+    else:
+        def block(ctx):
+            for op in ops:
+                op(ctx)
+            return last(ctx)
+    return block
+
+def translate_closures(form):
+    """\
+    Translate the bytecode of a Form or Procedure into basic block
+    closures. Return a list indexed by ip, holding the closure of the
+    block starting at that ip (None elsewhere).
+    """
+    bytecode = form.bytecode
+
+    # Blocks start at jump targets and after control flow instructions,
+    # so every ip a context can be resumed at begins a block.
+    insns = decode(bytecode)
+    starts = set([0, len(bytecode)])
+    for ip, insn, operands in insns:
+        for name, val in zip(insn.operands, operands):
+            if name == 'ip':
+                starts.add(val)
+        if TAG_CTRL_FLOW & INSN_TAGS[insn.opcode]:
+            starts.add(ip+1)
+
+    code = [None] * len(bytecode)
+    ops = []
+    start = 0
+    for ip, insn, operands in insns:
+        op = CLOSURE_FACTORY[insn.opcode](form, ip, *operands)
+        ip += 1
+        if TAG_CTRL_FLOW & INSN_TAGS[insn.opcode]:
+            code[start] = make_block(ops, op, ip)
+        else:
+            ops.append(op)
+            if ip not in starts:
+                continue
+            code[start] = make_block(ops, None, ip)
+        ops = []
+        start = ip
+    return code
+
+def closures_of(ctx):
+    "Get the block closures of the form run by ctx, translating it once."
+    form = ctx.form
+    if form is None:
+        return ()
+    if form.closures is None:
+        form.closures = translate_closures(form)
+    return form.closures
+
+def run_closure(ctx):
+    """\
+    Closure run loop: the form is translated once into a tree of
+    closures with pre-bound operands, then run one basic block per
+    iteration.
+    """
+    form = ctx.form
+    code = closures_of(ctx)
+    while ctx.ip < len(ctx.bytecode):
+        ctx = code[ctx.ip](ctx)
+        # the closures only depend on the form, a recycled context may
+        # be the same object running another one
+        if ctx.form is not form:
+            form = ctx.form
+            code = closures_of(ctx)
+    return ctx.pop()
+
+# Available run loops, selected by name with VM(engine=...)
+ENGINES = {
+    'table' : run_table,
+    'fused' : run_fused,
+    'closure' : run_closure
+    }
+
+DEFAULT_ENGINE = 'fused'
+
+run = ENGINES[DEFAULT_ENGINE]
+
+# Call a Procedure with the argc arguments on top of the stack, whose
+# arity is already checked. free are the values of the free variables
+# if the procedure is called as a Closure. A procedure tail-calling
+# itself reuses its context and environment, unless they are captured.
+def call_procedure(ctx, proc, argc, tail=False, free=None):
+    stack = ctx.stack
+    # the arguments are stack[base:]
+    base = len(stack)-argc
+    proc.calls += 1
+    frames = ctx.vm.frames
+    fixed_argc = proc.fixed_argc
+    if tail and proc is ctx.form and not ctx.captured and not ctx.env.captured:
+        env = ctx.env
+        if len(env.locals) > fixed_argc:
+            env.locals[:] = proc.env.locals
+        nctx = ctx
+    else:
+        env = frames.env(proc)
+        nctx = None
+
+    env.locals[:fixed_argc] = stack[base:base+fixed_argc]
+    if fixed_argc != proc.argc:
+        rest = None
+        for i in range(len(stack)-1, base+fixed_argc-1, -1):
+            rest = Pair(stack[i], rest)
+        env.locals[fixed_argc] = rest
+    if free is not None:
+        env.locals[-len(free):] = free
+    # the frame of the callee starts where the arguments were
+    del stack[base:]
+    if nctx is not None:
+        nctx.ip = 0
+    elif tail:
+        nctx = frames.context(proc, env, ctx.parent)
+        frames.release(ctx)
+    else:
+        nctx = frames.context(proc, env, ctx)
+    return nctx
+
+# Call a PyTrampoline with the argc arguments on top of the stack. It
+# runs in a context of its own, which calls the procedures it requests
+# and resumes it with their results, see resume_trampoline.
+def call_trampoline(ctx, prim, argc, tail=False):
+    stack = ctx.stack
+    base = len(stack)-argc
+    args = stack[base:]
+    del stack[base:]
+    frames = ctx.vm.frames
+    form = prim.form
+    if form is None:
+        form = prim.form = TrampolineForm(prim)
+    request = prim.proc(ctx.vm, *args)
+    if not tail:
+        nctx = frames.context(form, ctx.vm.env, ctx)
+        return resume_trampoline(nctx, request)
+    # The caller is only released once the context of the trampoline
+    # has taken over, or the first procedure it calls would get it
+    # back from the pool.
+    nctx = frames.context(form, ctx.vm.env, ctx.parent)
+    nctx = resume_trampoline(nctx, request)
+    frames.release(ctx)
+    return nctx
+
+# Run what a PyTrampoline requested in its context ctx: call a
+# procedure, or return a value. The state of the primitive is left in
+# the frame of ctx under the arguments, so that a continuation captured
+# by the procedure saves it with the stack.
+def resume_trampoline(ctx, request):
+    proc, value, state = request
+    if proc is None:
+        ctx.stack.append(value)
+        parent = ctx.parent
+        ctx.vm.frames.release(ctx)
+        return parent
+    ctx.stack.append(state)
+    ctx.stack.extend(value)
+    ctx.stack.append(proc)
+    return make_call(ctx, len(value))
+
 def make_call(ctx, argc, tail=False):
-    proc = ctx.pop()
+    stack = ctx.stack
+    proc = stack.pop()
+    free = None
+    if isinstance(proc, Closure):
+        free = proc.free
+        proc = proc.proc
     if tail:
         parent = ctx.parent
     else:
         parent = ctx
+    # the arguments are stack[base:]
+    base = len(stack)-argc
 
     if isinstance(proc, Procedure):
         proc.check_arity(argc)
-        nctx = Context(proc, proc.env.dup(), parent)
-
-        for i in range(proc.fixed_argc):
-            nctx.env.assign_local(i, ctx.top(idx=argc-i))
-        if proc.fixed_argc != proc.argc:
-            rest = None
-            for i in range(argc-proc.fixed_argc):
-                rest = Pair(ctx.top(idx=i+1), rest)
-            nctx.env.assign_local(proc.fixed_argc, rest)
-        ctx.pop_n(argc)
+        nctx = call_procedure(ctx, proc, argc, tail, free)
 
     elif isinstance(proc, Primitive):
         proc.check_arity(argc)
-        args = range(argc)
-        for i in range(argc):
-            args[i] = ctx.top(idx=argc-i)
-        ctx.pop_n(argc)
+        if isinstance(proc, Apply):
+            # call the procedure given to apply in this run loop
+            func = stack[base]
+            args = apply_arguments(stack[base+1:])
+            del stack[base:]
+            stack.extend(args)
+            stack.append(func)
+            return make_call(ctx, len(args), tail)
+        if isinstance(proc, PyTrampoline):
+            return call_trampoline(ctx, proc, argc, tail)
+
+        args = stack[base:]
+        del stack[base:]
 
         nctx = parent
-        nctx.push(proc.call(ctx.vm, *args))
+        stack.append(proc.call(ctx.vm, *args))
+        if tail:
+            ctx.vm.frames.release(ctx)
 
     elif isinstance(proc, Continuation):
         if argc > 1:
             raise WrongArgNumber("Continuation only accept 1 argument")
-        nctx = proc.ctx.clone()
         if argc == 1:
-            nctx.push(ctx.pop())
+            value = stack.pop()
         else:
-            nctx.push(None)
-        nctx.parent = ctx.parent
+            value = None
+        stack[:] = proc.stack
+        nctx = proc.resume()
+        stack.append(value)
 
     else:
         raise WrongArgType("Not a skime callable: %s" % proc)
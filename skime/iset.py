@@ -0,0 +1,672 @@
+# Don't edit this file. This is generated by iset_gen.py
+
+class Instruction(object):
+    __slots__ = ('opcode',
+                 'name',
+                 'tags',
+                 'desc',
+                 'operands',
+                 'stack_before',
+                 'stack_after',
+                 'code',
+                 'fuses')
+    def __init__(self, opcode, name, tags, desc, operands,
+                 stack_before, stack_after, code, fuses):
+        self.opcode = opcode
+        self.name = name
+        self.tags = tags
+        self.desc = desc
+        self.operands = operands
+        self.stack_before = stack_before
+        self.stack_after = stack_after
+        self.code = code
+        # Names of the instructions a superinstruction fuses
+        self.fuses = fuses
+
+    def length_get(self):
+        return 1
+    def length_set(self):
+        raise AttributeError, 'length attribute is read only'
+    length = property(length_get, length_set,
+                      'length of the instruction in words, without extended_arg words')
+
+INSTRUCTIONS = [
+Instruction(0,
+            'ret',
+            ['ctx_switch', 'ctrl_flow'],
+            'Return from a procedure. The return value is left on the stack for the caller.',
+            [],
+            ['retval'],
+            ['retval'],
+            'pctx = ctx.parent\nctx.vm.frames.release(ctx)\nreturn pctx\n',
+            []),
+Instruction(1,
+            'call',
+            ['ctx_switch', 'ctrl_flow'],
+            'Call a procedure.',
+            ['argc'],
+            ['...', 'proc'],
+            ['retval'],
+            'argc = get_param(ctx, 1)\nnctx = make_call(ctx, argc)\n\nctx.ip += $(insn_len)\nreturn nctx\n',
+            []),
+Instruction(2,
+            'tail_call',
+            ['ctx_switch', 'ctrl_flow'],
+            'Call a procedure with tail-call.',
+            ['argc'],
+            ['...', 'proc'],
+            ['retval'],
+            'argc = get_param(ctx, 1)\nctx.ip += $(insn_len)\nnctx = make_call(ctx, argc, tail=True)\nreturn nctx\n',
+            []),
+Instruction(3,
+            'call_cc',
+            ['ctx_switch', 'ctrl_flow'],
+            'Call with current continuation.',
+            [],
+            ['lambda'],
+            ['return_value'],
+            'cc = Continuation(ctx, $(insn_len), 1)\nctx.insert(-1, cc)\n\nnctx = make_call(ctx, 1)\nctx.ip += $(insn_len)\nreturn nctx\n',
+            []),
+Instruction(4,
+            'pop',
+            [],
+            'Pop the value off from the operand stack.',
+            [],
+            ['value'],
+            [],
+            'ctx.pop()\n',
+            []),
+Instruction(5,
+            'push_local',
+            [],
+            'Push value of a local variable to operand stack.',
+            ['local'],
+            [],
+            ['value'],
+            'idx = get_param(ctx, 1)\nloc = ctx.env.read_local(idx)\nctx.push(loc)\n',
+            []),
+Instruction(6,
+            'set_local',
+            [],
+            'Pop the stack top and assign it to a local variable.',
+            ['local'],
+            ['value'],
+            [],
+            'idx = get_param(ctx, 1)\nval = ctx.pop()\nctx.env.assign_local(idx, val)\n',
+            []),
+Instruction(7,
+            'push_local_depth',
+            [],
+            'Push value of a local in lexical parent to operand stack.',
+            ['depth', 'local'],
+            [],
+            ['value'],
+            'depth = get_param(ctx, 1)\nidx = get_param(ctx, 2)\n\npenv = ctx.env\nwhile depth > 0:\n    penv = penv.parent\n    depth -= 1\nloc = penv.read_local(idx)\nctx.push(loc)\n',
+            []),
+Instruction(8,
+            'set_local_depth',
+            [],
+            'Pop a value and assign to a local variable of lexical parent.',
+            ['depth', 'local'],
+            ['value'],
+            [],
+            'depth = get_param(ctx, 1)\nidx = get_param(ctx, 2)\nvalue = ctx.pop()\n\npenv = ctx.env\nwhile depth > 0:\n    penv = penv.parent\n    depth -= 1\npenv.assign_local(idx, value)\n',
+            []),
+Instruction(9,
+            'push_global',
+            [],
+            'Push value of a variable of the global environment to operand stack.',
+            ['local'],
+            [],
+            ['value'],
+            'ctx.push(ctx.vm.env.read_local(get_param(ctx, 1)))\n',
+            []),
+Instruction(10,
+            'set_global',
+            [],
+            'Pop a value and assign to a variable of the global environment.',
+            ['local'],
+            ['value'],
+            [],
+            'value = ctx.pop()\ngenv = ctx.vm.env\ngenv.assign_local(get_param(ctx, 1), value)\ngenv.version += 1\n',
+            []),
+Instruction(11,
+            'push_literal',
+            [],
+            'Push a literal to operand stack.',
+            ['literal'],
+            [],
+            ['value'],
+            'idx = get_param(ctx, 1)\nlit = ctx.form.literals[idx]\nctx.push(lit)\n',
+            []),
+Instruction(12,
+            'push_0',
+            [],
+            'Push 0 to operand stack.',
+            [],
+            [],
+            [0],
+            'ctx.push(0)\n',
+            []),
+Instruction(13,
+            'push_1',
+            [],
+            'Push 1 to operand stack.',
+            [],
+            [],
+            [0],
+            'ctx.push(1)\n',
+            []),
+Instruction(14,
+            'push_nil',
+            [],
+            'Push None to oeprand stack.',
+            [],
+            [],
+            ['None'],
+            'ctx.push(None)\n',
+            []),
+Instruction(15,
+            'push_true',
+            [],
+            'Push True to oeprand stack.',
+            [],
+            [],
+            [True],
+            'ctx.push(True)\n',
+            []),
+Instruction(16,
+            'push_false',
+            [],
+            'Push False to oeprand stack.',
+            [],
+            [],
+            [False],
+            'ctx.push(False)\n',
+            []),
+Instruction(17,
+            'dup',
+            [],
+            'Duplicate the stack top object.',
+            [],
+            [],
+            ['value'],
+            'ctx.push(ctx.top())\n',
+            []),
+Instruction(18,
+            'goto',
+            ['ctrl_flow'],
+            'Unconditional jump. Backward jumps are counted for the JIT.',
+            ['ip'],
+            [],
+            [],
+            'ip = get_param(ctx, 1)\nif ip <= ctx.ip:\n    ctx.form.backedges += 1\nctx.ip = ip\n',
+            []),
+Instruction(19,
+            'goto_if_not_false',
+            ['ctrl_flow'],
+            'Jump if the stack top is not False.',
+            ['ip'],
+            ['condition'],
+            [],
+            'ip = get_param(ctx, 1)\ncond = ctx.pop()\nif cond is not False:\n    ctx.ip = ip\nelse:\n    ctx.ip += $(insn_len)\n',
+            []),
+Instruction(20,
+            'push_folded',
+            ['ctrl_flow'],
+            'Push the value of a call folded at compile time and jump to ip, if the primitives it calls are still bound to their globals (see Folded). Else the code of the call follows.',
+            ['literal', 'ip'],
+            [],
+            ['value'],
+            'folded = ctx.form.literals[get_param(ctx, 1)]\ngenv = ctx.vm.env\nif folded.version == genv.version or folded.check(genv):\n    ctx.push(folded.value)\n    ctx.ip = get_param(ctx, 2)\nelse:\n    ctx.ip += $(insn_len)\n',
+            []),
+Instruction(21,
+            'guard_inlined',
+            ['ctrl_flow'],
+            'Fall through to the body of a procedure inlined at compile time if the global it was called by is still bound to it (see Guard). Else jump to ip, where the call of the procedure follows.',
+            ['literal', 'ip'],
+            [],
+            [],
+            'guard = ctx.form.literals[get_param(ctx, 1)]\ngenv = ctx.vm.env\nif guard.version == genv.version or guard.check(genv):\n    ctx.ip += $(insn_len)\nelse:\n    ctx.ip = get_param(ctx, 2)\n',
+            []),
+Instruction(22,
+            'goto_if_false',
+            ['ctrl_flow'],
+            'Jump if the stack top is False.',
+            ['ip'],
+            ['condition'],
+            [],
+            'ip = get_param(ctx, 1)\ncond = ctx.pop()\nif cond is False:\n    ctx.ip = ip\nelse:\n    ctx.ip += $(insn_len)\n',
+            []),
+Instruction(23,
+            'fix_lexical',
+            [],
+            'Fix the lexical_parent of an object.',
+            [],
+            ['obj'],
+            ['obj'],
+            'proc = ctx.top()\nproc.lexical_parent = ctx.env\nctx.env.captured = True\n',
+            []),
+Instruction(24,
+            'fix_lexical_pop',
+            [],
+            'Like fix_literal, but pop the object off after fixing.',
+            [],
+            ['obj'],
+            [],
+            'proc = ctx.pop()\nproc.lexical_parent = ctx.env\nctx.env.captured = True\n',
+            []),
+Instruction(25,
+            'fix_lexical_depth',
+            [],
+            'Fix the lexical_parent of an object.',
+            ['depth'],
+            ['obj'],
+            ['obj'],
+            'depth = get_param(ctx, 1)\nproc = ctx.top()\nenv = ctx.env\nwhile depth > 0:\n    env = env.parent\n    depth -= 1\nproc.lexical_parent = env\nenv.captured = True\n',
+            []),
+Instruction(26,
+            'resume_trampoline',
+            ['ctx_switch', 'ctrl_flow'],
+            'Resume a PyTrampoline with its state and the result of the procedure it called, see TrampolineForm.',
+            [],
+            ['state', 'result'],
+            [],
+            'value = ctx.pop()\nstate = ctx.pop()\nnctx = resume_trampoline(ctx, ctx.form.prim.resume(ctx.vm, state, value))\nreturn nctx\n',
+            []),
+Instruction(27,
+            'dynamic_eval',
+            ['ctx_switch', 'ctrl_flow'],
+            'Evaluate a DynamicClosure and push the result. Its form returns to the next instruction.',
+            [],
+            ['dynamic_closure'],
+            ['result'],
+            'dc = ctx.pop()\nnctx = ctx.vm.frames.context(dc.form, dc.lexical_parent, ctx)\n\nctx.ip += $(insn_len)\nreturn nctx\n',
+            []),
+Instruction(28,
+            'dynamic_set_local',
+            [],
+            'Assignment of SymbolClosure.',
+            ['idx'],
+            ['value', 'sym_closure'],
+            [],
+            'idx = get_param(ctx, 1)\nsym_closure = ctx.pop()\nvalue = ctx.pop()\n\nenv = sym_closure.lexical_parent\nenv.assign_local(idx, value)\n',
+            []),
+Instruction(29,
+            'dynamic_set_local_depth',
+            [],
+            'Assignment of SymbolClosure.',
+            ['depth', 'idx'],
+            ['value', 'sym_closure'],
+            [],
+            'depth = get_param(ctx, 1)\nidx = get_param(ctx, 2)\nsym_closure = ctx.pop()\nvalue = ctx.pop()\n\nenv = sym_closure.lexical_parent\nwhile depth > 0:\n    env = env.parent\n    depth -= 1\nenv.assign_local(idx, value)\n',
+            []),
+Instruction(30,
+            'call_pop',
+            ['ctx_switch', 'ctrl_flow'],
+            'Call a procedure and drop its result. Followed by a pop that is skipped (jumping to ip) if a primitive was called.',
+            ['argc', 'ip'],
+            ['...', 'proc'],
+            [],
+            "argc = get_param(ctx, 1)\nnctx = make_call(ctx, argc)\nif nctx is ctx:\n    # A primitive was called, drop its result and skip the pop.\n    # A call outside of tail position never releases ctx, so it\n    # can't come back as a recycled context.\n    ctx.pop()\n    ctx.ip = get_param(ctx, 2)\nelse:\n    ctx.ip += $(insn_len)\nreturn nctx\n",
+            []),
+Instruction(31,
+            'call_known',
+            ['ctx_switch', 'ctrl_flow'],
+            'Call the procedure proc, known at compile time to be the value of the global variable local, if it still is. Otherwise call the value of the global.',
+            ['local', 'argc', 'literal'],
+            ['...'],
+            ['retval'],
+            'argc = get_param(ctx, 2)\nproc = ctx.form.literals[get_param(ctx, 3)]\nvalue = ctx.vm.env.read_local(get_param(ctx, 1))\nif value is proc:\n    nctx = call_procedure(ctx, proc, argc)\nelse:\n    ctx.push(value)\n    nctx = make_call(ctx, argc)\n\nctx.ip += $(insn_len)\nreturn nctx\n',
+            []),
+Instruction(32,
+            'tail_call_known',
+            ['ctx_switch', 'ctrl_flow'],
+            'Like call_known, but with tail-call.',
+            ['local', 'argc', 'literal'],
+            ['...'],
+            ['retval'],
+            'argc = get_param(ctx, 2)\nproc = ctx.form.literals[get_param(ctx, 3)]\nvalue = ctx.vm.env.read_local(get_param(ctx, 1))\nctx.ip += $(insn_len)\nif value is proc:\n    nctx = call_procedure(ctx, proc, argc, tail=True)\nelse:\n    ctx.push(value)\n    nctx = make_call(ctx, argc, tail=True)\nreturn nctx\n',
+            []),
+Instruction(33,
+            'call_direct',
+            ['ctx_switch', 'ctrl_flow'],
+            'Call the procedure proc, created for a lambda that is only called right there (see compiler/freevars.py), with the argc arguments on the stack below the values of its freec free variables. No closure is made.',
+            ['literal', 'argc', 'freec'],
+            ['...'],
+            ['retval'],
+            'proc = ctx.form.literals[get_param(ctx, 1)]\nargc = get_param(ctx, 2)\nfreec = get_param(ctx, 3)\nfree = None\nif freec > 0:\n    free = ctx.stack[-freec:]\n    ctx.pop_n(freec)\nnctx = call_procedure(ctx, proc, argc, free=free)\nctx.ip += $(insn_len)\nreturn nctx\n',
+            []),
+Instruction(34,
+            'tail_call_direct',
+            ['ctx_switch', 'ctrl_flow'],
+            'Like call_direct, but with tail-call.',
+            ['literal', 'argc', 'freec'],
+            ['...'],
+            ['retval'],
+            'proc = ctx.form.literals[get_param(ctx, 1)]\nargc = get_param(ctx, 2)\nfreec = get_param(ctx, 3)\nfree = None\nif freec > 0:\n    free = ctx.stack[-freec:]\n    ctx.pop_n(freec)\nctx.ip += $(insn_len)\nnctx = call_procedure(ctx, proc, argc, tail=True, free=free)\nreturn nctx\n',
+            []),
+Instruction(35,
+            'tail_call_self',
+            ['ctx_switch', 'ctrl_flow'],
+            'Like tail_call_known, for a procedure calling itself. The arguments are rebound in the frame of the call, which runs again from its start.',
+            ['local', 'argc'],
+            ['...'],
+            ['retval'],
+            'argc = get_param(ctx, 2)\nproc = ctx.form\nvalue = ctx.vm.env.read_local(get_param(ctx, 1))\nctx.ip += $(insn_len)\nif value is proc:\n    nctx = call_procedure(ctx, proc, argc, tail=True)\nelse:\n    ctx.push(value)\n    nctx = make_call(ctx, argc, tail=True)\nreturn nctx\n',
+            []),
+Instruction(36,
+            'push_local_box',
+            [],
+            'Push the value of a boxed local variable.',
+            ['local'],
+            [],
+            ['value'],
+            'idx = get_param(ctx, 1)\nbox = ctx.env.read_local(idx)\nctx.push(box.value)\n',
+            []),
+Instruction(37,
+            'set_local_box',
+            [],
+            'Pop the stack top and assign it to a boxed local variable.',
+            ['local'],
+            ['value'],
+            [],
+            'idx = get_param(ctx, 1)\nbox = ctx.env.read_local(idx)\nbox.value = ctx.pop()\n',
+            []),
+Instruction(38,
+            'box_local',
+            [],
+            'Put the value of a local variable captured by closures and assigned in a box.',
+            ['local'],
+            [],
+            [],
+            'idx = get_param(ctx, 1)\nvalue = ctx.env.read_local(idx)\nctx.env.assign_local(idx, Box(value))\n',
+            []),
+Instruction(39,
+            'make_closure',
+            [],
+            'Make a closure of a procedure and the values of its free variables.',
+            ['argc'],
+            ['proc', '...'],
+            ['closure'],
+            'argc = get_param(ctx, 1)\nfree = ctx.stack[-argc:]\nctx.pop_n(argc)\nproc = ctx.pop()\nctx.push(Closure(proc, free))\n',
+            []),
+Instruction(40,
+            'extended_arg',
+            [],
+            'Hold the high bits of the operands of the next instruction, which are too large for its word (see decode_operands in iset.py). Does nothing when run.',
+            [],
+            [],
+            [],
+            'pass\n',
+            []),
+Instruction(41,
+            'add2',
+            [],
+            'Add two numbers, like the + primitive.',
+            ['local', 'literal'],
+            ['a', 'b'],
+            ['a+b'],
+            'b = ctx.pop()\na = ctx.pop()\nif ctx.vm.env.read_local(get_param(ctx, 1)) is ctx.form.literals[get_param(ctx, 2)]:\n    try:\n        ctx.push(0 + a + b)\n    except TypeError, e:\n        raise WrongArgType(e.message)\nelse:\n    ctx.push(ctx.vm.apply(ctx.vm.env.read_local(get_param(ctx, 1)), [a, b]))\n',
+            []),
+Instruction(42,
+            'sub2',
+            [],
+            'Subtract two numbers, like the - primitive.',
+            ['local', 'literal'],
+            ['a', 'b'],
+            ['a-b'],
+            'b = ctx.pop()\na = ctx.pop()\nif ctx.vm.env.read_local(get_param(ctx, 1)) is ctx.form.literals[get_param(ctx, 2)]:\n    try:\n        ctx.push(a - b)\n    except TypeError, e:\n        raise WrongArgType(e.message)\nelse:\n    ctx.push(ctx.vm.apply(ctx.vm.env.read_local(get_param(ctx, 1)), [a, b]))\n',
+            []),
+Instruction(43,
+            'numeq2',
+            [],
+            'Compare two numbers, like the = primitive.',
+            ['local', 'literal'],
+            ['a', 'b'],
+            ['a=b'],
+            'b = ctx.pop()\na = ctx.pop()\nif ctx.vm.env.read_local(get_param(ctx, 1)) is ctx.form.literals[get_param(ctx, 2)]:\n    type_check(a, (int, long, float, complex))\n    type_check(b, (int, long, float, complex))\n    ctx.push(a == b)\nelse:\n    ctx.push(ctx.vm.apply(ctx.vm.env.read_local(get_param(ctx, 1)), [a, b]))\n',
+            []),
+Instruction(44,
+            'lt2',
+            [],
+            'Compare two numbers, like the < primitive.',
+            ['local', 'literal'],
+            ['a', 'b'],
+            ['a<b'],
+            'b = ctx.pop()\na = ctx.pop()\nif ctx.vm.env.read_local(get_param(ctx, 1)) is ctx.form.literals[get_param(ctx, 2)]:\n    ctx.push(not a >= b)\nelse:\n    ctx.push(ctx.vm.apply(ctx.vm.env.read_local(get_param(ctx, 1)), [a, b]))\n',
+            []),
+Instruction(45,
+            'car',
+            [],
+            'The first element of a pair, like the car primitive.',
+            ['local', 'literal'],
+            ['pair'],
+            ['first'],
+            'obj = ctx.pop()\nif ctx.vm.env.read_local(get_param(ctx, 1)) is ctx.form.literals[get_param(ctx, 2)]:\n    if not isinstance(obj, Pair):\n        type_check(obj, Pair)\n    ctx.push(obj.first)\nelse:\n    ctx.push(ctx.vm.apply(ctx.vm.env.read_local(get_param(ctx, 1)), [obj]))\n',
+            []),
+Instruction(46,
+            'cdr',
+            [],
+            'The rest of a pair, like the cdr primitive.',
+            ['local', 'literal'],
+            ['pair'],
+            ['rest'],
+            'obj = ctx.pop()\nif ctx.vm.env.read_local(get_param(ctx, 1)) is ctx.form.literals[get_param(ctx, 2)]:\n    if not isinstance(obj, Pair):\n        type_check(obj, Pair)\n    ctx.push(obj.rest)\nelse:\n    ctx.push(ctx.vm.apply(ctx.vm.env.read_local(get_param(ctx, 1)), [obj]))\n',
+            []),
+Instruction(47,
+            'cons',
+            [],
+            'Make a pair, like the cons primitive.',
+            ['local', 'literal'],
+            ['first', 'rest'],
+            ['pair'],
+            'rest = ctx.pop()\nfirst = ctx.pop()\nif ctx.vm.env.read_local(get_param(ctx, 1)) is ctx.form.literals[get_param(ctx, 2)]:\n    ctx.push(Pair(first, rest))\nelse:\n    ctx.push(ctx.vm.apply(ctx.vm.env.read_local(get_param(ctx, 1)), [first, rest]))\n',
+            []),
+Instruction(48,
+            'nullp',
+            [],
+            'Whether an object is the empty list, like the null? primitive.',
+            ['local', 'literal'],
+            ['obj'],
+            ['bool'],
+            'obj = ctx.pop()\nif ctx.vm.env.read_local(get_param(ctx, 1)) is ctx.form.literals[get_param(ctx, 2)]:\n    ctx.push(obj is None)\nelse:\n    ctx.push(ctx.vm.apply(ctx.vm.env.read_local(get_param(ctx, 1)), [obj]))\n',
+            []),
+Instruction(49,
+            'call_locals',
+            ['ctx_switch', 'ctrl_flow'],
+            'Call a global procedure with two local arguments.',
+            ['local', 'local', 'local', 'argc'],
+            [],
+            ['retval'],
+            'idx = get_param(ctx, 1)\nloc = ctx.env.read_local(idx)\nctx.push(loc)\nidx = get_param(ctx, 2)\nloc = ctx.env.read_local(idx)\nctx.push(loc)\nctx.push(ctx.vm.env.read_local(get_param(ctx, 3)))\nargc = get_param(ctx, 4)\nnctx = make_call(ctx, argc)\n\nctx.ip += $(insn_len)\nreturn nctx\n',
+            ['push_local', 'push_local', 'push_global', 'call']),
+Instruction(50,
+            'call_literal_global',
+            ['ctx_switch', 'ctrl_flow'],
+            'Call a global procedure with a literal argument.',
+            ['literal', 'local', 'argc'],
+            ['...'],
+            ['retval'],
+            'idx = get_param(ctx, 1)\nlit = ctx.form.literals[idx]\nctx.push(lit)\nctx.push(ctx.vm.env.read_local(get_param(ctx, 2)))\nargc = get_param(ctx, 3)\nnctx = make_call(ctx, argc)\n\nctx.ip += $(insn_len)\nreturn nctx\n',
+            ['push_literal', 'push_global', 'call']),
+Instruction(51,
+            'call_global',
+            ['ctx_switch', 'ctrl_flow'],
+            'Call a global procedure.',
+            ['local', 'argc'],
+            ['...'],
+            ['retval'],
+            'ctx.push(ctx.vm.env.read_local(get_param(ctx, 1)))\nargc = get_param(ctx, 2)\nnctx = make_call(ctx, argc)\n\nctx.ip += $(insn_len)\nreturn nctx\n',
+            ['push_global', 'call']),
+Instruction(52,
+            'tail_call_global',
+            ['ctx_switch', 'ctrl_flow'],
+            'Tail-call a global procedure.',
+            ['local', 'argc'],
+            ['...'],
+            ['retval'],
+            'ctx.push(ctx.vm.env.read_local(get_param(ctx, 1)))\nargc = get_param(ctx, 2)\nctx.ip += $(insn_len)\nnctx = make_call(ctx, argc, tail=True)\nreturn nctx\n',
+            ['push_global', 'tail_call']),
+Instruction(53,
+            'push_local_local',
+            [],
+            'Push the values of two local variables.',
+            ['local', 'local'],
+            [],
+            ['value1', 'value2'],
+            'idx = get_param(ctx, 1)\nloc = ctx.env.read_local(idx)\nctx.push(loc)\nidx = get_param(ctx, 2)\nloc = ctx.env.read_local(idx)\nctx.push(loc)\n',
+            ['push_local', 'push_local']),
+Instruction(54,
+            'push_local_literal',
+            [],
+            'Push the value of a local variable and a literal.',
+            ['local', 'literal'],
+            [],
+            ['value', 'literal'],
+            'idx = get_param(ctx, 1)\nloc = ctx.env.read_local(idx)\nctx.push(loc)\nidx = get_param(ctx, 2)\nlit = ctx.form.literals[idx]\nctx.push(lit)\n',
+            ['push_local', 'push_literal']),
+Instruction(55,
+            'push_local_1',
+            [],
+            'Push the value of a local variable and 1.',
+            ['local'],
+            [],
+            ['value', 1],
+            'idx = get_param(ctx, 1)\nloc = ctx.env.read_local(idx)\nctx.push(loc)\nctx.push(1)\n',
+            ['push_local', 'push_1']),
+Instruction(56,
+            'dup_set_local',
+            [],
+            'Assign the stack top to a local variable, keeping it.',
+            ['local'],
+            ['value'],
+            ['value'],
+            'ctx.push(ctx.top())\nidx = get_param(ctx, 1)\nval = ctx.pop()\nctx.env.assign_local(idx, val)\n',
+            ['dup', 'set_local'])]
+
+INSN_MAP = {
+    'ret' : INSTRUCTIONS[0],
+    'call' : INSTRUCTIONS[1],
+    'tail_call' : INSTRUCTIONS[2],
+    'call_cc' : INSTRUCTIONS[3],
+    'pop' : INSTRUCTIONS[4],
+    'push_local' : INSTRUCTIONS[5],
+    'set_local' : INSTRUCTIONS[6],
+    'push_local_depth' : INSTRUCTIONS[7],
+    'set_local_depth' : INSTRUCTIONS[8],
+    'push_global' : INSTRUCTIONS[9],
+    'set_global' : INSTRUCTIONS[10],
+    'push_literal' : INSTRUCTIONS[11],
+    'push_0' : INSTRUCTIONS[12],
+    'push_1' : INSTRUCTIONS[13],
+    'push_nil' : INSTRUCTIONS[14],
+    'push_true' : INSTRUCTIONS[15],
+    'push_false' : INSTRUCTIONS[16],
+    'dup' : INSTRUCTIONS[17],
+    'goto' : INSTRUCTIONS[18],
+    'goto_if_not_false' : INSTRUCTIONS[19],
+    'push_folded' : INSTRUCTIONS[20],
+    'guard_inlined' : INSTRUCTIONS[21],
+    'goto_if_false' : INSTRUCTIONS[22],
+    'fix_lexical' : INSTRUCTIONS[23],
+    'fix_lexical_pop' : INSTRUCTIONS[24],
+    'fix_lexical_depth' : INSTRUCTIONS[25],
+    'resume_trampoline' : INSTRUCTIONS[26],
+    'dynamic_eval' : INSTRUCTIONS[27],
+    'dynamic_set_local' : INSTRUCTIONS[28],
+    'dynamic_set_local_depth' : INSTRUCTIONS[29],
+    'call_pop' : INSTRUCTIONS[30],
+    'call_known' : INSTRUCTIONS[31],
+    'tail_call_known' : INSTRUCTIONS[32],
+    'call_direct' : INSTRUCTIONS[33],
+    'tail_call_direct' : INSTRUCTIONS[34],
+    'tail_call_self' : INSTRUCTIONS[35],
+    'push_local_box' : INSTRUCTIONS[36],
+    'set_local_box' : INSTRUCTIONS[37],
+    'box_local' : INSTRUCTIONS[38],
+    'make_closure' : INSTRUCTIONS[39],
+    'extended_arg' : INSTRUCTIONS[40],
+    'add2' : INSTRUCTIONS[41],
+    'sub2' : INSTRUCTIONS[42],
+    'numeq2' : INSTRUCTIONS[43],
+    'lt2' : INSTRUCTIONS[44],
+    'car' : INSTRUCTIONS[45],
+    'cdr' : INSTRUCTIONS[46],
+    'cons' : INSTRUCTIONS[47],
+    'nullp' : INSTRUCTIONS[48],
+    'call_locals' : INSTRUCTIONS[49],
+    'call_literal_global' : INSTRUCTIONS[50],
+    'call_global' : INSTRUCTIONS[51],
+    'tail_call_global' : INSTRUCTIONS[52],
+    'push_local_local' : INSTRUCTIONS[53],
+    'push_local_literal' : INSTRUCTIONS[54],
+    'push_local_1' : INSTRUCTIONS[55],
+    'dup_set_local' : INSTRUCTIONS[56]
+}
+
+
+# Wordcode: every instruction is a single word of the bytecode (an
+# array('i')), holding its opcode in the low bits and its operands in
+# the high bits, split into fields of the same width (see FIELDS). An
+# operand too large for its field gets its high bits from extended_arg
+# words preceding the instruction, whose word then has the EXTENDED
+# flag set.
+OPCODE_MASK = 0x7f
+EXTENDED = OPCODE_MASK + 1
+EXTENDED_ARG = INSN_MAP['extended_arg'].opcode
+
+# The (shift, mask) of the fields of the operands, by number of operands
+FIELDS = [
+    [],
+    [(8, 8388607)],
+    [(8, 2047), (19, 2047)],
+    [(8, 127), (15, 127), (22, 127)],
+    [(8, 31), (13, 31), (18, 31), (23, 31)]
+]
+
+
+def encode(insn, operands):
+    """\
+    Return the words of the instruction insn with operands: extended_arg
+    words for the high bits of the operands too large for their field,
+    then the word of the instruction.
+    """
+    fields = FIELDS[len(operands)]
+    values = list(operands)
+    words = []
+    while True:
+        word = 0
+        for i, (shift, mask) in enumerate(fields):
+            if values[i] < 0:
+                raise ValueError("Negative operand for %s: %d" % (insn.name, operands[i]))
+            word |= (values[i] & mask) << shift
+            values[i] >>= mask.bit_length()
+        words.insert(0, word)
+        if not any(values):
+            break
+    for i in range(len(words)-1):
+        words[i] |= EXTENDED_ARG
+    words[-1] |= insn.opcode
+    if len(words) > 1:
+        words[-1] |= EXTENDED
+    return words
+
+def decode_operands(bytecode, ip):
+    "Return the operands of the instruction whose word is at ip."
+    word = bytecode[ip]
+    fields = FIELDS[len(INSTRUCTIONS[word & OPCODE_MASK].operands)]
+    values = [word >> shift & mask for shift, mask in fields]
+    if word & EXTENDED:
+        bits = 0
+        while ip > 0 and bytecode[ip-1] & OPCODE_MASK == EXTENDED_ARG:
+            ip -= 1
+            bits += fields[0][1].bit_length()
+            values = [value | (bytecode[ip] >> shift & mask) << bits
+                      for value, (shift, mask) in zip(values, fields)]
+    return values
+
+def decode(bytecode):
+    "Return the instructions of bytecode as [(ip, instruction, operands)]."
+    return [(ip, INSTRUCTIONS[word & OPCODE_MASK], decode_operands(bytecode, ip))
+            for ip, word in enumerate(bytecode)]
@@ -1,12 +1,80 @@
 import re
 import yaml
 
+# Wordcode: every instruction is a single word, with its opcode in the
+# low OPCODE_BITS bits, the EXTENDED flag above, and its operands in
+# the next OPERAND_BITS bits, split into as many fields of the same
+# width. The sign bit of the word is left clear, so that the bytecode
+# is an array('i') of Python ints (not longs). See encode and
+# decode_operands in TMPL_ISET.
+OPCODE_BITS = 7
+OPERAND_BITS = 23
+OPERAND_SHIFT = 8
+
+def operand_fields(count):
+    "Return the (shift, mask) of the fields of count operands in a word."
+    width = OPERAND_BITS // count
+    return [(OPERAND_SHIFT + i*width, (1 << width)-1) for i in range(count)]
+
+def param_expr(word, n, count):
+    """\
+    Return an expression extracting operand n of count from word. It
+    isn't parenthesized, so that the rewrites of read_local and
+    assign_local calls still apply: get_param calls are only used as
+    whole expressions in iset.yml.
+    """
+    shift, mask = operand_fields(count)[n-1]
+    if n == count:
+        # the bits above the last field are never set
+        return '%s >> %d' % (word, shift)
+    return '%s >> %d & %d' % (word, shift, mask)
+
+def gen_operand_fields(instructions):
+    count = max([len(insn['operands']) for insn in instructions])
+    return 'FIELDS = [\n' + \
+           ',\n'.join(['    %r' % operand_fields(i) if i else '    []'
+                       for i in range(count+1)]) + \
+           '\n]\n'
+
 def gen_tags(tags):
     stmts =  []
     for tag, i in zip(tags, range(len(tags))):
         stmts.append('TAG_%-12s = %d' % (tag.upper(), 2**i))
     return '\n'.join(stmts)
 
+def gen_superinstructions(instructions):
+    """\
+    Fill in the operands, tags and code of the superinstructions (the
+    instructions with a fuses list) from the instructions they fuse.
+    The code of each fused instruction is kept in parts, with its
+    get_param calls shifted to the operands of the superinstruction.
+    """
+    insn_map = dict([(insn['name'], insn) for insn in instructions])
+    for insn in instructions:
+        fuses = insn.get('fuses')
+        if not fuses:
+            insn['fuses'] = []
+            continue
+        operands = []
+        parts = []
+        for i, name in enumerate(fuses):
+            part = insn_map[name]
+            if part.get('fuses'):
+                raise ValueError("%s: can't fuse superinstruction %s" %
+                                 (insn['name'], name))
+            if 'ctrl_flow' in part['tags'] and i != len(fuses)-1:
+                raise ValueError("%s: only the last fused instruction can be control flow" %
+                                 insn['name'])
+            offset = len(operands)
+            parts.append(re.sub(r'get_param\(ctx, (\d+)\)',
+                                lambda m: 'get_param(ctx, %d)' % (int(m.group(1))+offset),
+                                part['code']))
+            operands += part['operands']
+        insn['operands'] = operands
+        insn['tags'] = list(insn_map[fuses[-1]]['tags'])
+        insn['parts'] = parts
+        insn['code'] = ''.join(parts)
+
 def gen_actions(instructions):
     def gen_action(insn):
         func = "def op_%s(ctx):\n" % insn['name']
@@ -18,13 +86,15 @@ def gen_actions(instructions):
             "\"\"\"\n"
             ]
         env = {
-            'insn_len' : 1 + len(insn['operands'])
+            'insn_len' : 1
             }
         code = insn['code']
         if not 'ctrl_flow' in insn['tags']:
             code += 'ctx.ip += $(insn_len)\n'
             
         code = process_tmpl(code, env)
+        code = re.sub(r'get_param\(ctx, (\d+)\)',
+                      r'get_param(ctx, \1, %d)' % len(insn['operands']), code)
         code = re.sub(re.compile('^', re.MULTILINE), '    ', code)
         
         return func + "\n    ".join(doclist) + code
@@ -57,7 +127,8 @@ def gen_insn_table(instructions):
         return "Instruction(" + str(i) + ",\n" + \
                ",\n".join(["            " + insn[key].__repr__()
                            for key in ['name', 'tags', 'desc', 'operands',
-                                       'stack_before', 'stack_after', 'code']]) + \
+                                       'stack_before', 'stack_after', 'code',
+                                       'fuses']]) + \
                ")"
 
     insns = zip(range(len(instructions)), instructions)
@@ -71,6 +142,183 @@ def gen_insn_table(instructions):
            "\n}\n"
     
 
+# Rewrites turning an instruction body written against the Context API
+# into code working on the locals cached by the fused run loop.
+FUSED_REWRITES = [
+    (r'ctx\.ip \+= ', 'pc += '),
+    (r'ctx\.ip = ', 'pc = '),
+    (r'ctx\.push\(', 'push('),
+    (r'ctx\.pop\(\)', 'pop()'),
+    (r'ctx\.top\(\)', 'stack[-1]'),
+    (r'([\w.]+)\.read_local\(([^()]*)\)', r'\1.locals[\2]'),
+    (r'([\w.]+)\.assign_local\(([^(),]*), ([^()]*)\)', r'\1.locals[\2] = \3'),
+    (r'ctx\.env\.locals', 'lvars'),
+    (r'ctx\.vm\.env\.locals', 'G'),
+    (r'ctx\.form\.literals', 'literals')
+    ]
+
+# Reload the cached locals after the fused loop switched to another context.
+FUSED_RELOAD = """\
+form = ctx.form
+bc = ctx.bytecode
+pc = ctx.ip
+end = len(bc)
+stack = ctx.stack
+push = stack.append
+pop = stack.pop
+lvars = ctx.env.locals
+if form is not None:
+    literals = form.literals
+"""
+
+def indent(code, level):
+    return re.sub(re.compile('^(?=.)', re.MULTILINE), '    '*level, code)
+
+# Switch the fused loop to the context nctx. The cached locals only
+# depend on the form and environment of the context, so they are kept
+# if nctx runs the same ones, like a procedure tail-calling itself (see
+# call_procedure). nctx may be a recycled context running another
+# frame, even if it is the same object as ctx.
+FUSED_SWITCH = """\
+ctx = %s
+if ctx.form is form and ctx.env.locals is lvars:
+    pc = ctx.ip
+else:
+""" + indent(FUSED_RELOAD, 1)
+
+def gen_fused_body(insn):
+    """\
+    Generate the inlined body of an instruction for the fused run loop.
+
+    Context switching instructions still work on ctx, so pc is flushed
+    before the body runs and the cached locals are reloaded if the body
+    returns a context running another frame, see FUSED_SWITCH. Other
+    instructions are rewritten to use the cached locals; pc is flushed
+    first only if the rewritten body still uses ctx for something else
+    than its env, vm or form. So are the instructions a context
+    switching superinstruction fuses before the context switch.
+    """
+    env = {
+        'insn_len' : 1
+        }
+    code = insn['code']
+    if not 'ctrl_flow' in insn['tags']:
+        code += 'ctx.ip += $(insn_len)\n'
+    code = process_tmpl(code, env)
+
+    def params(code):
+        # the operands are taken from the word of the instruction, see
+        # FUSED_EXTENDED for extended operands
+        count = len(insn['operands'])
+        return re.sub(r'get_param\(ctx, (\d+)\)',
+                      lambda m: param_expr('word', int(m.group(1)), count), code)
+
+    head = ''
+    if 'ctx_switch' in insn['tags']:
+        if insn['fuses']:
+            # The instructions fused before the context switching one
+            # can work on the cached locals
+            head = ''.join(insn['parts'][:-1])
+            code = code[len(head):]
+            for pattern, repl in FUSED_REWRITES:
+                head = re.sub(pattern, repl, params(head))
+        code = params(code)
+        m = re.search(r'^return (\w+)\n?\Z', code, re.MULTILINE)
+        if m is None:
+            raise ValueError("%s: context switching instructions should end with 'return nctx'" %
+                             insn['name'])
+        nctx = m.group(1)
+        code = head + 'ctx.ip = pc\n' + code[:m.start()] + \
+               FUSED_SWITCH % nctx
+    else:
+        code = params(code)
+        for pattern, repl in FUSED_REWRITES:
+            code = re.sub(pattern, repl, code)
+        if re.search(r'\bctx\b(?!\.(env|vm|form)\b)', code):
+            code = 'ctx.ip = pc\n' + code
+    return code
+
+def gen_fused_loop(instructions, order):
+    """\
+    Generate the dispatch chain of the fused run loop. Instructions
+    listed in order (the most frequently executed first) are tested
+    first, the others follow in opcode order.
+    """
+    opcodes = dict([(insn['name'], i) for i, insn in enumerate(instructions)])
+    names = list(order) + [insn['name'] for insn in instructions
+                           if insn['name'] not in order]
+    branches = []
+    for name in names:
+        insn = instructions[opcodes[name]]
+        branches.append('if opcode == %d: # %s\n' % (opcodes[name], name) +
+                        indent(gen_fused_body(insn), 1))
+    return indent('el'.join(branches) + FUSED_EXTENDED, 2)
+
+# Instructions with the EXTENDED flag, whose opcode matches none of the
+# branches of the fused loop, are run by their table action.
+FUSED_EXTENDED = """\
+else:
+    ctx.ip = pc
+    opcode &= OPCODE_MASK
+    nctx = INSN_ACTION[opcode](ctx)
+    if not has_tag(opcode, TAG_CTX_SWITCH):
+        pc = ctx.ip
+    else:
+""" + indent(FUSED_SWITCH % 'nctx', 2)
+
+# Rewrites turning an instruction body into the body of a closure with
+# its operands (p1, p2, ...) bound at translation time.
+CLOSURE_REWRITES = [
+    (r'get_param\(ctx, (\d+)\)', r'p\1'),
+    (r'ctx\.ip \+= \d+', 'ctx.ip = next_ip'),
+    (r'ctx\.push\(', 'ctx.stack.append('),
+    (r'ctx\.pop\(\)', 'ctx.stack.pop()'),
+    (r'ctx\.top\(\)', 'ctx.stack[-1]'),
+    (r'([\w.]+)\.read_local\(([^()]*)\)', r'\1.locals[\2]'),
+    (r'([\w.]+)\.assign_local\(([^(),]*), ([^()]*)\)', r'\1.locals[\2] = \3'),
+    (r'ctx\.form\.literals', 'literals')
+    ]
+
+def gen_closure_factories(instructions):
+    """\
+    Generate a closure factory per instruction for the closure engine.
+    closure_<name>(form, at, p1, ...) returns a function taking the
+    current context. Instructions that are not control flow leave the
+    ip alone (the basic block takes care of it) and return nothing,
+    control flow instructions return the context to continue with.
+    """
+    def gen_factory(insn):
+        params = ['form', 'at'] + ['p%d' % (i+1) for i in range(len(insn['operands']))]
+        env = {
+            'insn_len' : 1
+            }
+        code = process_tmpl(insn['code'], env)
+        for pattern, repl in CLOSURE_REWRITES:
+            code = re.sub(pattern, repl, code)
+        if 'ctx_switch' in insn['tags']:
+            code = 'ctx.ip = at\n' + code
+        elif 'ctrl_flow' in insn['tags']:
+            code += 'return ctx\n'
+
+        factory = "def closure_%s(%s):\n" % (insn['name'], ', '.join(params))
+        factory += '    "%s"\n' % insn['desc']
+        if 'literals' in code:
+            factory += '    literals = form.literals\n'
+        if 'next_ip' in code:
+            factory += '    next_ip = at + %d\n' % env['insn_len']
+        factory += '    def op(ctx):\n'
+        factory += indent(code, 2)
+        factory += '    return op\n'
+        return factory
+
+    return '\n'.join([gen_factory(insn) for insn in instructions])
+
+def gen_closure_table(instructions):
+    return 'CLOSURE_FACTORY = [\n' + \
+           ',\n'.join(['    closure_' + insn['name']
+                       for insn in instructions]) + \
+           '\n]\n'
+
 def process_tmpl(tmpl, env):
     """\
     Process template. Special variables like $(key) in the template
@@ -83,12 +331,17 @@ def process_tmpl(tmpl, env):
 TMPL_INSNS = """\
 # Don't edit this file. This is generated by iset_gen.py
 
+from timeit      import default_timer as clock
+
 from .ctx        import Context
+from .form       import TrampolineForm
 from .call_cc    import Continuation
-from .proc       import Procedure
-from .prim       import Primitive
+from .proc       import Procedure, Closure
+from .env        import Box
+from .prim       import Primitive, PyTrampoline, Apply, apply_arguments, type_check
 from .types.pair import Pair
-from .errors     import WrongArgType
+from .errors     import WrongArgType, WrongArgNumber
+from .iset       import INSTRUCTIONS, FIELDS, OPCODE_MASK, EXTENDED, decode, decode_operands
 
 $(tags)
 
@@ -102,57 +355,288 @@ $(tags_table)
 def has_tag(opcode, tag):
     return INSN_TAGS[opcode] & tag == tag
 
-def get_param(ctx, n):
-    "Returns Nth parameter by looking up Nth bytecode from current IP position."
-    return ctx.bytecode[ctx.ip+n]
+def get_param(ctx, n, count):
+    "Return the Nth of the count operands of the instruction at the current IP."
+    word = ctx.bytecode[ctx.ip]
+    if word & EXTENDED:
+        return decode_operands(ctx.bytecode, ctx.ip)[n-1]
+    shift, mask = FIELDS[count][n-1]
+    return word >> shift & mask
+
+def run_table(ctx):
+    "Table driven run loop: one call through INSN_ACTION per instruction."
+    while ctx.ip < len(ctx.bytecode):
+        opcode = ctx.bytecode[ctx.ip] & OPCODE_MASK
+        nctx = INSN_ACTION[opcode](ctx)
+        if has_tag(opcode, TAG_CTX_SWITCH):
+            ctx = nctx
+    return ctx.pop()
 
-def run(ctx):
+def run_stats(ctx):
+    \"\"\"\\
+    Instrumented run loop, like run_table but recording instruction
+    counts, times and pairs in ctx.vm.stats (an InsnStats).
+    \"\"\"
+    stats = ctx.vm.stats
+    counts = stats.counts
+    times = stats.times
+    pairs = stats.pairs
     while ctx.ip < len(ctx.bytecode):
-        opcode = ctx.bytecode[ctx.ip]
+        opcode = ctx.bytecode[ctx.ip] & OPCODE_MASK
+        counts[opcode] += 1
+        pairs[stats.last][opcode] += 1
+        stats.last = opcode
+        start = clock()
         nctx = INSN_ACTION[opcode](ctx)
+        times[opcode] += clock() - start
         if has_tag(opcode, TAG_CTX_SWITCH):
             ctx = nctx
     return ctx.pop()
 
+def run_fused(ctx):
+    \"\"\"\\
+    Fused run loop: all instruction bodies are inlined into a single
+    dispatch chain ordered by opcode frequency, with the state of the
+    current context cached in local variables.
+    \"\"\"
+    literals = None
+    G = ctx.vm.env.locals
+$(fused_reload)
+    while pc < end:
+        word = bc[pc]
+        # with the EXTENDED flag, see FUSED_EXTENDED
+        opcode = word & 0xff
+$(fused_loop)
+    ctx.ip = pc
+    return ctx.pop()
+
+$(closure_factories)
+
+$(closure_table)
+
+def make_block(ops, last, next_ip):
+    \"\"\"\\
+    Make the closure running a basic block: ops are the closures of the
+    straight-line instructions, last the closure of the control flow
+    instruction ending the block (None if the block falls through to
+    next_ip).
+    \"\"\"
+    if last is None:
+        def block(ctx):
+            for op in ops:
+                op(ctx)
+            ctx.ip = next_ip
+            return ctx
+    elif len(ops) == 0:
+        block = last
+    else:
+        def block(ctx):
+            for op in ops:
+                op(ctx)
+            return last(ctx)
+    return block
+
+def translate_closures(form):
+    \"\"\"\\
+    Translate the bytecode of a Form or Procedure into basic block
+    closures. Return a list indexed by ip, holding the closure of the
+    block starting at that ip (None elsewhere).
+    \"\"\"
+    bytecode = form.bytecode
+
+    # Blocks start at jump targets and after control flow instructions,
+    # so every ip a context can be resumed at begins a block.
+    insns = decode(bytecode)
+    starts = set([0, len(bytecode)])
+    for ip, insn, operands in insns:
+        for name, val in zip(insn.operands, operands):
+            if name == 'ip':
+                starts.add(val)
+        if TAG_CTRL_FLOW & INSN_TAGS[insn.opcode]:
+            starts.add(ip+1)
+
+    code = [None] * len(bytecode)
+    ops = []
+    start = 0
+    for ip, insn, operands in insns:
+        op = CLOSURE_FACTORY[insn.opcode](form, ip, *operands)
+        ip += 1
+        if TAG_CTRL_FLOW & INSN_TAGS[insn.opcode]:
+            code[start] = make_block(ops, op, ip)
+        else:
+            ops.append(op)
+            if ip not in starts:
+                continue
+            code[start] = make_block(ops, None, ip)
+        ops = []
+        start = ip
+    return code
+
+def closures_of(ctx):
+    "Get the block closures of the form run by ctx, translating it once."
+    form = ctx.form
+    if form is None:
+        return ()
+    if form.closures is None:
+        form.closures = translate_closures(form)
+    return form.closures
+
+def run_closure(ctx):
+    \"\"\"\\
+    Closure run loop: the form is translated once into a tree of
+    closures with pre-bound operands, then run one basic block per
+    iteration.
+    \"\"\"
+    form = ctx.form
+    code = closures_of(ctx)
+    while ctx.ip < len(ctx.bytecode):
+        ctx = code[ctx.ip](ctx)
+        # the closures only depend on the form, a recycled context may
+        # be the same object running another one
+        if ctx.form is not form:
+            form = ctx.form
+            code = closures_of(ctx)
+    return ctx.pop()
+
+# Available run loops, selected by name with VM(engine=...)
+ENGINES = {
+    'table' : run_table,
+    'fused' : run_fused,
+    'closure' : run_closure
+    }
+
+DEFAULT_ENGINE = 'fused'
+
+run = ENGINES[DEFAULT_ENGINE]
+
+# Call a Procedure with the argc arguments on top of the stack, whose
+# arity is already checked. free are the values of the free variables
+# if the procedure is called as a Closure. A procedure tail-calling
+# itself reuses its context and environment, unless they are captured.
+def call_procedure(ctx, proc, argc, tail=False, free=None):
+    stack = ctx.stack
+    # the arguments are stack[base:]
+    base = len(stack)-argc
+    proc.calls += 1
+    frames = ctx.vm.frames
+    fixed_argc = proc.fixed_argc
+    if tail and proc is ctx.form and not ctx.captured and not ctx.env.captured:
+        env = ctx.env
+        if len(env.locals) > fixed_argc:
+            env.locals[:] = proc.env.locals
+        nctx = ctx
+    else:
+        env = frames.env(proc)
+        nctx = None
+
+    env.locals[:fixed_argc] = stack[base:base+fixed_argc]
+    if fixed_argc != proc.argc:
+        rest = None
+        for i in range(len(stack)-1, base+fixed_argc-1, -1):
+            rest = Pair(stack[i], rest)
+        env.locals[fixed_argc] = rest
+    if free is not None:
+        env.locals[-len(free):] = free
+    # the frame of the callee starts where the arguments were
+    del stack[base:]
+    if nctx is not None:
+        nctx.ip = 0
+    elif tail:
+        nctx = frames.context(proc, env, ctx.parent)
+        frames.release(ctx)
+    else:
+        nctx = frames.context(proc, env, ctx)
+    return nctx
+
+# Call a PyTrampoline with the argc arguments on top of the stack. It
+# runs in a context of its own, which calls the procedures it requests
+# and resumes it with their results, see resume_trampoline.
+def call_trampoline(ctx, prim, argc, tail=False):
+    stack = ctx.stack
+    base = len(stack)-argc
+    args = stack[base:]
+    del stack[base:]
+    frames = ctx.vm.frames
+    form = prim.form
+    if form is None:
+        form = prim.form = TrampolineForm(prim)
+    request = prim.proc(ctx.vm, *args)
+    if not tail:
+        nctx = frames.context(form, ctx.vm.env, ctx)
+        return resume_trampoline(nctx, request)
+    # The caller is only released once the context of the trampoline
+    # has taken over, or the first procedure it calls would get it
+    # back from the pool.
+    nctx = frames.context(form, ctx.vm.env, ctx.parent)
+    nctx = resume_trampoline(nctx, request)
+    frames.release(ctx)
+    return nctx
+
+# Run what a PyTrampoline requested in its context ctx: call a
+# procedure, or return a value. The state of the primitive is left in
+# the frame of ctx under the arguments, so that a continuation captured
+# by the procedure saves it with the stack.
+def resume_trampoline(ctx, request):
+    proc, value, state = request
+    if proc is None:
+        ctx.stack.append(value)
+        parent = ctx.parent
+        ctx.vm.frames.release(ctx)
+        return parent
+    ctx.stack.append(state)
+    ctx.stack.extend(value)
+    ctx.stack.append(proc)
+    return make_call(ctx, len(value))
+
 def make_call(ctx, argc, tail=False):
-    proc = ctx.pop()
+    stack = ctx.stack
+    proc = stack.pop()
+    free = None
+    if isinstance(proc, Closure):
+        free = proc.free
+        proc = proc.proc
     if tail:
         parent = ctx.parent
     else:
         parent = ctx
+    # the arguments are stack[base:]
+    base = len(stack)-argc
 
     if isinstance(proc, Procedure):
         proc.check_arity(argc)
-        nctx = Context(proc, proc.env.dup(), parent)
-
-        for i in range(proc.fixed_argc):
-            nctx.env.assign_local(i, ctx.top(idx=argc-i))
-        if proc.fixed_argc != proc.argc:
-            rest = None
-            for i in range(argc-proc.fixed_argc):
-                rest = Pair(ctx.top(idx=i+1), rest)
-            nctx.env.assign_local(proc.fixed_argc, rest)
-        ctx.pop_n(argc)
+        nctx = call_procedure(ctx, proc, argc, tail, free)
 
     elif isinstance(proc, Primitive):
         proc.check_arity(argc)
-        args = range(argc)
-        for i in range(argc):
-            args[i] = ctx.top(idx=argc-i)
-        ctx.pop_n(argc)
+        if isinstance(proc, Apply):
+            # call the procedure given to apply in this run loop
+            func = stack[base]
+            args = apply_arguments(stack[base+1:])
+            del stack[base:]
+            stack.extend(args)
+            stack.append(func)
+            return make_call(ctx, len(args), tail)
+        if isinstance(proc, PyTrampoline):
+            return call_trampoline(ctx, proc, argc, tail)
+
+        args = stack[base:]
+        del stack[base:]
 
         nctx = parent
-        nctx.push(proc.call(ctx.vm, *args))
+        stack.append(proc.call(ctx.vm, *args))
+        if tail:
+            ctx.vm.frames.release(ctx)
 
     elif isinstance(proc, Continuation):
         if argc > 1:
             raise WrongArgNumber("Continuation only accept 1 argument")
-        nctx = proc.ctx.clone()
         if argc == 1:
-            nctx.push(ctx.pop())
+            value = stack.pop()
         else:
-            nctx.push(None)
-        nctx.parent = ctx.parent
+            value = None
+        stack[:] = proc.stack
+        nctx = proc.resume()
+        stack.append(value)
 
     else:
         raise WrongArgType("Not a skime callable: %s" % proc)
@@ -171,9 +655,10 @@ class Instruction(object):
                  'operands',
                  'stack_before',
                  'stack_after',
-                 'code')
+                 'code',
+                 'fuses')
     def __init__(self, opcode, name, tags, desc, operands,
-                 stack_before, stack_after, code):
+                 stack_before, stack_after, code, fuses):
         self.opcode = opcode
         self.name = name
         self.tags = tags
@@ -182,25 +667,96 @@ class Instruction(object):
         self.stack_before = stack_before
         self.stack_after = stack_after
         self.code = code
+        # Names of the instructions a superinstruction fuses
+        self.fuses = fuses
 
     def length_get(self):
-        return len(self.operands)+1
+        return 1
     def length_set(self):
         raise AttributeError, 'length attribute is read only'
-    length = property(length_get, length_set, 'length of the instruction')
+    length = property(length_get, length_set,
+                      'length of the instruction in words, without extended_arg words')
 
 $(instruction_table)
+
+# Wordcode: every instruction is a single word of the bytecode (an
+# array('i')), holding its opcode in the low bits and its operands in
+# the high bits, split into fields of the same width (see FIELDS). An
+# operand too large for its field gets its high bits from extended_arg
+# words preceding the instruction, whose word then has the EXTENDED
+# flag set.
+OPCODE_MASK = $(opcode_mask)
+EXTENDED = OPCODE_MASK + 1
+EXTENDED_ARG = INSN_MAP['extended_arg'].opcode
+
+# The (shift, mask) of the fields of the operands, by number of operands
+$(operand_fields)
+
+def encode(insn, operands):
+    \"\"\"\\
+    Return the words of the instruction insn with operands: extended_arg
+    words for the high bits of the operands too large for their field,
+    then the word of the instruction.
+    \"\"\"
+    fields = FIELDS[len(operands)]
+    values = list(operands)
+    words = []
+    while True:
+        word = 0
+        for i, (shift, mask) in enumerate(fields):
+            if values[i] < 0:
+                raise ValueError("Negative operand for %s: %d" % (insn.name, operands[i]))
+            word |= (values[i] & mask) << shift
+            values[i] >>= mask.bit_length()
+        words.insert(0, word)
+        if not any(values):
+            break
+    for i in range(len(words)-1):
+        words[i] |= EXTENDED_ARG
+    words[-1] |= insn.opcode
+    if len(words) > 1:
+        words[-1] |= EXTENDED
+    return words
+
+def decode_operands(bytecode, ip):
+    "Return the operands of the instruction whose word is at ip."
+    word = bytecode[ip]
+    fields = FIELDS[len(INSTRUCTIONS[word & OPCODE_MASK].operands)]
+    values = [word >> shift & mask for shift, mask in fields]
+    if word & EXTENDED:
+        bits = 0
+        while ip > 0 and bytecode[ip-1] & OPCODE_MASK == EXTENDED_ARG:
+            ip -= 1
+            bits += fields[0][1].bit_length()
+            values = [value | (bytecode[ip] >> shift & mask) << bits
+                      for value, (shift, mask) in zip(values, fields)]
+    return values
+
+def decode(bytecode):
+    "Return the instructions of bytecode as [(ip, instruction, operands)]."
+    return [(ip, INSTRUCTIONS[word & OPCODE_MASK], decode_operands(bytecode, ip))
+            for ip, word in enumerate(bytecode)]
 """
 
 if __name__ == '__main__':
     iset = yaml.load(open("iset.yml").read())
+    gen_superinstructions(iset['instructions'])
 
+    if len(iset['instructions']) > 2**OPCODE_BITS:
+        raise ValueError("Too many instructions for %d bits opcodes" % OPCODE_BITS)
     env = {
+        'opcode_mask' : hex(2**OPCODE_BITS-1),
+        'operand_fields' : gen_operand_fields(iset['instructions']),
         'tags' : gen_tags(iset['tags']),
         'actions' : gen_actions(iset['instructions']),
         'instruction_table' : gen_insn_table(iset['instructions']),
         'action_table' : gen_action_table(iset['instructions']),
-        'tags_table' : gen_tags_table(iset['instructions'])
+        'tags_table' : gen_tags_table(iset['instructions']),
+        'closure_factories' : gen_closure_factories(iset['instructions']),
+        'closure_table' : gen_closure_table(iset['instructions']),
+        'fused_reload' : indent(FUSED_RELOAD, 1).rstrip('\n'),
+        'fused_loop' : gen_fused_loop(iset['instructions'],
+                                      iset.get('dispatch_order', [])).rstrip('\n')
         }
 
     py = open("iset.py", "w")
@@ -0,0 +1,651 @@
+# A tiered JIT for skime.
+#
+# Procedures start out interpreted by the closure engine. make_call
+# counts invocations and goto counts backward jumps; once a procedure
+# gets hot its bytecode is translated into Python source, compiled and
+# run in place of the interpreted body.
+#
+# The native code works one basic block at a time like the closure
+# engine, so it can be entered at every ip a context can be resumed at.
+# Operands are kept on a symbolic stack of Python expressions, so that
+# a sequence like (+ n 1) becomes a single direct call of the Python
+# function behind the primitive.
+#
+# Global procedures and primitives are inlined as constants. They are
+# guarded each time the native code is entered (and after calls which
+# may have run Scheme code): if a global was set! to something else,
+# the native code is thrown away and the procedure is interpreted
+# again. The guard is an inline cache keyed on the version of the
+# global environment, so the inlined globals are only compared again
+# after a global was assigned.
+
+from .iset   import INSN_MAP, OPCODE_MASK, decode
+from .insns  import make_call, call_procedure, closures_of, ENGINES, TAG_CTRL_FLOW, INSN_TAGS
+from .insns  import INSN_ACTION, TAG_CTX_SWITCH, has_tag
+from .prim   import Primitive, PyPrimitive
+from .proc   import Procedure, Closure
+from .env    import Box
+
+# A procedure is compiled once it was called CALL_THRESHOLD times or
+# jumped backward BACKEDGE_THRESHOLD times.
+CALL_THRESHOLD = 100
+BACKEDGE_THRESHOLD = 1000
+
+# Stop compiling a procedure after its native code was thrown away
+# MAX_DEOPTS times.
+MAX_DEOPTS = 3
+
+# Maximum number of arguments of a call in Python 2 source, calls of
+# primitives with more arguments pass them as a tuple
+MAX_CALL_ARGS = 255
+
+# Instructions of inlined primitives, with their number of arguments
+INLINE_PRIMITIVES = {
+    'add2' : 2, 'sub2' : 2, 'numeq2' : 2, 'lt2' : 2,
+    'car' : 1, 'cdr' : 1, 'cons' : 2, 'nullp' : 1
+    }
+
+class Unsupported(Exception):
+    "Raised when a procedure uses instructions the JIT can't translate."
+
+# Marks a symbolic stack entry whose value is not known at compile time
+UNKNOWN = object()
+
+# Placeholder for the check of the inlined globals in the generated code
+GUARD = '<guard>'
+
+class Translator(object):
+    """\
+    Translate the bytecode of a Procedure into the Python source of a
+    function taking and returning a context.
+    """
+    def __init__(self, proc):
+        self.proc = proc
+
+        # Depth of the global environment from the procedure environment
+        self.root = proc.env
+        self.root_depth = 0
+        while self.root.parent is not None:
+            self.root = self.root.parent
+            self.root_depth += 1
+
+        # Objects referred to by the generated code. VC holds the
+        # version of the global environment the inlined globals were
+        # last checked at.
+        self.consts = {'G' : self.root.locals, 'VC' : [self.root.version]}
+        self.const_names = {}
+        # Global slots inlined as constants: [(idx, const name)]
+        self.guards = []
+        self.inlined = {}
+
+        self.lines = []
+        self.indent = 0
+        # Symbolic operand stack: [(python expression, value)]
+        self.sym = []
+        self.ntemp = 0
+
+    ########################################
+    # Code emission helpers
+    ########################################
+    def emit(self, line):
+        self.lines.append('    '*self.indent + line)
+
+    def const(self, obj):
+        "Make obj available to the generated code, return its name."
+        name = self.const_names.get(id(obj))
+        if name is None:
+            name = 'K%d' % len(self.consts)
+            self.consts[name] = obj
+            self.const_names[id(obj)] = name
+        return name
+
+    def temp(self, expr):
+        "Evaluate expr into a new temporary, return its name."
+        name = 't%d' % self.ntemp
+        self.ntemp += 1
+        self.emit('%s = %s' % (name, expr))
+        return name
+
+    def push(self, expr, value=UNKNOWN):
+        self.sym.append((expr, value))
+
+    def take(self, n):
+        """\
+        Take n entries from the top of the stack, in stack order. Values
+        not on the symbolic stack are popped into temporaries.
+        """
+        taken = []
+        while len(taken) < n and self.sym:
+            taken.insert(0, self.sym.pop())
+        popped = []
+        while len(popped)+len(taken) < n:
+            popped.insert(0, (self.temp('pop()'), UNKNOWN))
+        return popped + taken
+
+    def take1(self):
+        return self.take(1)[0]
+
+    def flush(self):
+        "Move the symbolic stack to the real stack."
+        for expr, value in self.sym:
+            self.emit('push(%s)' % expr)
+        self.sym = []
+
+    def settle(self):
+        """\
+        Evaluate variable reads still pending on the symbolic stack, so
+        they aren't affected by a following assignment.
+        """
+        for i, (expr, value) in enumerate(self.sym):
+            if not self.is_settled(expr):
+                self.sym[i] = (self.temp(expr), value)
+
+    def is_settled(self, expr):
+        return expr[0] in 'Kt0123456789-' or expr in ('None', 'True', 'False')
+
+    def guard_check(self):
+        "Expression testing that inlined globals are unchanged."
+        return ' or '.join(['G[%d] is not %s' % (idx, name)
+                            for idx, name in self.guards])
+
+    ########################################
+    # Translation
+    ########################################
+    def decode(self):
+        """\
+        Return the instructions as [(ip, insn, operands)], the jump
+        targets and the ips a context can be resumed at.
+        """
+        insns = decode(self.proc.bytecode)
+        targets = set([0])
+        entries = set([0])
+        for ip, insn, operands in insns:
+            for name, val in zip(insn.operands, operands):
+                if name == 'ip':
+                    targets.add(val)
+            if TAG_CTRL_FLOW & INSN_TAGS[insn.opcode]:
+                entries.add(ip+1)
+        entries.update(targets)
+        return insns, targets, entries
+
+    def inline_calls(self, insns, written):
+        """\
+        Return the ips following the inlined primitives whose global
+        holds something else than a primitive which can be called
+        directly. They are called like any procedure, so the native code
+        is resumed after them.
+        """
+        ips = set()
+        for ip, insn, operands in insns:
+            if insn.name in INLINE_PRIMITIVES:
+                idx = operands[0]
+                if idx in written or \
+                   direct_primitive(self.root.locals[idx], INLINE_PRIMITIVES[insn.name]) is None:
+                    ips.add(ip+1)
+        return ips
+
+    def written_globals(self, insns):
+        "Global slots assigned by the procedure itself are never inlined."
+        written = set()
+        for ip, insn, operands in insns:
+            if insn.name == 'set_local_depth' and operands[0] == self.root_depth:
+                written.add(operands[1])
+            elif insn.name == 'set_global':
+                written.add(operands[0])
+        return written
+
+    def translate(self):
+        """\
+        Every ip the native code can be entered at gets a block, which
+        runs straight through calls and conditional jumps up to the next
+        jump target. The code between a resume point and the next jump
+        target is thus translated more than once, with different
+        symbolic stacks.
+        """
+        insns, targets, entries = self.decode()
+        written = self.written_globals(insns)
+        entries.update(self.inline_calls(insns, written))
+        index = dict([(ip, i) for i, (ip, insn, operands) in enumerate(insns)])
+        end = len(self.proc.bytecode)
+
+        body = []
+        self.lines = body
+        for start in sorted(entries):
+            if start == end:
+                continue
+            self.indent = 2
+            self.emit('if ip == %d:' % start)
+            self.indent = 3
+            self.ntemp = 0
+            self.sym = []
+            i = index[start]
+            while True:
+                ip, insn, operands = insns[i]
+                if i+1 < len(insns):
+                    next_ip = insns[i+1][0]
+                else:
+                    next_ip = end
+                if not self.translate_insn(insn, operands, ip, next_ip, written):
+                    break
+                if next_ip == end:
+                    self.flush()
+                    self.emit('ctx.ip = %d' % end)
+                    self.emit('return ctx')
+                    break
+                if next_ip in targets:
+                    self.flush()
+                    self.emit('ip = %d' % next_ip)
+                    break
+                i += 1
+        self.indent = 2
+        self.emit('return deopt(ctx)')
+
+        self.lines = []
+        self.indent = 0
+        self.emit('def native(ctx):')
+        self.indent = 1
+        self.emit('vm = ctx.vm')
+        self.emit('env = ctx.env')
+        self.emit('lvars = env.locals')
+        self.emit('stack = ctx.stack')
+        self.emit('push = stack.append')
+        self.emit('pop = stack.pop')
+        self.emit(GUARD)
+        self.emit('ip = ctx.ip')
+        self.emit('while True:')
+
+        lines = []
+        for line in self.lines + body:
+            if line.strip() == GUARD:
+                if not self.guards:
+                    continue
+                indent = line[:line.index(GUARD)]
+                lines.append(indent + 'if VC[0] != vm.env.version:')
+                lines.append(indent + '    if %s:' % self.guard_check())
+                lines.append(indent + '        return deopt(ctx)')
+                lines.append(indent + '    VC[0] = vm.env.version')
+            else:
+                lines.append(line)
+        return '\n'.join(lines) + '\n'
+
+    def global_value(self, idx, written):
+        """\
+        Return the constant name of a global that can be inlined, or None.
+        """
+        if idx in written:
+            return None
+        name = self.inlined.get(idx)
+        if name is None:
+            value = self.root.locals[idx]
+            if not isinstance(value, (Procedure, Primitive)):
+                return None
+            name = self.const(value)
+            self.inlined[idx] = name
+            self.guards.append((idx, name))
+        return name
+
+    def env_expr(self, depth):
+        return 'env' + '.parent'*depth
+
+    def translate_insn(self, insn, operands, ip, next_ip, written):
+        """\
+        Translate an instruction. Return False if the block ends with it,
+        True if translation goes on with the next instruction.
+        """
+        name = insn.name
+        if insn.fuses:
+            # A superinstruction is translated as the instructions it fuses
+            at = 0
+            for part in insn.fuses:
+                part = INSN_MAP[part]
+                n = len(part.operands)
+                if not self.translate_insn(part, operands[at:at+n], ip, next_ip, written):
+                    return False
+                at += n
+        elif name == 'push_local':
+            self.push('lvars[%d]' % operands[0])
+        elif name == 'push_local_depth':
+            depth, idx = operands
+            if depth == self.root_depth:
+                self.push_global(idx, written)
+            else:
+                self.push('%s.locals[%d]' % (self.env_expr(depth), idx))
+        elif name == 'push_global':
+            self.push_global(operands[0], written)
+        elif name == 'set_local':
+            expr, value = self.take1()
+            self.settle()
+            self.emit('lvars[%d] = %s' % (operands[0], expr))
+        elif name == 'set_local_depth':
+            depth, idx = operands
+            expr, value = self.take1()
+            self.settle()
+            if depth == self.root_depth:
+                self.emit('G[%d] = %s' % (idx, expr))
+            else:
+                self.emit('%s.locals[%d] = %s' % (self.env_expr(depth), idx, expr))
+        elif name == 'set_global':
+            expr, value = self.take1()
+            self.settle()
+            self.emit('G[%d] = %s' % (operands[0], expr))
+            self.emit('vm.env.version += 1')
+        elif name == 'push_local_box':
+            self.push('lvars[%d].value' % operands[0])
+        elif name == 'set_local_box':
+            expr, value = self.take1()
+            self.settle()
+            self.emit('lvars[%d].value = %s' % (operands[0], expr))
+        elif name == 'box_local':
+            self.settle()
+            self.emit('lvars[%d] = %s(lvars[%d])' % (operands[0], self.const(Box), operands[0]))
+        elif name == 'make_closure':
+            entries = self.take(operands[0]+1)
+            free = ', '.join([expr for expr, value in entries[1:]])
+            self.push(self.temp('%s(%s, [%s])' % (self.const(Closure), entries[0][0], free)))
+        elif name == 'push_literal':
+            lit = self.proc.literals[operands[0]]
+            if type(lit) in (int, long) and lit >= 0:
+                self.push(repr(lit))
+            else:
+                self.push(self.const(lit), lit)
+        elif name == 'push_folded':
+            self.translate_folded(self.proc.literals[operands[0]], operands[1], next_ip, written)
+            return False
+        elif name == 'guard_inlined':
+            self.translate_guard(self.proc.literals[operands[0]], operands[1], written)
+        elif name == 'push_0':
+            self.push('0')
+        elif name == 'push_1':
+            self.push('1')
+        elif name == 'push_nil':
+            self.push('None')
+        elif name == 'push_true':
+            self.push('True')
+        elif name == 'push_false':
+            self.push('False')
+        elif name == 'pop':
+            if self.sym:
+                self.sym.pop()
+            else:
+                self.emit('pop()')
+        elif name == 'extended_arg':
+            # its bits are part of the operands of the next instruction
+            pass
+        elif name == 'dup':
+            entry = self.take1()
+            self.sym.append(entry)
+            self.sym.append(entry)
+        elif name == 'fix_lexical':
+            entry = self.take1()
+            self.emit('%s.lexical_parent = env' % entry[0])
+            self.emit('env.captured = True')
+            self.sym.append(entry)
+        elif name == 'fix_lexical_pop':
+            expr, value = self.take1()
+            self.emit('%s.lexical_parent = env' % expr)
+            self.emit('env.captured = True')
+        elif name == 'goto':
+            self.flush()
+            self.emit('ip = %d' % operands[0])
+            self.emit('continue')
+            return False
+        elif name in ('goto_if_false', 'goto_if_not_false'):
+            expr, value = self.take1()
+            self.flush()
+            if name == 'goto_if_false':
+                self.emit('if %s is False:' % expr)
+            else:
+                self.emit('if %s is not False:' % expr)
+            self.emit('    ip = %d' % operands[0])
+            self.emit('    continue')
+        elif name in ('call', 'call_pop'):
+            # The pop following call_pop is translated on its own
+            self.translate_call(False, operands[0], next_ip)
+        elif name == 'tail_call':
+            self.translate_call(True, operands[0], next_ip)
+            return False
+        elif name in INLINE_PRIMITIVES:
+            # Called like the primitive, which the global is inlined as
+            self.push_global(operands[0], written)
+            self.translate_call(False, INLINE_PRIMITIVES[name], next_ip)
+        elif name in ('call_known', 'tail_call_known'):
+            # The global is inlined and guarded like any other, which
+            # covers the check of call_known
+            idx, argc = operands[0], operands[1]
+            self.push_global(idx, written)
+            tail = name == 'tail_call_known'
+            self.translate_call(tail, argc, next_ip)
+            return not tail
+        elif name in ('call_direct', 'tail_call_direct'):
+            proc, argc, freec = self.proc.literals[operands[0]], operands[1], operands[2]
+            self.translate_direct_call(name == 'tail_call_direct', proc, argc, freec, next_ip)
+            return False
+        elif name == 'tail_call_self':
+            idx, argc = operands
+            self.push_global(idx, written)
+            self.translate_self_call(argc)
+            return False
+        elif name == 'ret':
+            # the return value is left on the stack for the caller
+            self.flush()
+            self.emit('pctx = ctx.parent')
+            self.emit('vm.frames.release(ctx)')
+            self.emit('return pctx')
+            return False
+        else:
+            raise Unsupported(name)
+        return True
+
+    def push_global(self, idx, written):
+        "Push a global, inlined as a constant if possible."
+        const = self.global_value(idx, written)
+        if const is not None:
+            self.push(const, self.consts[const])
+        else:
+            self.push('G[%d]' % idx)
+
+    def translate_folded(self, folded, target, next_ip, written):
+        """\
+        The value of a folded call is a constant if the primitives it
+        calls can be inlined, which guards them like any other global.
+        Else push_folded checks them as it does in bytecode.
+        """
+        if all([idx not in written and self.root.locals[idx] is prim
+                for idx, prim in folded.guards]):
+            for idx, prim in folded.guards:
+                self.global_value(idx, written)
+            self.push(self.const(folded.value), folded.value)
+            self.flush()
+        else:
+            name = self.const(folded)
+            self.flush()
+            self.emit('if %s.version == vm.env.version or %s.check(vm.env):' % (name, name))
+            self.emit('    push(%s.value)' % name)
+            self.emit('else:')
+            self.emit('    ip = %d' % next_ip)
+            self.emit('    continue')
+        self.emit('ip = %d' % target)
+        self.emit('continue')
+
+    def translate_guard(self, guard, target, written):
+        """\
+        An inlined procedure needs no check if its global can be
+        inlined, which guards it like any other. Else guard_inlined
+        checks it as it does in bytecode.
+        """
+        if all([idx not in written and self.root.locals[idx] is value
+                for idx, value in guard.guards]):
+            for idx, value in guard.guards:
+                self.global_value(idx, written)
+        else:
+            name = self.const(guard)
+            self.flush()
+            self.emit('if %s.version != vm.env.version and not %s.check(vm.env):' % (name, name))
+            self.emit('    ip = %d' % target)
+            self.emit('    continue')
+
+    def translate_call(self, tail, argc, next_ip):
+        callee = self.take1()
+        prim = direct_primitive(callee[1], argc)
+        if prim is not None:
+            # Call the Python function behind the primitive directly
+            args = ['vm'] + [expr for expr, value in self.take(argc)]
+            if len(args) > MAX_CALL_ARGS:
+                args = ['*(%s)' % ', '.join(args)]
+            result = self.temp('%s(%s)' % (self.const(prim.proc), ', '.join(args)))
+            if tail:
+                self.emit('push(%s)' % result)
+                self.emit('pctx = ctx.parent')
+                self.emit('vm.frames.release(ctx)')
+                self.emit('return pctx')
+            else:
+                self.push(result)
+            return
+
+        self.sym.append(callee)
+        self.flush()
+        if tail:
+            # a self tail call may run ctx again from its start
+            self.emit('return make_call(ctx, %d, tail=True)' % argc)
+            return
+        self.emit('nctx = make_call(ctx, %d)' % argc)
+        self.emit('ctx.ip = %d' % next_ip)
+        self.emit('if nctx is not ctx:')
+        self.emit('    return nctx')
+        # A primitive was called, it might have run Scheme code assigning
+        # an inlined global. Guards are only known once the whole
+        # procedure is translated, see translate.
+        self.emit(GUARD)
+
+    def translate_direct_call(self, tail, proc, argc, freec, next_ip):
+        "A procedure that never escapes is called without a closure."
+        free = 'None'
+        if freec > 0:
+            free = '[%s]' % ', '.join([expr for expr, value in self.take(freec)])
+        self.flush()
+        if tail:
+            self.emit('return call_procedure(ctx, %s, %d, True, %s)' %
+                      (self.const(proc), argc, free))
+            return
+        self.emit('nctx = call_procedure(ctx, %s, %d, False, %s)' %
+                  (self.const(proc), argc, free))
+        self.emit('ctx.ip = %d' % next_ip)
+        self.emit('return nctx')
+
+    def translate_self_call(self, argc):
+        """\
+        A procedure tail-calling itself with a fixed number of arguments
+        loops back to ip 0, with the arguments rebound in place (see
+        call_procedure).
+        """
+        proc = self.proc
+        if proc.fixed_argc != proc.argc:
+            self.translate_call(True, argc, None)
+            return
+        callee = self.take1()
+        args = [self.temp(expr) if not self.is_settled(expr) else expr
+                for expr, value in self.take(argc)]
+        self.flush()
+        self.emit('if %s is %s and not ctx.captured and not env.captured:' %
+                  (callee[0], self.const(proc)))
+        self.indent += 1
+        if len(proc.env.locals) > argc:
+            self.emit('lvars[:] = %s' % self.const(proc.env.locals))
+        for i, expr in enumerate(args):
+            self.emit('lvars[%d] = %s' % (i, expr))
+        self.emit('ip = 0')
+        self.emit('continue')
+        self.indent -= 1
+        for expr in args:
+            self.emit('push(%s)' % expr)
+        self.sym.append(callee)
+        self.flush()
+        self.emit('return make_call(ctx, %d, tail=True)' % argc)
+
+def direct_primitive(value, argc):
+    "Return value if it is a primitive the native code can call directly."
+    if not isinstance(value, PyPrimitive) or value.reentrant:
+        return None
+    try:
+        value.check_arity(argc)
+    except Exception:
+        return None
+    return value
+
+def translate(proc):
+    "Return the Python source of the native code of proc and its constants."
+    tr = Translator(proc)
+    source = tr.translate()
+    return source, tr.consts
+
+def compile_native(proc):
+    """\
+    Compile proc into native code. Set and return proc.native, which is
+    False if the procedure can't be compiled.
+    """
+    try:
+        source, consts = translate(proc)
+        code = compile(source, '<native procedure at %X>' % id(proc), 'exec')
+    except (Unsupported, SyntaxError):
+        # SyntaxError for what Python can't compile, e.g. too deeply
+        # nested expressions
+        proc.native = False
+        return False
+
+    namespace = dict(consts)
+    namespace['make_call'] = make_call
+    namespace['call_procedure'] = call_procedure
+    namespace['deopt'] = deopt
+    exec code in namespace
+    proc.native = namespace['native']
+    return proc.native
+
+def deopt(ctx):
+    """\
+    Throw away the native code of the procedure run by ctx and go back
+    to interpreting it. The procedure may get compiled again (with the
+    new values of its globals) once it is hot again.
+    """
+    proc = ctx.form
+    proc.native = None
+    proc.calls = 0
+    proc.backedges = 0
+    proc.deopts += 1
+    if proc.deopts >= MAX_DEOPTS:
+        proc.native = False
+    return ctx
+
+def run_jit(ctx):
+    """\
+    Tiered run loop: procedures are run by the closure engine until
+    they get hot, then by their native code.
+    """
+    form = ctx.form
+    code = closures_of(ctx)
+    while ctx.ip < len(ctx.bytecode):
+        native = form.native
+        block = code[ctx.ip]
+        if native:
+            nctx = native(ctx)
+        elif block is not None:
+            nctx = block(ctx)
+            if native is None and (form.calls >= CALL_THRESHOLD or
+                                   form.backedges >= BACKEDGE_THRESHOLD):
+                compile_native(form)
+        else:
+            # The native code was thrown away during a call resumed
+            # after an inlined primitive (see Translator.inline_calls),
+            # which is no block start. The instructions up to the next
+            # one are run by their table action.
+            opcode = ctx.bytecode[ctx.ip] & OPCODE_MASK
+            nctx = INSN_ACTION[opcode](ctx)
+            if not has_tag(opcode, TAG_CTX_SWITCH):
+                nctx = ctx
+        ctx = nctx
+        # see run_closure
+        if ctx.form is not form:
+            form = ctx.form
+            code = closures_of(ctx)
+    return ctx.pop()
+
+ENGINES['jit'] = run_jit
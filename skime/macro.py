@@ -5,6 +5,9 @@ from .errors       import SyntaxError
 class Macro(object):
     def __init__(self, env, body):
         self.lexical_parent = env
+        # The literals and rules of the syntax-rules, kept to write the
+        # macro out, see skc.py
+        self.body = body
         try:
             # Process literals
             literals = body.first
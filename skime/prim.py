@@ -2,7 +2,7 @@ import math
 
 from .types.symbol import Symbol as sym
 from .types.pair   import Pair as pair
-from .proc         import Procedure
+from .proc         import Procedure, Closure
 from .errors       import WrongArgNumber
 from .errors       import WrongArgType
 from .errors       import MiscError
@@ -15,7 +15,13 @@ class Primitive(object):
     by calling prim.check_arity(3). Then the vm object is inserted as the first
     argument and the primitive called: prim.call(vm, 1, 2, 3). The vm is always
     the first argument of all primitives, but not count as argc.
+
+    name is the global name the primitive was registered under by
+    load_primitives, which identifies it in compiled code written out
+    (see skc.signature). None for primitives defined elsewhere.
     """
+    name = None
+
     def check_arity(self, argc):
         "Check whether this primitive is OK to execute with argc arguments."
         raise TypeError("check_arity is not implemented in abstract class Primitive")
@@ -27,17 +33,24 @@ class Primitive(object):
 
 class PyPrimitive(Primitive):
     "Primitive wrapping a Python callable."
-    def __init__(self, proc, arity):
+    def __init__(self, proc, arity, reentrant=False, pure=False):
         """\
         Create a PyPrimitive.
 
-          proc  should be a Python callable.
-          arity can be a tuple specifying the min and max number of arguments.
-                either min or max or both can be -1, which means it is of no
-                bound.
+          proc      should be a Python callable.
+          arity     can be a tuple specifying the min and max number of arguments.
+                    either min or max or both can be -1, which means it is of no
+                    bound.
+          reentrant should be True if proc may run Scheme code through the
+                    vm (e.g. apply).
+          pure      should be True if proc has no side effect and its result
+                    only depends on its arguments, so that calls on constants
+                    can be computed at compile time (e.g. +).
         """
         self.proc = proc
         self.arity = arity
+        self.reentrant = reentrant
+        self.pure = pure
         
     def check_arity(self, argc):
         min, max = self.arity
@@ -54,6 +67,49 @@ class PyPrimitive(Primitive):
     def __str__(self):
         return "<skime primitive => %s>" % self.proc.__name__
 
+class Apply(Primitive):
+    """\
+    The apply primitive. A call of apply from Scheme code is replaced
+    by a call of the procedure it is given (see make_call), so that the
+    procedure runs in the run loop of the caller instead of a new one.
+    """
+    def check_arity(self, argc):
+        if argc < 1:
+            raise WrongArgNumber("apply expects at least 1 arguments, but got %d" % argc)
+
+    def call(self, vm, proc, *args):
+        return vm.apply(proc, apply_arguments(args))
+
+    def __str__(self):
+        return "<skime primitive => apply>"
+
+class PyTrampoline(PyPrimitive):
+    """\
+    Primitive calling procedures (e.g. map), made of two Python
+    functions. Instead of calling a procedure through vm.apply, which
+    runs it in a run loop of its own, proc(vm, *args) returns a request
+    (proc, args, state) to call proc with args in the run loop of the
+    caller of the primitive (see call_trampoline). resume(vm, state,
+    result) is then called with the result of the call, and returns
+    the next request. (None, value, None) returns value.
+
+    The state is kept on the operand stack, so that continuations
+    captured by the procedures called save it. It should not be
+    mutated: a continuation may resume the same state more than once.
+    """
+    def __init__(self, proc, resume, arity):
+        PyPrimitive.__init__(self, proc, arity, reentrant=True)
+        self.resume = resume
+        # The form of the contexts running the calls of the primitive,
+        # made by call_trampoline
+        self.form = None
+
+    def call(self, vm, *args):
+        proc, value, state = self.proc(vm, *args)
+        while proc is not None:
+            proc, value, state = self.resume(vm, state, vm.apply(proc, value))
+        return value
+
 class PyCallable(Primitive):
     def __init__(self, proc):
         self.proc = proc
@@ -66,28 +122,28 @@ class PyCallable(Primitive):
 
 def load_primitives(env):
     "Load primitives into an Environment."
-    env.alloc_local('+', PyPrimitive(plus, (-1, -1)))
-    env.alloc_local('-', PyPrimitive(minus, (1, -1)))
-    env.alloc_local('*', PyPrimitive(mul, (-1, -1)))
-    env.alloc_local('/', PyPrimitive(div, (1, -1)))
-    env.alloc_local('=', PyPrimitive(equal, (-1, -1)))
-    env.alloc_local('<', PyPrimitive(less, (2, -1)))
-    env.alloc_local('>', PyPrimitive(more, (2, -1)))
-    env.alloc_local('<=', PyPrimitive(less_equal, (2, -1)))
-    env.alloc_local('>=', PyPrimitive(more_equal, (2, -1)))
-
-    env.alloc_local('equal?', PyPrimitive(prim_equal, (2, 2)))
-    env.alloc_local('eq?', PyPrimitive(prim_eqv, (2, 2)))
-    env.alloc_local('eqv?', PyPrimitive(prim_eqv, (2, 2)))
-
-    env.alloc_local("log", PyPrimitive(prim_log, (1, 1)))
-    env.alloc_local("exp", PyPrimitive(prim_exp, (1, 1)))
-    env.alloc_local("sin", PyPrimitive(prim_sin, (1, 1)))
-    env.alloc_local("cos", PyPrimitive(prim_cos, (1, 1)))
-    env.alloc_local("tan", PyPrimitive(prim_tan, (1, 1)))
-    env.alloc_local("abs", PyPrimitive(prim_abs, (1, 1)))
+    env.alloc_local('+', PyPrimitive(plus, (-1, -1), pure=True))
+    env.alloc_local('-', PyPrimitive(minus, (1, -1), pure=True))
+    env.alloc_local('*', PyPrimitive(mul, (-1, -1), pure=True))
+    env.alloc_local('/', PyPrimitive(div, (1, -1), pure=True))
+    env.alloc_local('=', PyPrimitive(equal, (-1, -1), pure=True))
+    env.alloc_local('<', PyPrimitive(less, (2, -1), pure=True))
+    env.alloc_local('>', PyPrimitive(more, (2, -1), pure=True))
+    env.alloc_local('<=', PyPrimitive(less_equal, (2, -1), pure=True))
+    env.alloc_local('>=', PyPrimitive(more_equal, (2, -1), pure=True))
+
+    env.alloc_local('equal?', PyPrimitive(prim_equal, (2, 2), pure=True))
+    env.alloc_local('eq?', PyPrimitive(prim_eqv, (2, 2), pure=True))
+    env.alloc_local('eqv?', PyPrimitive(prim_eqv, (2, 2), pure=True))
+
+    env.alloc_local("log", PyPrimitive(prim_log, (1, 1), pure=True))
+    env.alloc_local("exp", PyPrimitive(prim_exp, (1, 1), pure=True))
+    env.alloc_local("sin", PyPrimitive(prim_sin, (1, 1), pure=True))
+    env.alloc_local("cos", PyPrimitive(prim_cos, (1, 1), pure=True))
+    env.alloc_local("tan", PyPrimitive(prim_tan, (1, 1), pure=True))
+    env.alloc_local("abs", PyPrimitive(prim_abs, (1, 1), pure=True))
     
-    env.alloc_local('not', PyPrimitive(prim_not, (1, 1)))
+    env.alloc_local('not', PyPrimitive(prim_not, (1, 1), pure=True))
         
     env.alloc_local('first', PyPrimitive(prim_first, (1, 1)))
     env.alloc_local('rest', PyPrimitive(prim_rest, (1, 1)))
@@ -112,43 +168,47 @@ def load_primitives(env):
                    ((int, long, float), "real?"),
                    ((int, long, float, complex), "complex?"),
                    ((int, long), "integer?"),
-                   ((Procedure, Primitive), "procedure?")]:
-        env.alloc_local(name, PyPrimitive(make_type_predict(t), (1, 1)))
-
-    env.alloc_local('exact?', PyPrimitive(prim_exact_p, (1, 1)))
-    env.alloc_local('inexact?', PyPrimitive(prim_inexact_p, (1, 1)))
-    env.alloc_local('zero?', PyPrimitive(prim_zero_p, (1, 1)))
-    env.alloc_local('positive?', PyPrimitive(prim_positive_p, (1, 1)))
-    env.alloc_local('negative?', PyPrimitive(prim_negative_p, (1, 1)))
-    env.alloc_local('even?', PyPrimitive(prim_even_p, (1, 1)))
-    env.alloc_local('odd?', PyPrimitive(prim_odd_p, (1, 1)))
-    env.alloc_local('max', PyPrimitive(prim_max, (1, -1)))
-    env.alloc_local('min', PyPrimitive(prim_min, (1, -1)))
-    env.alloc_local('quotient', PyPrimitive(prim_quotient, (2, 2)))
-    env.alloc_local('modulo', PyPrimitive(prim_modulo, (2, 2)))
-    env.alloc_local('remainder', PyPrimitive(prim_remainder, (2, 2)))
-    env.alloc_local('gcd', PyPrimitive(prim_gcd, (-1, -1)))
-    env.alloc_local('lcm', PyPrimitive(prim_lcm, (-1, -1)))
-    env.alloc_local('floor', PyPrimitive(prim_floor, (1, 1)))
-    env.alloc_local('ceiling', PyPrimitive(prim_ceiling, (1, 1)))
-    env.alloc_local('truncate', PyPrimitive(prim_truncate, (1, 1)))
-    env.alloc_local('round', PyPrimitive(prim_round, (1, 1)))
-    env.alloc_local('asin', PyPrimitive(prim_asin, (1, 1)))
-    env.alloc_local('acos', PyPrimitive(prim_acos, (1, 1)))
-    env.alloc_local('atan', PyPrimitive(prim_atan, (1, 2)))
-    env.alloc_local('sqrt', PyPrimitive(prim_sqrt, (1, 1)))
-    env.alloc_local('expt', PyPrimitive(prim_expt, (2, 2)))
-    env.alloc_local('null?', PyPrimitive(prim_null_p, (1, 1)))
+                   ((Procedure, Closure, Primitive), "procedure?")]:
+        env.alloc_local(name, PyPrimitive(make_type_predict(t), (1, 1), pure=True))
+
+    env.alloc_local('exact?', PyPrimitive(prim_exact_p, (1, 1), pure=True))
+    env.alloc_local('inexact?', PyPrimitive(prim_inexact_p, (1, 1), pure=True))
+    env.alloc_local('zero?', PyPrimitive(prim_zero_p, (1, 1), pure=True))
+    env.alloc_local('positive?', PyPrimitive(prim_positive_p, (1, 1), pure=True))
+    env.alloc_local('negative?', PyPrimitive(prim_negative_p, (1, 1), pure=True))
+    env.alloc_local('even?', PyPrimitive(prim_even_p, (1, 1), pure=True))
+    env.alloc_local('odd?', PyPrimitive(prim_odd_p, (1, 1), pure=True))
+    env.alloc_local('max', PyPrimitive(prim_max, (1, -1), pure=True))
+    env.alloc_local('min', PyPrimitive(prim_min, (1, -1), pure=True))
+    env.alloc_local('quotient', PyPrimitive(prim_quotient, (2, 2), pure=True))
+    env.alloc_local('modulo', PyPrimitive(prim_modulo, (2, 2), pure=True))
+    env.alloc_local('remainder', PyPrimitive(prim_remainder, (2, 2), pure=True))
+    env.alloc_local('gcd', PyPrimitive(prim_gcd, (-1, -1), pure=True))
+    env.alloc_local('lcm', PyPrimitive(prim_lcm, (-1, -1), pure=True))
+    env.alloc_local('floor', PyPrimitive(prim_floor, (1, 1), pure=True))
+    env.alloc_local('ceiling', PyPrimitive(prim_ceiling, (1, 1), pure=True))
+    env.alloc_local('truncate', PyPrimitive(prim_truncate, (1, 1), pure=True))
+    env.alloc_local('round', PyPrimitive(prim_round, (1, 1), pure=True))
+    env.alloc_local('asin', PyPrimitive(prim_asin, (1, 1), pure=True))
+    env.alloc_local('acos', PyPrimitive(prim_acos, (1, 1), pure=True))
+    env.alloc_local('atan', PyPrimitive(prim_atan, (1, 2), pure=True))
+    env.alloc_local('sqrt', PyPrimitive(prim_sqrt, (1, 1), pure=True))
+    env.alloc_local('expt', PyPrimitive(prim_expt, (2, 2), pure=True))
+    env.alloc_local('null?', PyPrimitive(prim_null_p, (1, 1), pure=True))
     env.alloc_local('list?', PyPrimitive(prim_list_p, (1, 1)))
 
-    env.alloc_local('apply', PyPrimitive(prim_apply, (1, -1)))
-    env.alloc_local('map', PyPrimitive(prim_map, (2, -1)))
+    env.alloc_local('apply', Apply())
+    env.alloc_local('map', PyTrampoline(prim_map, prim_map_resume, (2, -1)))
 
-    env.alloc_local('string->symbol', PyPrimitive(prim_string_to_symbol, (1, 1)))
-    env.alloc_local('symbol->string', PyPrimitive(prim_symbol_to_string, (1, 1)))
-    env.alloc_local('number->string', PyPrimitive(prim_number_to_string, (1, 2)))
-    env.alloc_local('string->number', PyPrimitive(prim_string_to_number, (1, 2)))
-    env.alloc_local('string-append', PyPrimitive(prim_string_append, (-1, -1)))
+    env.alloc_local('string->symbol', PyPrimitive(prim_string_to_symbol, (1, 1), pure=True))
+    env.alloc_local('symbol->string', PyPrimitive(prim_symbol_to_string, (1, 1), pure=True))
+    env.alloc_local('number->string', PyPrimitive(prim_number_to_string, (1, 2), pure=True))
+    env.alloc_local('string->number', PyPrimitive(prim_string_to_number, (1, 2), pure=True))
+    env.alloc_local('string-append', PyPrimitive(prim_string_append, (-1, -1), pure=True))
+
+    for name, value in zip(env.scope.names, env.locals):
+        if isinstance(value, Primitive) and value.name is None:
+            value.name = name
 
 def type_error_decorator(meth):
     "Decorate method to catch Python TypeError and raise skime WrongArgType"
@@ -487,9 +547,10 @@ def prim_list(vm, *args):
     return lst
 
 
-def prim_apply(vm, proc, *args):
+def apply_arguments(args):
+    "Return the list of arguments apply calls its procedure with."
     if len(args) == 0:
-        return vm.apply(proc, args)
+        return []
     argv = list(args[:-1])
     arglst = args[-1]
     while isinstance(arglst, pair):
@@ -497,33 +558,42 @@ def prim_apply(vm, proc, *args):
         arglst = arglst.rest
     if arglst is not None:
         raise WrongArgType("The last argument of apply should be a valid list, but got %s" % args[-1])
-    return vm.apply(proc, argv)
+    return argv
 
 def prim_map(vm, proc, *lists):
-    res = []
-    while True:
-        args = []
-        end = False
-        lists = list(lists)
-        for i in range(len(lists)):
-            lst = lists[i]
-            if not isinstance(lst, pair):
-                if lst is None:
-                    end = True
-                else:
-                    raise WrongArgType("Arguments of map should be valid lists.")
+    return map_request(proc, lists, None)
+
+def prim_map_resume(vm, state, value):
+    proc, lists, results = state
+    return map_request(proc, lists, pair(value, results))
+
+def map_request(proc, lists, results):
+    """\
+    Return the request of map calling proc on the first elements of
+    lists, or returning the results (collected in reverse order) if
+    they are empty.
+    """
+    args = []
+    rests = []
+    end = False
+    for lst in lists:
+        if not isinstance(lst, pair):
+            if lst is None:
+                end = True
             else:
-                if end:
-                    raise MiscError("Lists supplied to map should be all of the same length.")
-                args.append(lst.first)
-                lists[i] = lst.rest
-        if end:
-            break
-        res.append(vm.apply(proc, args))
-    rest = None
-    for x in reversed(res):
-        rest = pair(x, rest)
-    return rest
+                raise WrongArgType("Arguments of map should be valid lists.")
+        else:
+            if end:
+                raise MiscError("Lists supplied to map should be all of the same length.")
+            args.append(lst.first)
+            rests.append(lst.rest)
+    if end:
+        rest = None
+        while results is not None:
+            rest = pair(results.first, rest)
+            results = results.rest
+        return (None, rest, None)
+    return (proc, args, (proc, tuple(rests), results))
 
 def prim_string_to_symbol(vm, name):
     type_check(name, str)
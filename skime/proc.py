@@ -24,7 +24,30 @@ class Procedure(object):
         else:
             self.fixed_argc = self.argc
 
-        self.literals = list(builder.literals)
+        # Shared with the form and procedures of the compilation unit
+        self.literals = builder.literals
+
+        # The names of the arguments and the body of the procedure if
+        # its calls can be inlined, see Compiler.inlinable
+        self.inline = builder.inline
+
+        # Basic block closures of the bytecode, translated on first
+        # call by the closure engine
+        self.closures = None
+
+        # Invocation and backward jump counters, used by the JIT to
+        # find hot procedures
+        self.calls = 0
+        self.backedges = 0
+        # Native code compiled by the JIT: None until the procedure gets
+        # hot, False if it can't be (or is no longer) compiled
+        self.native = None
+        # Number of times the native code was thrown away
+        self.deopts = 0
+
+        # Environments of returned calls that can be reused, see
+        # FramePool
+        self.free_envs = []
 
     def lexical_parent_get(self):
         return self.env.parent
@@ -70,3 +93,18 @@ class Procedure(object):
         io.close()
 
         return content
+
+class Closure(object):
+    """\
+    A Procedure with the values of its free variables, created by the
+    make_closure instruction. The values are copied into the last
+    locals of the environment of each call, see compiler/freevars.py.
+    """
+    __slots__ = ('proc', 'free')
+
+    def __init__(self, proc, free):
+        self.proc = proc
+        self.free = free
+
+    def __str__(self):
+        return '<Closure proc=%X, free=%s>' % (id(self.proc), self.free)
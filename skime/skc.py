@@ -0,0 +1,380 @@
+# The .skc format of compiled code.
+#
+# A compilation unit is the Form returned by Compiler.compile, with
+# everything its bytecode refers to: the procedures nested in it, their
+# literal pool (shared by the unit, see Builder.get_literal_idx), the
+# forms of the macro expansions it contains and the compile time
+# environments of all of them. dumps writes it out and loads rebuilds
+# it against a VM, without running the parser or the compiler.
+#
+# A file is a fixed header, checked before anything else is read, and
+# the unit as nested tuples and lists of plain Python values written by
+# marshal:
+#
+#   (global names, global macros, environments, pools, procedures,
+#    forms, dynamic closures)
+#
+# Objects refer to each other by their index in those tables, the main
+# form is the first one. Environments are (parent, names, name map,
+# macros), where parent -1 is the global environment. Literals are
+# tagged tuples, see Dumper.literal. The dynamic closures of macro
+# expansions have a table of their own as they are shared by several
+# pools: fix_lexical_pop sets the environment of the closure the form
+# of the expansion then refers to.
+#
+# The bytecode addresses the variables of the global environment by
+# index, so the names of the global environment at compile time are
+# written out too. Loading allocates the missing ones, in the same
+# order, and fails if a name has another index in the VM: a unit loads
+# in a VM set up like the one it was compiled in, e.g. by loading the
+# same units before it.
+#
+# Values of the global environment the unit refers to (inlined
+# primitives, procedures called directly, guards) are written as their
+# index and a signature of the value, see signature. They are read from
+# the VM at load time if the global still has a value of the same
+# signature, or else replaced by STALE, so that the guards of the code
+# fail like after an assignment of the global.
+
+import sys
+import struct
+import marshal
+from array            import array
+from hashlib          import md5
+
+from .iset            import INSTRUCTIONS, FIELDS, OPCODE_MASK
+from .env             import Environment, Undef
+from .form            import Form
+from .proc            import Procedure
+from .prim            import Primitive, PyPrimitive
+from .macro           import Macro, DynamicClosure, SymbolClosure
+from .types.pair      import Pair
+from .types.symbol    import Symbol
+from .compiler.compiler import Guard, Folded
+from .errors          import SerializeError
+
+MAGIC = 'SKC\0'
+# Incremented whenever the layout of the unit changes
+VERSION = 1
+# The bytecode is only valid for the instruction set it was compiled for
+ISET_DIGEST = md5(repr(([(insn.name, insn.operands) for insn in INSTRUCTIONS],
+                        FIELDS, OPCODE_MASK))).digest()
+# Magic, version, instruction set digest and byte order of the bytecode
+HEADER = struct.Struct('<4sH16sc')
+
+# Literals written as they are by marshal
+CONSTANT_TYPES = (int, long, float, complex, bool, str, unicode, type(None))
+
+class Stale(object):
+    "Never the value of a global, see signature."
+    def __repr__(self):
+        return '<stale>'
+
+STALE = Stale()
+
+def signature(value):
+    """\
+    Return what the code compiled for value depends on: the name a
+    primitive was registered under (or the module and name of its Python
+    function, for the primitives load_primitives didn't register), or
+    the bytecode and inlined body of a procedure. None if value can't be
+    referred to by a .skc file.
+    """
+    if isinstance(value, Primitive):
+        if value.name is not None:
+            return (type(value).__name__, value.name)
+        if isinstance(value, PyPrimitive):
+            return (type(value).__name__, value.proc.__module__, value.proc.__name__)
+        return (type(value).__name__,)
+    if type(value) is Procedure:
+        return ('Procedure', value.argc, value.fixed_argc,
+                value.bytecode.tostring(), str(value.inline))
+    return None
+
+def dumps(form):
+    "Return the .skc string of the compilation unit of form."
+    genv = form.env
+    while genv.parent is not None:
+        genv = genv.parent
+    if genv.vm is None or genv is not genv.vm.env:
+        raise SerializeError("Form not compiled in the environment of a VM")
+    dumper = Dumper(genv)
+    dumper.form(form)
+    unit = (list(genv.scope.names), dumper.macros(genv), dumper.envs,
+            dumper.pools, dumper.procs, dumper.forms, dumper.closures)
+    return HEADER.pack(MAGIC, VERSION, ISET_DIGEST, sys.byteorder[0]) + \
+           marshal.dumps(unit, 2)
+
+def dump(form, io):
+    "Write the compilation unit of form to the file io."
+    io.write(dumps(form))
+
+def loads(data, vm):
+    "Rebuild the compilation unit of a .skc string in vm, return its form."
+    if len(data) < HEADER.size:
+        raise SerializeError("Truncated .skc data")
+    magic, version, digest, byteorder = HEADER.unpack(data[:HEADER.size])
+    if magic != MAGIC:
+        raise SerializeError("Not .skc data")
+    if version != VERSION:
+        raise SerializeError("Unsupported .skc version: %d" % version)
+    if digest != ISET_DIGEST:
+        raise SerializeError(".skc data compiled for another instruction set")
+    try:
+        unit = marshal.loads(data[HEADER.size:])
+    except (EOFError, ValueError, TypeError), e:
+        raise SerializeError("Corrupted .skc data: %s" % e)
+    return Loader(vm, byteorder != sys.byteorder[0]).load(unit)
+
+def load(io, vm):
+    "Rebuild the compilation unit of the file io in vm, return its form."
+    return loads(io.read(), vm)
+
+class Dumper(object):
+    """\
+    Flatten a compilation unit into the tables written by dumps. Each
+    object gets its index in its table when it is first met, before its
+    content is flattened, so that cycles (a procedure in the pool it
+    refers to) end there.
+    """
+    def __init__(self, genv):
+        self.genv = genv
+        # Index of the values of the global environment
+        self.globals = dict([(id(value), idx) for idx, value in enumerate(genv.locals)])
+        self.envs = []
+        self.pools = []
+        self.procs = []
+        self.forms = []
+        self.closures = []
+        # Indexes of the objects in the tables, by id
+        self.index = {}
+
+    def add(self, table, obj):
+        """\
+        Return the index of obj in table and whether it was just added,
+        its entry is then to be filled in.
+        """
+        idx = self.index.get(id(obj))
+        if idx is not None:
+            return idx, False
+        idx = self.index[id(obj)] = len(table)
+        table.append(None)
+        return idx, True
+
+    def env(self, env):
+        if env is self.genv:
+            return -1
+        if env is None:
+            raise SerializeError("Environment out of the global environment")
+        idx, new = self.add(self.envs, env)
+        if new:
+            self.envs[idx] = (self.env(env.parent), list(env.scope.names),
+                              dict(env.scope.map), self.macros(env))
+        return idx
+
+    def macros(self, env):
+        "The macros defined in env, as (index, body)."
+        return [(i, self.literal(value.body)) for i, value in enumerate(env.locals)
+                if isinstance(value, Macro) and value.lexical_parent is env]
+
+    def pool(self, literals):
+        idx, new = self.add(self.pools, literals)
+        if new:
+            self.pools[idx] = [self.literal(lit) for lit in literals]
+        return idx
+
+    def form(self, form):
+        idx, new = self.add(self.forms, form)
+        if new:
+            self.forms[idx] = (self.env(form.env), form.bytecode.tostring(),
+                               self.pool(form.literals))
+        return idx
+
+    def proc(self, proc):
+        idx, new = self.add(self.procs, proc)
+        if new:
+            inline = None
+            if proc.inline is not None:
+                args, body = proc.inline
+                inline = (list(args), self.literal(body))
+            self.procs[idx] = (self.env(proc.env), proc.bytecode.tostring(),
+                               self.pool(proc.literals), proc.argc,
+                               proc.fixed_argc != proc.argc, inline)
+        return idx
+
+    def closure(self, closure):
+        idx, new = self.add(self.closures, closure)
+        if new:
+            self.closures[idx] = (type(closure) is SymbolClosure,
+                                  self.env(closure.lexical_parent),
+                                  self.literal(closure.expression),
+                                  self.form(closure.form))
+        return idx
+
+    def literal(self, lit):
+        """\
+        Return a literal as a tagged tuple:
+
+          ('c', value)                  constant
+          ('y', name)                   symbol
+          ('l', [element...], tail)     list, tail is a literal
+          ('p', proc)                   procedure of the unit
+          ('g', idx, signature)         value of a global
+          ('G', guards)                 Guard, guards are (idx, literal)
+          ('F', value, guards)          Folded
+          ('d', closure)                DynamicClosure or SymbolClosure
+        """
+        t = type(lit)
+        if t in CONSTANT_TYPES:
+            return ('c', lit)
+        if t is Symbol:
+            return ('y', lit.name)
+        if t is Pair:
+            elements = []
+            while type(lit) is Pair:
+                elements.append(self.literal(lit.first))
+                lit = lit.rest
+            return ('l', elements, self.literal(lit))
+        if t is Procedure and id(lit.literals) in self.index:
+            # the procedures of the unit share the pools of its forms
+            return ('p', self.proc(lit))
+        if t is Folded:
+            return ('F', self.literal(lit.value), self.guards(lit))
+        if t is Guard:
+            return ('G', self.guards(lit))
+        if t in (DynamicClosure, SymbolClosure):
+            return ('d', self.closure(lit))
+        idx = self.globals.get(id(lit))
+        if idx is not None and self.genv.locals[idx] is lit and \
+               signature(lit) is not None:
+            return ('g', idx, signature(lit))
+        raise SerializeError("Can't write out the literal %s" % (lit,))
+
+    def guards(self, guard):
+        return [(idx, self.literal(value)) for idx, value in guard.guards]
+
+class Unit(object):
+    """\
+    Stands for the builder of a loaded form or procedure, with the
+    attributes Form and Procedure are built from.
+    """
+    def __init__(self, env, literals, argc=0, rest_arg=False):
+        self.env = env
+        self.literals = literals
+        self.args = [None] * argc
+        self.rest_arg = rest_arg
+        self.inline = None
+
+class Loader(object):
+    "Rebuild the objects of the tables written by dumps."
+    def __init__(self, vm, swap):
+        self.vm = vm
+        self.genv = vm.env
+        # Whether the bytecode was written with the other byte order
+        self.swap = swap
+
+    def load(self, unit):
+        names, macros, envs, pools, procs, forms, closures = unit
+        self.load_globals(names)
+
+        self.envs = [Environment(self.genv) for entry in envs]
+        for env, (parent, names, map, env_macros) in zip(self.envs, envs):
+            if parent != -1:
+                env.parent = self.envs[parent]
+            env.scope.names = names
+            env.scope.map = map
+            env.locals = [Undef()] * len(names)
+
+        self.pools = [[] for entry in pools]
+        self.procs = [Procedure(Unit(self.env(env), self.pools[pool], argc, rest_arg),
+                                self.bytecode(bytecode))
+                      for env, bytecode, pool, argc, rest_arg, inline in procs]
+        self.forms = [Form(Unit(self.env(env), self.pools[pool]), self.bytecode(bytecode))
+                      for env, bytecode, pool in forms]
+
+        # the expressions of the closures are filled in with the pools
+        self.closures = []
+        for symbol, env, expression, form in closures:
+            if symbol:
+                closure = SymbolClosure(self.env(env), None)
+            else:
+                closure = DynamicClosure(self.env(env), None)
+            closure.form = self.forms[form]
+            self.closures.append(closure)
+
+        for literals, entries in zip(self.pools, pools):
+            literals.extend([self.literal(entry) for entry in entries])
+        for proc, entry in zip(self.procs, procs):
+            inline = entry[-1]
+            if inline is not None:
+                proc.inline = (inline[0], self.literal(inline[1]))
+        for closure, entry in zip(self.closures, closures):
+            closure.expression = self.literal(entry[2])
+
+        self.load_macros(self.genv, macros)
+        for env, entry in zip(self.envs, envs):
+            self.load_macros(env, entry[-1])
+        return self.forms[0]
+
+    def load_globals(self, names):
+        "Allocate the globals of the unit, at the indexes it was compiled for."
+        genv = self.genv
+        for idx, name in enumerate(names):
+            if idx < len(genv.locals):
+                found = genv.scope.names[idx]
+            else:
+                found = name
+                genv.alloc_local(name)
+            if found != name:
+                raise SerializeError("Global %s compiled for index %d, which is %s in the VM" %
+                                     (name, idx, found))
+
+    def load_macros(self, env, macros):
+        for idx, body in macros:
+            if not isinstance(env.locals[idx], Macro):
+                env.locals[idx] = Macro(env, self.literal(body))
+                if env is self.genv:
+                    self.vm.macros_changed()
+
+    def env(self, idx):
+        if idx == -1:
+            return self.genv
+        return self.envs[idx]
+
+    def bytecode(self, data):
+        bytecode = array('i')
+        bytecode.fromstring(data)
+        if self.swap:
+            bytecode.byteswap()
+        return bytecode
+
+    def literal(self, entry):
+        "Rebuild a literal written by Dumper.literal."
+        tag = entry[0]
+        if tag == 'c':
+            return entry[1]
+        if tag == 'y':
+            return Symbol(entry[1])
+        if tag == 'l':
+            lit = self.literal(entry[2])
+            for element in reversed(entry[1]):
+                lit = Pair(self.literal(element), lit)
+            return lit
+        if tag == 'p':
+            return self.procs[entry[1]]
+        if tag == 'g':
+            value = self.genv.locals[entry[1]]
+            if signature(value) != entry[2]:
+                return STALE
+            return value
+        if tag == 'F':
+            # checked the first time it runs
+            return Folded(self.literal(entry[1]), self.guards(entry[2]), -1)
+        if tag == 'G':
+            return Guard(self.guards(entry[1]), -1)
+        if tag == 'd':
+            return self.closures[entry[1]]
+        raise SerializeError("Unknown literal tag in .skc data: %r" % (tag,))
+
+    def guards(self, guards):
+        return [(idx, self.literal(value)) for idx, value in guards]
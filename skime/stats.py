@@ -0,0 +1,69 @@
+import json
+
+from .iset import INSTRUCTIONS
+
+class InsnStats(object):
+    """\
+    Instruction statistics collected by the instrumented run loop (see
+    VM.enable_stats): how many times each instruction ran, the time
+    spent in it and how many times each pair of instructions ran one
+    right after the other.
+
+    Macro expansions (dynamic_eval) and the procedures called by apply
+    and map run in the instrumented loop itself, so their instructions
+    are counted and timed on their own. The time of an instruction only
+    includes that of other instructions when it runs Scheme code in a
+    nested run loop: an inlined primitive (e.g. add2) whose global was
+    rebound to a procedure calls it through VM.apply.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        "Forget the statistics collected so far."
+        n = len(INSTRUCTIONS)
+        # Indexed by opcode
+        self.counts = [0] * n
+        self.times = [0.0] * n
+        # pairs[a][b] counts b run right after a. The extra row n
+        # counts the first instruction run.
+        self.pairs = [[0] * n for i in range(n+1)]
+        # Opcode of the last instruction run
+        self.last = n
+
+    def total(self):
+        "Total number of instructions run."
+        return sum(self.counts)
+
+    def as_dict(self):
+        """\
+        Return the statistics as a dict using instruction names, pairs
+        sorted by decreasing count.
+        """
+        insns = {}
+        for insn in INSTRUCTIONS:
+            if self.counts[insn.opcode] > 0:
+                insns[insn.name] = {
+                    'count' : self.counts[insn.opcode],
+                    'time' : self.times[insn.opcode]
+                    }
+        pairs = []
+        for first in INSTRUCTIONS:
+            for second in INSTRUCTIONS:
+                count = self.pairs[first.opcode][second.opcode]
+                if count > 0:
+                    pairs.append({
+                        'first' : first.name,
+                        'second' : second.name,
+                        'count' : count
+                        })
+        pairs.sort(key=lambda p: p['count'], reverse=True)
+        return {
+            'total' : self.total(),
+            'instructions' : insns,
+            'pairs' : pairs
+            }
+
+    def dump(self, io):
+        "Write the statistics as JSON to the file object io."
+        json.dump(self.as_dict(), io, indent=2, sort_keys=True)
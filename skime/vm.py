@@ -1,18 +1,21 @@
 # A Scheme expression is compiled into a Form. The Form object hold the
 # bytecode of the expression. To evaluate the form, a new Context is set up.
-# Instruction pointer and operand stack are held in the Context object.
+# Instruction pointer and operand stack frame are held in the Context object,
+# the frames of all contexts live on a single operand stack per VM.
 # Local variables are held in an Environment object, which are chained
 # through the lexical scope.
 
 import os.path
 
-from .ctx               import Context
+from .ctx               import Context, FramePool
 from .env               import Environment
 from .                  import insns
+from .                  import jit
+from .stats             import InsnStats
+from .cache             import CompileCache, FormCache, FORM_CACHE_SIZE
 from .types.pair        import Pair
-from .proc              import Procedure
+from .proc              import Procedure, Closure
 from .prim              import Primitive, load_primitives
-from .insns             import run
 from .types.pair        import Pair as pair
 
 from .compiler.parser   import parse
@@ -22,37 +25,106 @@ from .errors            import WrongArgType
 
 class VM(object):
 
-    def __init__(self):
+    def __init__(self, engine=insns.DEFAULT_ENGINE, cache=False, cache_dir=None,
+                 eval_cache_size=FORM_CACHE_SIZE):
         self.compiler = Compiler()
+
+        # The forms compiled by eval_string, 0 to disable
+        self.eval_cache = FormCache(eval_cache_size)
+
+        # The compiled code cache of load, None if disabled. It is
+        # enabled by cache or a cache_dir, its files are written next
+        # to the sources if cache_dir is None.
+        self.cache = None
+        if cache or cache_dir is not None:
+            self.cache = CompileCache(cache_dir)
+
+        # The run loop executing bytecode, see insns.ENGINES
+        self.engine_name = engine
+        self.engine = insns.ENGINES[engine]
+        # Instruction statistics, see enable_stats
+        self.stats = None
         
         self.env = Environment()
         self.env.vm = self
         load_primitives(self.env)
 
+        # The operand stack shared by all contexts, see Context
+        self.stack = []
+        # Recycled procedure frames
+        self.frames = FramePool()
         self.ctx = Context(None, self.env, None)
 
+        # skime may be installed in a directory that isn't writable
         self.load(os.path.join(os.path.dirname(__file__),
                                'scheme',
-                               'prim.scm'))
+                               'prim.scm'),
+                  cache=False)
 
     def run(self, form):
         return form.eval(self.env, self)
 
-    def load(self, path):
+    def load(self, path, cache=True):
+        """\
+        Load a source file, through the compiled code cache if it is
+        enabled and cache is True.
+        """
         io = open(path)
         content = io.read()
         io.close()
 
-        return self.eval_string("(begin %s)" % content)
+        if self.cache is None or not cache:
+            return self.run(self.compiler.compile(parse("(begin %s)" % content), self.env))
+        key = self.cache.key(content, self.env)
+        form = self.cache.load(self, path, key)
+        if form is None:
+            form = self.compiler.compile(parse("(begin %s)" % content), self.env)
+            self.cache.store(path, key, form)
+        return self.run(form)
 
     def eval_string(self, script):
-        return self.run(self.compiler.compile(parse(script), self.env))
+        form = self.eval_cache.get(script, self.env)
+        if form is None:
+            version = self.eval_cache.version
+            form = self.compiler.compile(parse(script), self.env)
+            self.eval_cache.put(script, self.env, form, version)
+        return self.run(form)
+
+    def macros_changed(self):
+        """\
+        Called when a macro of the global environment is defined, or
+        redefined as a variable: the forms of eval_string may have
+        expanded the former macro, or called the variable.
+        """
+        self.eval_cache.invalidate()
+
+    def enable_stats(self):
+        """\
+        Run bytecode with the instrumented run loop, which records
+        instruction statistics in self.stats (an InsnStats) until
+        disable_stats is called. Statistics accumulate over successive
+        enable_stats calls, use self.stats.reset() to start over.
+        """
+        if self.stats is None:
+            self.stats = InsnStats()
+        self.engine = insns.run_stats
+
+    def disable_stats(self):
+        "Go back to the run loop selected when the VM was created."
+        self.engine = insns.ENGINES[self.engine_name]
 
     def apply(self, proc, args):
+        free = None
+        if isinstance(proc, Closure):
+            free = proc.free
+            proc = proc.proc
+
         if isinstance(proc, Procedure):
             proc.check_arity(len(args))
 
-            ctx = Context(proc, proc.env.dup(), self.ctx)
+            ctx = self.frames.context(proc, self.frames.env(proc), self.ctx)
+            if free is not None:
+                ctx.env.locals[-len(free):] = free
             for i in range(proc.fixed_argc):
                 ctx.env.assign_local(i, args[i])
             if proc.fixed_argc != proc.argc:
@@ -61,7 +133,7 @@ class VM(object):
                     rest = Pair(args[i], rest)
                 ctx.env.assign_local(proc.fixed_argc, rest)
 
-            return run(ctx)
+            return self.engine(ctx)
         
         elif isinstance(proc, Primitive):
             proc.check_arity(len(args))
@@ -0,0 +1,180 @@
+import os
+import shutil
+import tempfile
+
+from skime.vm import VM
+from skime.cache import CACHE_DIR
+
+class TestCompileCache(object):
+    """\
+    VM.load caches the compiled forms of the sources, until the source
+    or the global environment it is compiled in changes.
+    """
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+        self.source = os.path.join(self.dir, 'lib.scm')
+        self.write("""
+        (define-syntax unless
+          (syntax-rules () ((_ c e) (if c #f e))))
+        (define (second l) (car (cdr l)))
+        (define (twice x) (unless (= x 0) (* 2 (second (list 0 x)))))""")
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, content):
+        io = open(self.source, 'w')
+        io.write(content)
+        io.close()
+
+    def load(self, vm):
+        "Load the source, return the cache hits and misses of the load."
+        hits, misses = vm.cache.hits, vm.cache.misses
+        vm.load(self.source)
+        return vm.cache.hits - hits, vm.cache.misses - misses
+
+    def test_hit(self):
+        vm = VM(cache=True)
+        assert self.load(vm) == (0, 1)
+        assert os.path.exists(os.path.join(self.dir, CACHE_DIR, 'lib.scm.skc'))
+        vm = VM(cache=True)
+        assert self.load(vm) == (1, 0)
+        assert vm.eval_string("(twice 21)") == 42
+        assert vm.eval_string("(unless #f 1)") == 1
+
+    def test_source_changed(self):
+        self.load(VM(cache=True))
+        self.write("(define (twice x) (+ x x))")
+        vm = VM(cache=True)
+        assert self.load(vm) == (0, 1)
+        assert vm.eval_string("(twice 2)") == 4
+        assert self.load(VM(cache=True)) == (1, 0)
+
+    def test_globals_changed(self):
+        # the unit inlines the primitives and procedures of the global
+        # environment, and addresses its variables by index
+        self.load(VM(cache=True))
+        vm = VM(cache=True)
+        vm.eval_string("(define (car l) 10)")
+        assert self.load(vm) == (0, 1)
+        assert vm.eval_string("(twice 21)") == 20
+        vm = VM(cache=True)
+        vm.eval_string("(define x 1)")
+        assert self.load(vm) == (0, 1)
+        assert vm.eval_string("(twice 21)") == 42
+        # but not the values of the variables
+        vm = VM(cache=True)
+        vm.eval_string("(define x 2)")
+        assert self.load(vm) == (1, 0)
+
+    def test_primitive_rebound(self):
+        # primitives sharing a Python function name are told apart
+        self.write("(define r (list (+ 2 3) ((lambda (x) (+ x 1)) 10)))")
+        self.load(VM(cache=True))
+        vm = VM(cache=True)
+        vm.eval_string("(set! + -)")
+        assert self.load(vm) == (0, 1)
+        assert str(vm.eval_string("r")) == "(-1 9)"
+        vm = VM(cache=True)
+        vm.eval_string("(set! + -)")
+        assert self.load(vm) == (1, 0)
+        assert str(vm.eval_string("r")) == "(-1 9)"
+
+    def test_cache_dir(self):
+        cache_dir = os.path.join(self.dir, 'cache')
+        self.load(VM(cache_dir=cache_dir))
+        assert not os.path.exists(os.path.join(self.dir, CACHE_DIR))
+        assert len([name for name in os.listdir(cache_dir)
+                    if name.startswith('lib.scm.')]) == 1
+        assert self.load(VM(cache_dir=cache_dir)) == (1, 0)
+
+    def test_invalid(self):
+        self.load(VM(cache=True))
+        io = open(os.path.join(self.dir, CACHE_DIR, 'lib.scm.skc'), 'r+b')
+        io.seek(40)
+        io.write('garbage')
+        io.close()
+        vm = VM(cache=True)
+        assert self.load(vm) == (0, 1)
+        assert vm.eval_string("(twice 21)") == 42
+
+    def test_disabled(self):
+        for vm in VM(), VM(cache=False):
+            vm.load(self.source)
+            assert vm.cache is None
+            assert not os.path.exists(os.path.join(self.dir, CACHE_DIR))
+            assert vm.eval_string("(twice 21)") == 42
+
+    def test_prelude(self):
+        # the Scheme code of skime is loaded without the cache
+        vm = VM(cache=True)
+        assert (vm.cache.hits, vm.cache.misses) == (0, 0)
+
+class TestFormCache(object):
+    """\
+    VM.eval_string keeps the forms it compiles, until a macro of the
+    global environment is defined.
+    """
+    def eval(self, vm, script):
+        "Eval script, return its value and whether its form was cached."
+        hits = vm.eval_cache.hits
+        value = vm.eval_string(script)
+        return value, vm.eval_cache.hits > hits
+
+    def test_hit(self):
+        vm = VM()
+        vm.eval_string("(define x 1)")
+        assert self.eval(vm, "(set! x (+ x 1))") == (2, False)
+        assert self.eval(vm, "(set! x (+ x 1))") == (3, True)
+        assert self.eval(vm, "x") == (3, False)
+        assert self.eval(vm, "x") == (3, True)
+
+    def test_mutable_literals(self):
+        # a quoted list is a new list each time its text is evaluated
+        vm = VM()
+        assert self.eval(vm, "(define l '(1 2))")[1] is False
+        vm.eval_string("(set-car! l 5)")
+        assert self.eval(vm, "(define l '(1 2))")[1] is False
+        assert str(vm.eval_string("l")) == "(1 2)"
+        vm.eval_string("(define-syntax ones (syntax-rules () ((_) '(1 1))))")
+        self.eval(vm, "(define m (ones))")
+        vm.eval_string("(set-car! m 5)")
+        assert self.eval(vm, "(define m (ones))")[1] is False
+        assert str(vm.eval_string("m")) == "(1 1)"
+        # other literals are kept
+        self.eval(vm, "(list \"a\" 'b 1.5)")
+        assert self.eval(vm, "(list \"a\" 'b 1.5)")[1] is True
+
+    def test_lru(self):
+        vm = VM(eval_cache_size=2)
+        self.eval(vm, "1")
+        self.eval(vm, "2")
+        assert self.eval(vm, "1") == (1, True)
+        self.eval(vm, "3")
+        # 2 is the least recently used
+        assert self.eval(vm, "2") == (2, False)
+        assert self.eval(vm, "3") == (3, True)
+        assert len(vm.eval_cache.forms) == 2
+
+    def test_disabled(self):
+        vm = VM(eval_cache_size=0)
+        self.eval(vm, "1")
+        assert self.eval(vm, "1") == (1, False)
+        assert len(vm.eval_cache.forms) == 0
+
+    def test_macros(self):
+        vm = VM()
+        vm.eval_string("(define (twice x) (* 2 x))")
+        assert self.eval(vm, "(twice 3)") == (6, False)
+        assert self.eval(vm, "(twice 3)") == (6, True)
+        vm.eval_string("(define-syntax twice (syntax-rules () ((_ x) (+ x x x))))")
+        assert self.eval(vm, "(twice 3)") == (9, False)
+        # defining a macro is never cached
+        script = "(define-syntax twice (syntax-rules () ((_ x) (- x))))"
+        vm.eval_string(script)
+        vm.eval_string("(define-syntax twice (syntax-rules () ((_ x) (+ x x x))))")
+        assert self.eval(vm, script) == (None, False)
+        assert self.eval(vm, "(twice 3)") == (-3, False)
+        # a macro redefined as a variable
+        vm.eval_string("(define twice (lambda (x) (* 2 x)))")
+        assert self.eval(vm, "(twice 3)") == (6, False)
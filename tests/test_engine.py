@@ -0,0 +1,80 @@
+from skime.vm import VM
+from skime.insns import ENGINES
+from skime.types.pair import Pair as pair
+
+class TestEngines(object):
+    """\
+    Every run loop in insns.ENGINES should give the same results.
+    """
+    programs = [
+        ("(+ 1 2 3)", 6),
+        ("((lambda (x . y) y) 1 2 3)", pair(2, pair(3, None))),
+        ("""(begin
+              (define (fact n) (if (= n 0) 1 (* n (fact (- n 1)))))
+              (fact 10))""", 3628800),
+        ("""(begin
+              (define (loop i acc) (if (= i 0) acc (loop (- i 1) (+ acc i))))
+              (loop 100 0))""", 5050),
+        ("""(do ((i 0 (+ i 1)) (s 0 (+ s i)))
+                ((= i 10) s))""", 45),
+        ("""(begin
+              (define x 1)
+              (define (inc!) (set! x (+ x 1)))
+              (inc!) (inc!)
+              x)""", 3),
+        ("(map (lambda (x) (* x x)) '(1 2 3))", pair(1, pair(4, pair(9, None)))),
+        ("(apply + 1 '(2 3))", 6),
+        ("(+ 1 (call/cc (lambda (k) (k 41))))", 42),
+        ("(begin (define y (if #f (lambda (x) x) 2)) y)", 2),
+        ("""(begin
+              (define (make-adder n) (lambda (x) (+ x n)))
+              (define add1 (make-adder 1))
+              (define add2 (make-adder 2))
+              (+ (add1 10) (add2 100)))""", 113),
+        ("""(begin
+              (define (counter) (define n 0) (lambda () (set! n (+ n 1)) n))
+              (define c (counter))
+              (c) (c)
+              (+ (c) ((counter))))""", 4),
+        ('''(begin
+              (define l (list 1 2))
+              (define (f x) (set-car! l x))
+              (f 5)
+              (set-car! (cdr l) 6)
+              l)''', pair(5, pair(6, None))),
+        ("""(begin
+              (define-syntax my-or (syntax-rules ()
+                                     ((_ a b) (let ((t a)) (if t t b)))))
+              (my-or #f 7))""", 7)
+        ]
+
+    def check(self, engine, code, expected):
+        vm = VM(engine=engine)
+        assert vm.eval_string(code) == expected
+
+    def test_engines(self):
+        for engine in ENGINES:
+            for code, expected in self.programs:
+                yield self.check, engine, code, expected
+
+    def test_call_cc_reentry(self):
+        for engine in ENGINES:
+            vm = VM(engine=engine)
+            vm.eval_string("(define return #f)")
+            assert vm.eval_string("""
+            (+ 1 (call/cc
+                   (lambda (cont)
+                     (set! return cont)
+                     1)))""") == 2
+            assert vm.eval_string("(return 22)") == 23
+
+    def test_closure_translation_cached(self):
+        vm = VM(engine='closure')
+        vm.eval_string("(define (foo x) (if x 1 2))")
+        foo = vm.env.read_local(vm.env.find_local('foo'))
+        assert foo.closures is None
+        assert vm.eval_string("(foo #t)") == 1
+        closures = foo.closures
+        assert closures is not None
+        assert vm.eval_string("(foo #f)") == 2
+        assert foo.closures is closures
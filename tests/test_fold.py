@@ -0,0 +1,89 @@
+from skime.vm import VM
+from skime.iset import INSTRUCTIONS, OPCODE_MASK
+from skime.insns import ENGINES
+from skime.compiler.parser import parse
+
+from nose.tools import assert_raises
+
+class TestConstantFolding(object):
+    def setup(self):
+        self.vm = VM()
+
+    def names(self, code):
+        bytecode = self.vm.compiler.compile(parse(code), self.vm.env).bytecode
+        names = []
+        ip = 0
+        while ip < len(bytecode):
+            insn = INSTRUCTIONS[bytecode[ip] & OPCODE_MASK]
+            names.append(insn.name)
+            ip += insn.length
+        return names
+
+    def test_folded(self):
+        assert self.names("(* 99 11)")[0] == 'push_folded'
+        assert self.names("(+ (* 2 3) (- 10 4))")[0] == 'push_folded'
+        assert self.vm.eval_string("(* 99 11)") == 1089
+        assert self.vm.eval_string("(+ (* 2 3) (- 10 4))") == 12
+        assert self.vm.eval_string("(string-append \"a\" \"b\")") == "ab"
+        assert self.vm.eval_string("(eq? 'a 'a)") is True
+
+    def test_not_folded(self):
+        # impure primitives, variables and shadowed primitives
+        assert 'push_folded' not in self.names("(list 1 2)")
+        assert 'push_folded' not in self.names("(lambda (x) (+ x 1))")
+        assert 'push_folded' not in self.names("(lambda (+) (+ 1 2))")
+
+    def test_error_at_run_time(self):
+        assert 'push_folded' not in self.names("(lambda () (/ 1 0))")
+        f = self.vm.eval_string("(lambda () (/ 1 0))")
+        assert_raises(ZeroDivisionError, self.vm.apply, f, [])
+
+    def check_rebound(self, engine):
+        vm = VM(engine=engine)
+        vm.eval_string("(define (f) (* 99 (+ 1 10)))")
+        for i in range(150):
+            assert vm.eval_string("(f)") == 1089
+        vm.eval_string("(set! + -)")
+        assert vm.eval_string("(f)") == -891
+        vm.eval_string("(set! + *)")
+        assert vm.eval_string("(f)") == 990
+
+    def test_rebound(self):
+        for engine in ENGINES.keys() + ['jit']:
+            yield self.check_rebound, engine
+
+    def test_rebound_in_unit(self):
+        assert self.vm.eval_string("(begin (set! * +) (* 2 3))") == 5
+
+class TestDeadBranches(object):
+    def setup(self):
+        self.vm = VM()
+
+    def literals(self, code):
+        return self.vm.compiler.compile(parse(code), self.vm.env).literals
+
+    def test_if(self):
+        assert 'then' not in self.literals("(if #f \"then\" \"else\")")
+        assert 'else' not in self.literals("(if 0 \"then\" \"else\")")
+        assert 'else' not in self.literals("(if '(1) \"then\" \"else\")")
+        assert self.vm.eval_string("(if #f 1 2)") == 2
+        assert self.vm.eval_string("(if '() 1 2)") == 1
+        assert self.vm.eval_string("(if #f 1)") is None
+
+    def test_and_or(self):
+        assert 'x' not in self.literals("(and 1 #f \"x\")")
+        assert 'x' not in self.literals("(or #f 2 \"x\")")
+        assert self.vm.eval_string("(and 1 #t)") is True
+        assert self.vm.eval_string("(and 1 2)") == 2
+        assert self.vm.eval_string("(and 1 #f 2)") is False
+        assert self.vm.eval_string("(and)") is True
+        assert self.vm.eval_string("(or #f 2 3)") == 2
+        assert self.vm.eval_string("(or #f #f)") is False
+        assert self.vm.eval_string("(or)") is False
+
+    def test_tail(self):
+        self.vm.eval_string("(define (f x y) (or x (and y 3)))")
+        assert self.vm.eval_string("(+ 1 (f 1 #f))") == 2
+        assert self.vm.eval_string("(+ 1 (f #f 1))") == 4
+        assert self.vm.eval_string("(f #f #f)") is False
+        assert self.vm.stack == []
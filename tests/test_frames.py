@@ -0,0 +1,111 @@
+from skime.vm import VM
+from skime.insns import ENGINES
+from skime.ctx import FramePool
+
+class TestFramePool(object):
+    def setup(self):
+        self.vm = VM()
+
+    def proc(self, name):
+        return self.vm.env.read_local(self.vm.env.find_local(name))
+
+    def test_recycled(self):
+        self.vm.eval_string("(define (f x) (define y (* x 2)) y)")
+        f = self.proc('f')
+        assert self.vm.eval_string("(f 2)") == 4
+        assert len(f.free_envs) == 1
+        env = f.free_envs[0]
+        assert self.vm.eval_string("(f 3)") == 6
+        assert f.free_envs == [env]
+        assert self.vm.frames.contexts
+
+    def check_closure(self, engine):
+        vm = VM(engine=engine)
+        vm.eval_string("""
+        (begin
+          (define (make-adder n) (lambda (x) (+ x n)))
+          (define (churn n) (if (= n 0) 0 (+ 1 (churn (- n 1)))))
+          (define add5 (make-adder 5)))""")
+        vm.eval_string("(churn 10)")
+        assert vm.eval_string("(add5 1)") == 6
+
+    def test_closure_env_not_recycled(self):
+        for engine in ENGINES:
+            yield self.check_closure, engine
+
+    def test_continuation_not_recycled(self):
+        self.vm.eval_string("""
+        (begin
+          (define k #f)
+          (define (f x) (+ x (call/cc (lambda (c) (set! k c) 1))))
+          (define (churn n) (if (= n 0) 0 (+ 1 (churn (- n 1))))))""")
+        assert self.vm.eval_string("(f 10)") == 11
+        self.vm.eval_string("(churn 10)")
+        assert self.vm.eval_string("(k 5)") == 15
+
+    def test_scope_shared(self):
+        self.vm.eval_string("(define (f x) (define y (* x 2)) y)")
+        f = self.proc('f')
+        self.vm.eval_string("(f 2)")
+        env = f.free_envs[0]
+        assert env.scope is f.env.scope
+        assert env.scope.size == 2
+        assert env.find_local('y') == 1
+
+class TestSelfTailCall(object):
+    def check_loop(self, engine):
+        vm = VM(engine=engine)
+        vm.eval_string("""
+        (define (loop n acc)
+          (define twice (* 2 acc))
+          (if (= n 0) acc (loop (- n 1) (+ acc 1))))""")
+        envs = []
+        def env(proc):
+            envs.append(proc)
+            return FramePool.env(vm.frames, proc)
+        vm.frames.env = env
+        assert vm.eval_string("(loop 1000 0)") == 1000
+        # a single frame ran the whole loop
+        assert len(envs) == 1
+        assert vm.stack == []
+
+    def check_swapped_args(self, engine):
+        vm = VM(engine=engine)
+        vm.eval_string("""
+        (define (swap n a b)
+          (if (= n 0) (cons a b) (swap (- n 1) b a)))""")
+        for i in range(200):
+            assert vm.eval_string("(car (swap 3 1 2))") == 2
+
+    def check_captured(self, engine):
+        vm = VM(engine=engine)
+        vm.eval_string("""
+        (define (collect n acc)
+          (if (= n 0) acc (collect (- n 1) (cons (lambda () n) acc))))""")
+        for i in range(200):
+            lst = vm.eval_string("(collect 3 '())")
+            assert vm.apply(lst.first, []) == 1
+            assert vm.apply(lst.rest.rest.first, []) == 3
+
+    def check_redefined(self, engine):
+        vm = VM(engine=engine)
+        vm.eval_string("""
+        (begin
+          (define (f n) (if (= n 0) 'f (f (- n 1))))
+          (define g f))""")
+        assert vm.eval_string("(g 3)").name == 'f'
+        vm.eval_string("(define (f n) 'new)")
+        assert vm.eval_string("(g 3)").name == 'new'
+
+    def test_self_tail_call(self):
+        for engine in ENGINES.keys() + ['jit']:
+            yield self.check_loop, engine
+            yield self.check_swapped_args, engine
+            yield self.check_captured, engine
+            yield self.check_redefined, engine
+
+    def test_compiled(self):
+        vm = VM()
+        vm.eval_string("(define (f n) (if (= n 0) 0 (f (- n 1))))")
+        f = vm.env.read_local(vm.env.find_local('f'))
+        assert 'tail_call_self' in f.disasm()
@@ -0,0 +1,90 @@
+from skime.vm import VM
+from skime.proc import Closure
+from skime.iset import INSTRUCTIONS, OPCODE_MASK
+
+class TestFreeVars(object):
+    def setup(self):
+        self.vm = VM()
+
+    def proc(self, name):
+        return self.vm.env.read_local(self.vm.env.find_local(name))
+
+    def names(self, proc):
+        bytecode = proc.bytecode
+        names = []
+        ip = 0
+        while ip < len(bytecode):
+            insn = INSTRUCTIONS[bytecode[ip] & OPCODE_MASK]
+            names.append(insn.name)
+            ip += insn.length
+        return names
+
+    def test_flat_closure(self):
+        self.vm.eval_string("""
+        (define (make-multiplier n)
+          (lambda (x) (* x n)))""")
+        make_multiplier = self.proc('make-multiplier')
+        assert make_multiplier.env.parent is self.vm.env
+        assert 'make_closure' in self.names(make_multiplier)
+
+        mul = self.vm.eval_string("(make-multiplier 5)")
+        assert isinstance(mul, Closure)
+        assert mul.free == [5]
+        # n is a local of the closure now, * is a global
+        assert mul.proc.env.parent is self.vm.env
+        assert self.names(mul.proc) == ['push_local_local', 'tail_call_global']
+        assert self.vm.apply(mul, [2]) == 10
+
+    def test_no_free_variables(self):
+        self.vm.eval_string("(define (f) (lambda (x) x))")
+        assert 'make_closure' not in self.names(self.proc('f'))
+        assert 'fix_lexical' not in self.names(self.proc('f'))
+
+    def test_boxed(self):
+        self.vm.eval_string("""
+        (define (counter)
+          (define n 0)
+          (lambda () (set! n (+ n 1)) n))""")
+        names = self.names(self.proc('counter'))
+        assert names[0] == 'box_local'
+        c = self.vm.eval_string("(counter)")
+        assert 'set_local_box' in self.names(c.proc)
+        assert self.vm.apply(c, []) == 1
+        assert self.vm.apply(c, []) == 2
+
+    def test_not_assigned_not_boxed(self):
+        self.vm.eval_string("(define (f x) (lambda () x))")
+        assert 'box_local' not in self.names(self.proc('f'))
+
+    def test_macro_keeps_chain(self):
+        self.vm.eval_string("""
+        (begin
+          (define-syntax my-if
+            (syntax-rules () ((_ c a b) (if c a b))))
+          (define (f x) (lambda () (my-if x 1 2))))""")
+        assert 'fix_lexical' in self.names(self.proc('f'))
+        assert self.vm.eval_string("((f #f))") == 2
+
+    def test_direct_call(self):
+        # the lambda of the let is called right away with the values of
+        # its free variables, the inner one escapes
+        self.vm.eval_string("""
+        (define (f n)
+          (let ((x (+ n 1)))
+            (list x (lambda () (+ x n)))))""")
+        names = self.names(self.proc('f'))
+        assert 'tail_call_direct' in names
+        assert 'make_closure' not in names
+        lst = self.vm.eval_string("(f 1)")
+        assert lst.first == 2
+        assert self.vm.apply(lst.rest.first, []) == 3
+
+    def test_immediate_lambda(self):
+        self.vm.eval_string("(define (f n) (+ 1 ((lambda (x) (* x n)) 2)))")
+        names = self.names(self.proc('f'))
+        assert 'call_direct' in names
+        assert 'make_closure' not in names
+        assert self.vm.eval_string("(f 3)") == 7
+        # a wrong number of arguments is still an error at run time
+        self.vm.eval_string("(define (g n) ((lambda (x) x)))")
+        assert 'call_direct' not in self.names(self.proc('g'))
@@ -0,0 +1,137 @@
+from skime.vm import VM
+from skime.iset import INSTRUCTIONS, OPCODE_MASK
+from skime.insns import ENGINES
+from skime.errors import WrongArgType
+from skime.compiler.parser import parse
+
+from nose.tools import assert_raises
+
+class TestInlinePrimitive(object):
+    def setup(self):
+        self.vm = VM()
+
+    def names(self, code):
+        bytecode = self.vm.compiler.compile(parse(code), self.vm.env).bytecode
+        names = []
+        ip = 0
+        while ip < len(bytecode):
+            insn = INSTRUCTIONS[bytecode[ip] & OPCODE_MASK]
+            names.append(insn.name)
+            ip += insn.length
+        return names
+
+    def test_inlined(self):
+        for code, insn in [("(+ 1 2)", 'add2'),
+                           ("(- 1 2)", 'sub2'),
+                           ("(= 1 2)", 'numeq2'),
+                           ("(< 1 2)", 'lt2'),
+                           ("(car '(1))", 'car'),
+                           ("(cdr '(1))", 'cdr'),
+                           ("(cons 1 2)", 'cons'),
+                           ("(null? '())", 'nullp')]:
+            assert self.names(code)[-1] == insn
+
+    def test_not_inlined(self):
+        # other numbers of arguments and shadowed primitives
+        assert 'add2' not in self.names("(+ 1 2 3)")
+        assert 'car' not in self.names("(lambda (car) (car 1))")
+
+    def test_values(self):
+        assert self.vm.eval_string("(+ 1 2)") == 3
+        assert self.vm.eval_string("(+ 1.5 2)") == 3.5
+        assert self.vm.eval_string("(- 1 2)") == -1
+        assert self.vm.eval_string("(= 1 1.0)") is True
+        assert self.vm.eval_string("(< 2 1)") is False
+        assert self.vm.eval_string("(car (cdr (cons 1 (cons 2 '()))))") == 2
+        assert self.vm.eval_string("(null? (cdr '(1)))") is True
+        assert self.vm.eval_string("(null? 0)") is False
+
+    def test_errors(self):
+        assert_raises(WrongArgType, self.vm.eval_string, '(+ "a" "b")')
+        assert_raises(WrongArgType, self.vm.eval_string, '(- 1 "b")')
+        assert_raises(WrongArgType, self.vm.eval_string, '(= 1 "b")')
+        assert_raises(WrongArgType, self.vm.eval_string, '(car 1)')
+        assert_raises(WrongArgType, self.vm.eval_string, '(cdr 1)')
+
+    def check_redefined(self, engine):
+        vm = VM(engine=engine)
+        vm.eval_string("(define (f x y) (+ (car x) y))")
+        for i in range(150):
+            assert vm.eval_string("(f '(1) 2)") == 3
+        vm.eval_string("(define (car x) 10)")
+        assert vm.eval_string("(f '(1) 2)") == 12
+        vm.eval_string("(set! + *)")
+        assert vm.eval_string("(f '(1) 2)") == 20
+
+    def test_redefined(self):
+        for engine in ENGINES.keys() + ['jit']:
+            yield self.check_redefined, engine
+
+class TestInlineProcedure(object):
+    """\
+    Calls of small global procedures are compiled into their body.
+    """
+    def setup(self):
+        self.vm = VM()
+        self.vm.eval_string("(define (second l) (car (cdr l)))")
+
+    def names(self, code):
+        "Names of the instructions of the procedure code evaluates to."
+        bytecode = self.vm.eval_string(code).bytecode
+        names = []
+        ip = 0
+        while ip < len(bytecode):
+            insn = INSTRUCTIONS[bytecode[ip] & OPCODE_MASK]
+            names.append(insn.name)
+            ip += insn.length
+        return names
+
+    def test_inlined(self):
+        names = self.names("(lambda (l) (+ 1 (second l)))")
+        assert 'guard_inlined' in names
+        assert 'cdr' in names and 'car' in names
+        assert self.vm.eval_string("((lambda (l) (+ 1 (second l))) '(1 2))") == 3
+
+    def test_not_inlined(self):
+        # large, recursive and rest argument procedures, and bodies
+        # using variables shadowed at the call site
+        self.vm.eval_string("""
+        (define (big l)
+          (+ (car l) (car (cdr l)) (car (cdr (cdr l))) (car (cdr (cdr (cdr l))))))""")
+        self.vm.eval_string("(define (count n) (if (= n 0) 0 (count (- n 1))))")
+        self.vm.eval_string("(define (rest . l) (cdr l))")
+        for code in ["(lambda (l) (big l))",
+                     "(lambda (n) (count n))",
+                     "(lambda (l) (rest l))",
+                     "(lambda (cdr) (second (list 1 cdr)))"]:
+            assert 'guard_inlined' not in self.names(code)
+        assert self.vm.eval_string("((lambda (cdr) (second (list 1 cdr))) 2)") == 2
+
+    def test_arguments(self):
+        # the arguments are evaluated once, in order, before the body
+        self.vm.eval_string("(define (swap a b) (cons b a))")
+        self.vm.eval_string("(define log '())")
+        assert self.vm.eval_string("""
+        ((lambda (a)
+           (car (swap (begin (set! log (cons 1 log)) a)
+                      (begin (set! log (cons 2 log)) (+ a 1)))))
+         1)""") == 2
+        assert self.vm.eval_string("(car log)") == 2
+        assert self.vm.eval_string("(cdr (cdr log))") is None
+
+    def check_redefined(self, engine):
+        vm = VM(engine=engine)
+        vm.eval_string("(define (second l) (car (cdr l)))")
+        vm.eval_string("(define (f l) (+ 1 (second l)))")
+        vm.eval_string("(define (g l) (second l))")
+        for i in range(150):
+            assert vm.eval_string("(f '(1 2))") == 3
+            assert vm.eval_string("(g '(1 2))") == 2
+        vm.eval_string("(define (second l) (car l))")
+        assert vm.eval_string("(f '(1 2))") == 2
+        assert vm.eval_string("(g '(1 2))") == 1
+        assert vm.stack == []
+
+    def test_redefined(self):
+        for engine in ENGINES.keys() + ['jit']:
+            yield self.check_redefined, engine
@@ -0,0 +1,150 @@
+from skime.vm import VM
+from skime import jit
+
+from nose.tools import assert_raises
+
+class TestJit(object):
+    def setup(self):
+        self.vm = VM(engine='jit')
+
+    def proc(self, name):
+        return self.vm.env.read_local(self.vm.env.find_local(name))
+
+    def test_hot_procedure(self):
+        self.vm.eval_string("""
+        (define (fact n)
+          (if (= n 0) 1 (* n (fact (- n 1)))))""")
+        fact = self.proc('fact')
+        assert self.vm.eval_string("(fact 5)") == 120
+        assert fact.native is None
+        assert self.vm.eval_string("(fact %d)" % jit.CALL_THRESHOLD) > 0
+        assert fact.native
+        assert self.vm.eval_string("(fact 10)") == 3628800
+
+    def test_hot_loop(self):
+        assert self.vm.eval_string("""
+        (do ((i 0 (+ i 1)) (s 0 (+ s i)))
+            ((= i %d) s))""" % (jit.BACKEDGE_THRESHOLD*2)) == \
+            sum(range(jit.BACKEDGE_THRESHOLD*2))
+
+    def test_deopt(self):
+        self.vm.eval_string("(define (double x) (* x 2))")
+        double = self.proc('double')
+        jit.compile_native(double)
+        assert double.native
+        assert self.vm.eval_string("(double 21)") == 42
+
+        self.vm.eval_string("(set! * +)")
+        assert self.vm.eval_string("(double 21)") == 23
+        assert double.native is None
+        assert double.deopts == 1
+
+    def test_guard_cache(self):
+        # assigning another global only makes the guard compare the
+        # inlined globals again
+        self.vm.eval_string("(begin (define n 0) (define (double x) (* x 2)))")
+        double = self.proc('double')
+        jit.compile_native(double)
+        version = self.vm.env.version
+        self.vm.eval_string("(set! n 1)")
+        assert self.vm.env.version > version
+        assert self.vm.eval_string("(double 21)") == 42
+        assert double.native
+        assert double.deopts == 0
+
+    def test_deopt_in_callee(self):
+        # the global is reassigned by Scheme code run by a primitive
+        # called from the native code
+        self.vm.eval_string("""
+        (begin
+          (define (redefine) (set! * +))
+          (define (foo x)
+            (apply redefine '())
+            (* x 2)))""")
+        foo = self.proc('foo')
+        jit.compile_native(foo)
+        assert self.vm.eval_string("(foo 21)") == 23
+
+    def test_unsupported(self):
+        self.vm.eval_string("(define (foo) (call/cc (lambda (k) (k 1))))")
+        foo = self.proc('foo')
+        assert jit.compile_native(foo) is False
+        assert self.vm.eval_string("(foo)") == 1
+
+    def test_many_arguments(self):
+        args = ' '.join(['a%d' % i for i in range(300)])
+        self.vm.eval_string("(define (foo %s) (list %s))" % (args, args))
+        foo = self.proc('foo')
+        assert jit.compile_native(foo)
+        values = ' '.join([str(i) for i in range(300)])
+        assert str(self.vm.eval_string("(foo %s)" % values)) == "(%s)" % values
+
+    def test_syntax_error(self):
+        # source Python can't compile leaves the procedure interpreted
+        self.vm.eval_string("(define (foo) 1)")
+        foo = self.proc('foo')
+        translate = jit.translate
+        jit.translate = lambda proc: ('def native(:\n', {})
+        try:
+            assert jit.compile_native(foo) is False
+        finally:
+            jit.translate = translate
+        assert self.vm.eval_string("(foo)") == 1
+
+    def test_superinstructions(self):
+        self.vm.eval_string("""
+        (begin
+          (define l (list 0 0))
+          (define (g x) x)
+          (define (foo a b)
+            (g a)
+            (set-car! l a)
+            (set-car! (cdr l) b)
+            (+ a b)))""")
+        foo = self.proc('foo')
+        assert jit.compile_native(foo)
+        assert self.vm.eval_string("(foo 1 2)") == 3
+        assert self.vm.eval_string("l") == self.vm.eval_string("'(1 2)")
+
+    def test_closures(self):
+        self.vm.eval_string("""
+        (define (foo n)
+          (define total 0)
+          (define (add! x) (set! total (+ total x n)))
+          (add! 1)
+          (add! 2)
+          total)""")
+        foo = self.proc('foo')
+        assert jit.compile_native(foo)
+        assert self.vm.eval_string("(foo 10)") == 23
+        assert self.vm.eval_string("(foo 1)") == 5
+
+    def test_redefined_primitive(self):
+        # + is no longer the inlined primitive when loop gets hot, so
+        # the native code calls f like any procedure and is resumed
+        # after the call
+        assert self.vm.eval_string("""
+        (begin
+          (define (f) (+ 1 2))
+          (define (+ a b) (* a b))
+          (define (loop n acc)
+            (if (= n 0) acc (loop (- n 1) (f))))
+          (loop %d 0))""" % (jit.CALL_THRESHOLD*3)) == 2
+        assert self.proc('loop').native
+
+    def test_deopt_in_redefined_primitive(self):
+        # the native code of foo is thrown away while it calls +, and
+        # foo is interpreted again from the middle of a block
+        self.vm.eval_string("""
+        (begin
+          (define (g) 10)
+          (define (foo x)
+            (cons (+ x 1) (g)))
+          (define (+ a b)
+            (if (= a 1) (begin (set! g (lambda () 20)) (foo 0)))
+            (- a (- 0 b))))""")
+        foo = self.proc('foo')
+        assert jit.compile_native(foo)
+        assert self.vm.eval_string("(foo 1)") == self.vm.eval_string("'(2 . 20)")
+        assert foo.native is None
+        assert self.vm.stack == []
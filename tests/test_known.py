@@ -0,0 +1,78 @@
+from skime.vm import VM
+from skime.iset import INSTRUCTIONS, OPCODE_MASK
+from skime.insns import ENGINES
+from skime.compiler.parser import parse
+
+class TestKnownCall(object):
+    def setup(self):
+        self.vm = VM()
+
+    def names(self, code):
+        return self.insn_names(self.vm.compiler.compile(parse(code), self.vm.env))
+
+    def insn_names(self, form):
+        bytecode = form.bytecode
+        names = []
+        ip = 0
+        while ip < len(bytecode):
+            insn = INSTRUCTIONS[bytecode[ip] & OPCODE_MASK]
+            names.append(insn.name)
+            ip += insn.length
+        return names
+
+    def test_defined_procedure(self):
+        self.vm.eval_string("(define (f x) (* x 2))")
+        assert 'call_known' in self.names("(f 2)")
+        assert self.vm.eval_string("(f 2)") == 4
+
+    def test_tail_call(self):
+        self.vm.eval_string("(define (f x) (* x 2))")
+        g = self.vm.eval_string("(lambda (x) (f x))")
+        assert self.insn_names(g)[-1] == 'tail_call_known'
+        assert self.vm.eval_string("((lambda (x) (f x)) 3)") == 6
+
+    def test_recursion_in_same_unit(self):
+        names = self.names("""
+        (begin
+          (define (count n) (if (= n 0) 0 (+ 1 (count (- n 1)))))
+          (count 10))""")
+        assert names[-1] == 'call_known'
+        assert self.vm.eval_string("""
+        (begin
+          (define (count n) (if (= n 0) 0 (+ 1 (count (- n 1)))))
+          (count 10))""") == 10
+
+    def test_not_known(self):
+        self.vm.eval_string("(define (f x) x)")
+        self.vm.eval_string("(define g (let ((n 1)) (lambda () n)))")
+        # wrong number of arguments, primitives, closures and locals
+        assert 'call_known' not in self.names("(f)")
+        assert 'call_known' not in self.names("(car '(1))")
+        assert 'call_known' not in self.names("(g)")
+        assert 'call_known' not in self.names("(lambda (f) (f 1))")
+
+    def test_rest_args(self):
+        self.vm.eval_string("(define (f x . rest) rest)")
+        assert 'call_known' in self.names("(f 1 2 3)")
+        assert self.vm.eval_string("(f 1 2 3)").first == 2
+        assert 'call_known' not in self.names("(f)")
+
+    def check_redefined(self, engine):
+        vm = VM(engine=engine)
+        vm.eval_string("""
+        (begin
+          (define (f x) (+ x 1))
+          (define (g x) (f x))
+          (define (h x) (* 2 (f x))))""")
+        assert vm.eval_string("(g 1)") == 2
+        assert vm.eval_string("(h 1)") == 4
+        vm.eval_string("(define (f x) (+ x 10))")
+        assert vm.eval_string("(g 1)") == 11
+        assert vm.eval_string("(h 1)") == 22
+        vm.eval_string("(set! f car)")
+        assert vm.eval_string("(g '(5))") == 5
+        assert vm.eval_string("(h '(5))") == 10
+
+    def test_redefined(self):
+        for engine in ENGINES:
+            yield self.check_redefined, engine
@@ -0,0 +1,64 @@
+from skime.vm import VM
+from skime.iset import INSTRUCTIONS, OPCODE_MASK
+from skime.insns import ENGINES
+
+class TestInlineLet(object):
+    def setup(self):
+        self.vm = VM()
+
+    def names(self, proc):
+        bytecode = proc.bytecode
+        names = []
+        ip = 0
+        while ip < len(bytecode):
+            insn = INSTRUCTIONS[bytecode[ip] & OPCODE_MASK]
+            names.append(insn.name)
+            ip += insn.length
+        return names
+
+    def test_inlined(self):
+        for code in ["(lambda (x) (let ((y (+ x 1))) (* y 2)))",
+                     "(lambda (x) (let* ((y (+ x 1)) (y (* y 2))) y))",
+                     "(lambda (x) (letrec ((y (+ x 1))) (* y 2)))"]:
+            f = self.vm.eval_string(code)
+            assert 'push_literal' not in self.names(f)
+            assert self.vm.apply(f, [2]) == 6
+
+    def test_not_inlined(self):
+        # captured by a closure, at top level
+        f = self.vm.eval_string("(lambda (n) (let ((x n)) (lambda () x)))")
+        assert 'tail_call_direct' in self.names(f)
+        assert self.vm.apply(self.vm.apply(f, [3]), []) == 3
+        assert self.vm.eval_string("(let ((x 1)) (+ x 1))") == 2
+        assert self.vm.env.find_local('x') is None
+
+    def test_shadowing(self):
+        f = self.vm.eval_string("""
+        (lambda (x)
+          (+ (let ((x 10) (y x)) (+ x y)) x))""")
+        assert self.vm.apply(f, [1]) == 12
+        f = self.vm.eval_string("""
+        (lambda (x)
+          (let* ((y x) (x (+ y 1)))
+            (let ((x (* x 2)))
+              (list x y))))""")
+        lst = self.vm.apply(f, [1])
+        assert (lst.first, lst.rest.first) == (4, 1)
+
+    def check_loop(self, engine):
+        vm = VM(engine=engine)
+        vm.eval_string("""
+        (define (sum n acc)
+          (if (= n 0)
+              acc
+              (let ((m (- n 1)) (acc (+ acc n)))
+                (sum m acc))))""")
+        sum = vm.env.read_local(vm.env.find_local('sum'))
+        assert 'tail_call_self' in self.names(sum)
+        for i in range(150):
+            assert vm.eval_string("(sum 10 0)") == 55
+        assert vm.stack == []
+
+    def test_loop(self):
+        for engine in ENGINES.keys() + ['jit']:
+            yield self.check_loop, engine
@@ -0,0 +1,39 @@
+from skime.vm import VM
+from skime.types.symbol import Symbol as sym
+from skime.compiler.parser import parse
+
+class TestLiteralPool(object):
+    def setup(self):
+        self.vm = VM()
+
+    def literals(self, code):
+        return self.vm.compiler.compile(parse(code), self.vm.env).literals
+
+    def test_shared(self):
+        literals = self.literals('(list "a" 42 \'b "a" 42 \'b)')
+        assert literals.count("a") == 1
+        assert literals.count(42) == 1
+        assert literals.count(sym('b')) == 1
+
+    def test_types(self):
+        # equal values of different types are different literals
+        literals = self.literals('(list 42 42.0 "a" 42)')
+        assert [type(lit) for lit in literals if lit == 42] == [int, float]
+
+    def test_pairs(self):
+        # quoted lists are only shared with themselves
+        literals = self.literals("(list '(1 2) '(1 2))")
+        assert len([lit for lit in literals if str(lit) == '(1 2)']) == 2
+        lst = self.vm.eval_string("(list '(1 2) '(1 2))")
+        assert lst.first == lst.rest.first
+
+    def test_nested_procedures(self):
+        # the procedures of a unit share the literals of its form
+        form = self.vm.compiler.compile(parse("""
+        (define (f) (list "abc" (lambda () (list "abc" "def"))))"""),
+                                        self.vm.env)
+        assert form.literals.count("abc") == 1
+        self.vm.run(form)
+        f = self.vm.env.read_local(self.vm.env.find_local('f'))
+        assert f.literals is form.literals
+        assert self.vm.eval_string("(car (cdr ((car (cdr (f))))))") == "def"
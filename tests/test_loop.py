@@ -0,0 +1,87 @@
+from skime.vm import VM
+from skime.iset import INSTRUCTIONS, OPCODE_MASK
+from skime.insns import ENGINES
+
+class TestLoop(object):
+    """\
+    Named lets, do and letrec loops only calling themselves in tail
+    position are compiled into jumps in the frame of the procedure.
+    """
+    def setup(self):
+        self.vm = VM()
+
+    def names(self, code):
+        "Names of the instructions of the procedure code evaluates to."
+        bytecode = self.vm.eval_string(code).bytecode
+        names = []
+        ip = 0
+        while ip < len(bytecode):
+            insn = INSTRUCTIONS[bytecode[ip] & OPCODE_MASK]
+            names.append(insn.name)
+            ip += insn.length
+        return names
+
+    def check_values(self, engine):
+        vm = VM(engine=engine)
+        vm.eval_string("""
+        (define (sum n)
+          (let loop ((i 0) (acc 0))
+            (if (= i n) acc (loop (+ i 1) (+ acc i)))))""")
+        vm.eval_string("""
+        (define (fact n)
+          (letrec ((loop (lambda (i acc)
+                           (if (= i 0) acc (loop (- i 1) (* acc i))))))
+            (loop n 1)))""")
+        vm.eval_string("""
+        (define (count n)
+          (do ((i 0 (+ i 1)) (acc '() (cons i acc))) ((= i n) acc)))""")
+        vm.eval_string("""
+        (define (triangle n)
+          (let outer ((i 0) (s 0))
+            (cond ((= i n) s)
+                  (else (outer (+ i 1)
+                               (let inner ((j 0) (t s))
+                                 (if (= j i) t (inner (+ j 1) (+ t 1)))))))))""")
+        assert vm.eval_string("(sum 1000)") == 499500
+        assert vm.eval_string("(fact 5)") == 120
+        assert vm.eval_string("(car (count 5))") == 4
+        assert vm.eval_string("(triangle 5)") == 10
+        assert vm.stack == []
+
+    def test_values(self):
+        for engine in ENGINES.keys() + ['jit']:
+            yield self.check_values, engine
+
+    def test_jumps(self):
+        for code in ["(lambda (n) (let loop ((i 0)) (if (= i n) i (loop (+ i 1)))))",
+                     "(lambda (n) (do ((i 0 (+ i 1))) ((= i n) i)))",
+                     """(lambda (n)
+                          (letrec ((loop (lambda (i) (if (= i n) i (loop (+ i 1))))))
+                            (loop 0)))"""]:
+            names = self.names(code)
+            assert 'goto' in names
+            assert 'call' not in names and 'tail_call' not in names
+            assert 'fix_lexical' not in names
+
+    def test_not_loop(self):
+        # calls out of tail position and captured variables
+        for code in ["(lambda (n) (let loop ((i n)) (if (= i 0) 0 (+ 1 (loop (- i 1))))))",
+                     "(lambda (n) (let loop ((i n)) (if (= i 0) (lambda () i) (loop (- i 1)))))"]:
+            assert 'goto' not in self.names(code)
+        assert self.vm.eval_string(
+            "((lambda (n) (let loop ((i n)) (if (= i 0) 0 (+ 1 (loop (- i 1)))))) 10)") == 10
+        assert self.vm.eval_string(
+            "(((lambda (n) (let loop ((i n)) (if (= i 0) (lambda () i) (loop (- i 1))))) 3))") == 0
+
+    def test_scope(self):
+        # the values are out of the scope of the loop, its variables
+        # may shadow it
+        assert self.vm.eval_string("""
+        ((lambda (loop)
+           (let loop ((i (loop 1)))
+             (if (= i 3) i (loop (+ i 1)))))
+         (lambda (x) (+ x 1)))""") == 3
+        assert self.vm.eval_string(
+            "((lambda () (let loop ((loop 3)) loop)))") == 3
+        assert self.vm.eval_string(
+            "(let loop ((i 0)) (if (= i 3) i (loop (+ i 1))))") == 3
@@ -0,0 +1,79 @@
+from skime.vm import VM
+from skime.iset import INSTRUCTIONS, OPCODE_MASK
+from skime.compiler.parser import parse
+from skime.compiler.peephole import optimize
+
+class TestPeephole(object):
+    def setup(self):
+        self.vm = VM()
+
+    def names(self, code):
+        "Names of the instructions of code, or of a procedure."
+        if isinstance(code, str):
+            bytecode = self.vm.compiler.compile(parse(code), self.vm.env).bytecode
+        else:
+            bytecode = code.bytecode
+        names = []
+        ip = 0
+        while ip < len(bytecode):
+            insn = INSTRUCTIONS[bytecode[ip] & OPCODE_MASK]
+            names.append(insn.name)
+            ip += insn.length
+        return names
+
+    def test_binary_call_on_locals(self):
+        f = self.vm.eval_string("(lambda (a b) (list (* a b)))")
+        assert self.names(f) == ['call_locals', 'tail_call_global']
+        assert self.vm.apply(f, [1, 2]).first == 2
+
+    def test_call_literal_global(self):
+        assert self.names("(list -1)") == ['call_literal_global']
+
+    def test_call_pop(self):
+        f = self.vm.eval_string("(lambda (g) (g) 2)")
+        assert self.names(f) == ['push_local', 'call_pop', 'pop', 'push_literal', 'ret']
+        assert self.vm.apply(f, [self.vm.eval_string("(lambda () 1)")]) == 2
+        assert self.vm.apply(f, [self.vm.eval_string("list")]) == 2
+
+    def test_dup_set_local(self):
+        f = self.vm.eval_string("(lambda (a) (set! a 2))")
+        assert self.names(f) == ['push_literal', 'dup_set_local', 'ret']
+        assert self.vm.apply(f, [1]) == 2
+
+    def test_no_fusion_across_labels(self):
+        assert self.vm.eval_string("""
+        (begin
+          (define a 1)
+          (define b 2)
+          (if (< a b) (+ a b) (- a b)))""") == 3
+
+    def test_jump_threading(self):
+        f = self.vm.eval_string("""
+        (lambda (x) (cond ((= x 2) (x)) ((x) => x) (else (x 2))))""")
+        names = self.names(f)
+        assert 'goto' not in names and 'ret' not in names
+        assert names.count('tail_call') == 3
+
+    def test_dead_code(self):
+        f = self.vm.eval_string("(lambda (x) (cond (else 1)))")
+        assert self.names(f) == ['push_1', 'ret']
+        assert self.vm.apply(f, [0]) == 1
+
+    def test_push_pop(self):
+        f = self.vm.eval_string("(lambda (x) x '() 1)")
+        assert self.names(f) == ['push_1', 'ret']
+
+    def test_rewrites(self):
+        def names(stream):
+            return [insn for insn, args in optimize(stream)]
+        assert names([('dup', ()), ('set_local', (0,)), ('pop', ())]) == ['set_local']
+        assert names([('push_true', ()), ('goto_if_false', ('L',)),
+                      ('push_1', ()), ('label', 'L'), ('ret', ())]) == ['push_1', 'ret']
+        assert names([('push_false', ()), ('goto_if_false', ('L',)),
+                      ('push_1', ()), ('label', 'L'), ('ret', ())]) == ['ret']
+        assert names([('push_local', (0,)), ('goto_if_false', ('L',)),
+                      ('goto', ('M',)), ('label', 'L'), ('push_1', ()),
+                      ('label', 'M'), ('push_0', ()), ('ret', ())]) == \
+               ['push_local', 'goto_if_not_false', 'push_1', 'label', 'push_0', 'ret']
+        # a loop to itself is left alone
+        assert names([('label', 'L'), ('goto', ('L',))]) == ['label', 'goto']
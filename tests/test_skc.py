@@ -0,0 +1,91 @@
+from cStringIO import StringIO
+
+from skime.vm import VM
+from skime import skc
+from skime.insns import ENGINES
+from skime.errors import SerializeError
+from skime.compiler.parser import parse
+
+from nose.tools import assert_raises
+
+SOURCE = """
+(begin
+  (define-syntax swap!
+    (syntax-rules ()
+      ((_ a b) (let ((tmp a)) (set! a b) (set! b tmp)))))
+  (define (second l) (car (cdr l)))
+  (define (count n)
+    (let loop ((i 0) (acc '()))
+      (if (= i n) acc (loop (+ i 1) (cons (second '(1 2)) acc)))))
+  (define (counter x) (lambda () (set! x (+ x 1)) x))
+  (define c (counter 10))
+  (define (f a b) (swap! a b) (list a b "s" 1.5 'sym))
+  (define folded (* 99 11))
+  (list (car (count 5)) (c) (c) (f 1 2) folded (+ 1 (second '(1 5)))))
+"""
+
+class TestSkc(object):
+    def compile(self, vm, code):
+        return vm.compiler.compile(parse(code), vm.env)
+
+    def check_load(self, engine):
+        vm = VM()
+        data = skc.dumps(self.compile(vm, SOURCE))
+        vm = VM(engine=engine)
+        result = vm.run(skc.loads(data, vm))
+        assert str(result) == "(2 11 12 (2 1 s 1.5 sym) 1089 6)"
+        # the macros and procedures of the unit are defined
+        assert str(vm.eval_string("(let ((x 1) (y 2)) (swap! x y) (list x y))")) == "(2 1)"
+        assert vm.eval_string("(second '(3 4))") == 4
+        for i in range(150):
+            assert vm.eval_string("(car (count 3))") == 2
+        assert vm.stack == []
+
+    def test_load(self):
+        for engine in ENGINES.keys() + ['jit']:
+            yield self.check_load, engine
+
+    def test_file(self):
+        vm = VM()
+        io = StringIO()
+        skc.dump(self.compile(vm, "(define (f x) (* x 2))"), io)
+        vm = VM()
+        io.seek(0)
+        vm.run(skc.load(io, vm))
+        assert vm.eval_string("(f 21)") == 42
+
+    def test_globals(self):
+        # the globals of the unit are allocated in a VM set up the same
+        # way, and have to be at the same indexes
+        vm = VM()
+        vm.eval_string("(define x 1)")
+        data = skc.dumps(self.compile(vm, "(define y (+ x 1))"))
+        vm = VM()
+        vm.eval_string("(define x 2)")
+        vm.run(skc.loads(data, vm))
+        assert vm.eval_string("y") == 3
+        vm = VM()
+        vm.eval_string("(define z 2)")
+        assert_raises(SerializeError, skc.loads, data, vm)
+
+    def test_redefined(self):
+        # the globals inlined by the unit are those of the VM it is
+        # loaded in, checked by the guards
+        vm = VM()
+        data = skc.dumps(self.compile(vm, "(define (f x) (+ x (car '(1))))"))
+        vm = VM()
+        vm.eval_string("(define (car x) 10)")
+        vm.run(skc.loads(data, vm))
+        assert vm.eval_string("(f 1)") == 11
+        vm = VM()
+        vm.eval_string("(set! + -)")
+        vm.run(skc.loads(data, vm))
+        assert vm.eval_string("(f 1)") == 0
+
+    def test_invalid(self):
+        vm = VM()
+        data = skc.dumps(self.compile(vm, "(+ 1 2)"))
+        assert_raises(SerializeError, skc.loads, "", vm)
+        assert_raises(SerializeError, skc.loads, "XXXX" + data[4:], vm)
+        assert_raises(SerializeError, skc.loads, data[:skc.HEADER.size+5], vm)
+        assert vm.run(skc.loads(data, vm)) == 3
@@ -0,0 +1,38 @@
+from skime.vm import VM
+from skime.insns import ENGINES
+from skime.errors import WrongArgType
+
+from nose.tools import assert_raises
+
+class TestStack(object):
+    """\
+    All contexts share the operand stack of the VM.
+    """
+    def check_balanced(self, engine):
+        vm = VM(engine=engine)
+        vm.eval_string("""
+        (begin
+          (define (f) 2)
+          (define (g . rest) rest)
+          (define (h x) (g x (f))))""")
+        assert vm.eval_string("(+ 1 (f))") == 3
+        assert vm.eval_string("(+ (f) (car (h 1)) (car (cdr (h 1))))") == 5
+        assert vm.eval_string("(apply h '(5))").first == 5
+        assert vm.stack == []
+
+    def test_balanced(self):
+        for engine in ENGINES:
+            yield self.check_balanced, engine
+
+    def test_error(self):
+        vm = VM()
+        assert_raises(WrongArgType, vm.eval_string, "(+ 1 2 (car 5))")
+        assert vm.stack == []
+        assert vm.eval_string("(+ 1 2)") == 3
+
+    def test_continuation_restores_stack(self):
+        vm = VM()
+        vm.eval_string("(define k #f)")
+        assert vm.eval_string("(+ 1 2 (call/cc (lambda (c) (set! k c) 3)))") == 6
+        assert vm.eval_string("(k 10)") == 13
+        assert vm.stack == []
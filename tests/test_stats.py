@@ -0,0 +1,43 @@
+import json
+
+from skime.vm import VM
+from skime.iset import INSN_MAP
+
+class TestStats(object):
+    def setup(self):
+        self.vm = VM()
+
+    def test_counts(self):
+        self.vm.enable_stats()
+        assert self.vm.eval_string("(list 1 2)").rest.first == 2
+        stats = self.vm.stats
+        assert stats.counts[INSN_MAP['push_1'].opcode] == 1
+        assert stats.counts[INSN_MAP['call_literal_global'].opcode] == 1
+        assert stats.total() == 2
+        assert stats.pairs[INSN_MAP['push_1'].opcode][INSN_MAP['call_literal_global'].opcode] == 1
+
+    def test_disable(self):
+        self.vm.enable_stats()
+        self.vm.eval_string("(list 1 2)")
+        self.vm.disable_stats()
+        self.vm.eval_string("(list 1 2)")
+        assert self.vm.stats.total() == 2
+        self.vm.stats.reset()
+        assert self.vm.stats.total() == 0
+
+    def test_as_dict(self):
+        self.vm.enable_stats()
+        self.vm.eval_string("""
+        (begin
+          (define (fact n) (if (= n 0) 1 (* n (fact (- n 1)))))
+          (fact 5))""")
+        stats = json.loads(json.dumps(self.vm.stats.as_dict()))
+        assert stats['instructions']['numeq2']['count'] == 6
+        assert stats['instructions']['sub2']['count'] == 5
+        assert stats['instructions']['call_known']['count'] == 6
+        assert stats['instructions']['tail_call_global']['count'] == 5
+        assert stats['instructions']['ret']['time'] >= 0
+        counts = [p['count'] for p in stats['pairs']]
+        assert counts == sorted(counts, reverse=True)
+        # the first instruction run has no predecessor
+        assert sum(counts) == stats['total'] - 1
@@ -0,0 +1,110 @@
+import sys
+
+from skime.vm import VM
+from skime.insns import ENGINES
+
+class TestTrampoline(object):
+    """\
+    apply, map and macro expansions run in the run loop of their
+    caller, so their nesting isn't limited by the Python stack.
+    """
+    depth = sys.getrecursionlimit() * 2
+
+    def check_apply(self, engine):
+        vm = VM(engine=engine)
+        vm.eval_string("""
+        (define (f n)
+          (if (= n 0) 0 (+ 1 (apply f (list (- n 1))))))""")
+        assert vm.eval_string("(f %d)" % self.depth) == self.depth
+        assert vm.stack == []
+
+    def check_map(self, engine):
+        vm = VM(engine=engine)
+        vm.eval_string("""
+        (define (f n)
+          (if (= n 0) 0 (car (map (lambda (x) (+ 1 (f x))) (list (- n 1))))))""")
+        assert vm.eval_string("(f %d)" % self.depth) == self.depth
+        assert vm.stack == []
+
+    def check_macro(self, engine):
+        vm = VM(engine=engine)
+        vm.eval_string("""
+        (begin
+          (define-syntax my-if
+            (syntax-rules ()
+              ((_ c a b) (if c a b))))
+          (define (f n)
+            (my-if (= n 0) 0 (+ 1 (f (- n 1))))))""")
+        assert vm.eval_string("(f %d)" % self.depth) == self.depth
+        assert vm.stack == []
+
+    def test_nesting(self):
+        for engine in ENGINES.keys() + ['jit']:
+            yield self.check_apply, engine
+            yield self.check_map, engine
+            yield self.check_macro, engine
+
+    def test_continuation_in_map(self):
+        vm = VM()
+        assert vm.eval_string("""
+        (+ 1 (call/cc
+               (lambda (return)
+                 (map (lambda (x) (if (= x 2) (return 10) x)) '(1 2 3))
+                 0)))""") == 11
+        assert vm.stack == []
+
+    def check_tail_map(self, engine):
+        vm = VM(engine=engine)
+        assert str(vm.eval_string("""
+        (begin
+          (define (f l) (map (lambda (x) (* x 2)) l))
+          (f '(1 2 3)))""")) == "(2 4 6)"
+        assert str(vm.eval_string("""
+        (begin
+          (define (g l) (map (lambda (x) (car (f (list x)))) l))
+          (g '(1 2 3)))""")) == "(2 4 6)"
+        assert str(vm.eval_string("""
+        (letrec ((lp (lambda (x) (if (pair? x) (map lp x) (+ x 1))))
+                 (h (lambda (l) (map lp l))))
+          (h '(1 (2 3) 4)))""")) == "(2 (3 4) 5)"
+        assert vm.stack == []
+
+    def check_tail_apply(self, engine):
+        vm = VM(engine=engine)
+        vm.eval_string("""
+        (begin
+          (define (f l) (apply + l))
+          (define (g l) (apply f (list l))))""")
+        assert vm.eval_string("(f '(1 2 3))") == 6
+        assert vm.eval_string("(g '(1 2 3))") == 6
+        assert vm.stack == []
+
+    def check_tail_map_continuation(self, engine):
+        vm = VM(engine=engine)
+        assert vm.eval_string("""
+        (+ 1 (call/cc
+               (lambda (return)
+                 (map (lambda (x) (if (= x 2) (return 10) x)) '(1 2 3)))))""") == 11
+        assert vm.stack == []
+
+    def check_map_reentered(self, engine):
+        # the state of map is saved by the continuation, which resumes
+        # it each time it is called
+        vm = VM(engine=engine)
+        assert str(vm.eval_string("""
+        (let ((k #f) (n 0))
+          (let ((r (map (lambda (x)
+                          (call/cc (lambda (c) (if (= x 2) (set! k c)) x)))
+                        '(1 2 3))))
+            (set! n (+ n 1))
+            (if (< n 3) (k (* 10 n)) r)))""")) == "(1 20 3)"
+
+    def test_continuation_reentered(self):
+        for engine in ENGINES.keys() + ['jit']:
+            yield self.check_map_reentered, engine
+
+    def test_tail_position(self):
+        for engine in ENGINES.keys() + ['jit']:
+            yield self.check_tail_map, engine
+            yield self.check_tail_apply, engine
+            yield self.check_tail_map_continuation, engine
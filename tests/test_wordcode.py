@@ -0,0 +1,48 @@
+from skime.vm import VM
+from skime.iset import INSN_MAP, EXTENDED, encode, decode
+from skime.insns import ENGINES
+from skime.compiler.parser import parse
+
+class TestWordcode(object):
+    """\
+    Every instruction is a single word, preceded by extended_arg words
+    when its operands are too large for it.
+    """
+    def test_encode(self):
+        for name, operands in [('ret', []),
+                               ('push_literal', [5]),
+                               ('push_literal', [2**30]),
+                               ('call_known', [3, 2, 300]),
+                               ('call_locals', [70, 1, 2**20, 3])]:
+            insn = INSN_MAP[name]
+            words = encode(insn, operands)
+            assert [(ip, i.name, ops) for ip, i, ops in decode(words)][-1] == \
+                   (len(words)-1, name, operands)
+            assert len(words) > 1 or not words[0] & EXTENDED
+
+    def test_extended(self):
+        vm = VM()
+        assert len(encode(INSN_MAP['call_known'], [3, 2, 1])) == 1
+        assert len(encode(INSN_MAP['call_known'], [3, 2, 300])) == 2
+        form = vm.compiler.compile(parse("(list %s)" % ' '.join(['"%d"' % i for i in range(300)])),
+                                   vm.env)
+        assert 'extended_arg' in [insn.name for ip, insn, operands in decode(form.bytecode)]
+
+    def check_values(self, engine):
+        # operands larger than their field, in a loop getting hot enough
+        # to be compiled by the jit
+        vm = VM(engine=engine)
+        vm.eval_string("(define (id x) x)")
+        vm.eval_string("""
+        (define (f n)
+          (list %s)
+          (let loop ((i 0) (s '()))
+            (if (= i n) s (loop (+ i 1) (id "last")))))""" %
+                       ' '.join(['"%d"' % i for i in range(300)]))
+        for i in range(3):
+            assert vm.eval_string("(f 200)") == "last"
+        assert vm.stack == []
+
+    def test_values(self):
+        for engine in ENGINES.keys() + ['jit']:
+            yield self.check_values, engine